@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Microbenchmark of method invocation through _MethodInfo.
+
+Times _MethodInfo.invoke for methods taking no parameters, a few named
+parameters, and **kwargs, and compares it with binding every argument by
+keyword, which is how methods were invoked before binders were introduced.
+
+Usage:
+
+    python benchmarks/binders.py [--number N]
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from werkzeug.test import create_environ
+from werkzeug.wrappers import Request
+
+from pystapler.dispatch import _MethodInfo
+from pystapler.request import RequestParams
+
+
+class Target(object):
+    def zero(self):
+        return self
+
+    def few(self, spam, eggs, ham='ham'):
+        # pylint: disable=unused-argument
+        return self
+
+    def keywords(self, spam, **kwargs):
+        # pylint: disable=unused-argument
+        return self
+
+
+def _invoke_by_keyword(method_info, method, obj, request_params):
+    """Invokes method the way pystapler used to, for comparison."""
+    parameters = [parameter.name for parameter in method_info.parameters]
+    for required_arg in method_info.required_args:
+        if required_arg not in request_params:
+            raise AssertionError('missing ' + required_arg)
+    if 'kwargs' in parameters:
+        kwargs = dict(request_params)
+    else:
+        kwargs = {
+            key: request_params[key]
+            for key in parameters
+            if key in request_params}
+    kwargs['self'] = obj
+    return method(**kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=200000)
+    args = parser.parse_args()
+
+    request = Request(create_environ('/?spam=1&eggs=2&x=3&y=4&z=5'))
+    request_params = RequestParams(request)
+    obj = Target()
+    for name in ('zero', 'few', 'keywords'):
+        method = getattr(Target, name)
+        method_info = _MethodInfo(method)
+        bound = timeit.timeit(
+            lambda: method_info.binder(obj, request_params),
+            number=args.number)
+        keyword = timeit.timeit(
+            lambda: _invoke_by_keyword(
+                method_info, method, obj, request_params),
+            number=args.number)
+        print('{:9}  binder {:6.3f} us  by keyword {:6.3f} us'.format(
+            name, bound / args.number * 1e6, keyword / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Benchmark of deep-path dispatch with and without route plans.
+
+Builds an application whose URL tree is eight segments deep, and times
+requests to the deepest path by calling the WSGI application directly, once
+with route plans enabled and once with the recursive dispatcher.
+
+Usage:
+
+    python benchmarks/route_plans.py [--number N]
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from werkzeug.test import create_environ
+
+from pystapler.dispatch import StaplerRoot, traversable, default
+from pystapler.response import plaintext
+
+
+DEPTH = 8
+
+
+class Node(object):
+    def __init__(self, depth):
+        self.depth = depth
+
+    @traversable
+    def child(self):
+        return Node(self.depth + 1)
+
+    @default
+    @plaintext
+    def render(self):
+        return 'node {}'.format(self.depth)
+
+
+class Root(StaplerRoot):
+    @traversable
+    def child(self):
+        return Node(1)
+
+
+def _start_response(status, headers, exc_info=None):
+    # pylint: disable=unused-argument
+    return lambda data: None
+
+
+def _time_requests(root, path, number):
+    """Returns the mean time in seconds to serve one request to path."""
+    def request():
+        environ = create_environ(path)
+        for _ in root(environ, _start_response):
+            pass
+    request()
+    return timeit.timeit(request, number=number) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    path = '/' + '/'.join(['child'] * DEPTH)
+    for route_plans in (False, True):
+        root = Root()
+        root.config.route_plans = route_plans
+        seconds = _time_requests(root, path, args.number)
+        print('route_plans={!s:5}  {:8.2f} us/request  {:9.0f} requests/s'
+              .format(route_plans, seconds * 1e6, 1 / seconds))
+
+
+if __name__ == '__main__':
+    main()
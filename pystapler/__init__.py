@@ -12,8 +12,8 @@ Example Usage:
     from pystapler import pystapler
 
     class Root(pystapler.StaplerRoot):
-        assets = pystapler.static_root('assets')
-        env = pystapler.JinjaEnvironment('templates')
+        assets = pystapler.static.static_root('assets')
+        env = pystapler.jinja.JinjaEnvironment('templates')
 
         def __init__(self):
             self.guestbook = []
@@ -43,6 +43,11 @@ You can launch this application using:
 
     uwsgi --socket 0.0.0.0:8080 --wsgi-file example.py --callable Root
 
+Or, using an ASGI server (Python 3 only), where "async def" methods are
+awaited rather than run on a thread:
+
+    uvicorn example:root.asgi
+
 Or, for development:
 
     python example.py --port 8080 --debug
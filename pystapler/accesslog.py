@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements access logging that stays off the request thread.
+
+A StaplerRoot logs requests through the AccessLog in its configuration
+(StaplerConfig.access_log). Whether a request is logged at all is decided
+once, when it starts: the access logger must be enabled for the configured
+level, and the request must be picked by sampling. For the requests that are
+logged, the request thread only collects a few values into a tuple and puts
+it on a queue; a background thread formats the record and hands it to the
+logging module.
+
+Each record is logged as a message like:
+
+    127.0.0.1 "GET /spam?page=2" 200 5120 1.234ms
+
+and also carries the values as a dictionary in its "access" attribute, with
+the keys remote_addr, method, path, query_string, status (an integer, or
+None if the response was never started), bytes, latency (in seconds) and
+time (the Unix time at which the request arrived), for handlers that emit
+structured logs.
+
+Example Usage:
+
+    class Config(StaplerConfig):
+        # Log one request in a hundred.
+        access_log = AccessLog(sample_rate=0.01)
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+import inspect
+import logging
+import os
+import random
+import threading
+import time
+
+from six.moves import queue
+
+
+# The clock that request phases, access log latencies and reloads are timed
+# with. Python 2 has no perf_counter.
+_timer = getattr(time, 'perf_counter', time.time)
+
+LOGGER = logging.getLogger(__name__)
+
+_FIELDS = (
+    'time', 'remote_addr', 'method', 'path', 'query_string', 'status',
+    'bytes', 'latency')
+
+
+def _record(environ, started_at, started, status, sent_bytes):
+    """Returns the record of a finished request, in _FIELDS order."""
+    return (
+        started_at,
+        environ.get('REMOTE_ADDR', '-'),
+        environ.get('REQUEST_METHOD', ''),
+        environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+        environ.get('QUERY_STRING', ''),
+        status[0] if status else None,
+        sent_bytes,
+        _timer() - started)
+
+
+class _LoggedIterable(object):
+    """Wraps a WSGI response iterable, and logs the request when closed."""
+
+    def __init__(self, access_log, environ, started_at, started, status,
+                 app_iter):
+        # pylint: disable=too-many-arguments
+        self.__access_log = access_log
+        self.__environ = environ
+        self.__started_at = started_at
+        self.__started = started
+        self.__status = status
+        self.__app_iter = app_iter
+        self.__bytes = 0
+
+    def __iter__(self):
+        for chunk in self.__app_iter:
+            self.__bytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        """Closes the wrapped iterable, and logs the request."""
+        try:
+            close = getattr(self.__app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.__access_log.enqueue(_record(
+                self.__environ, self.__started_at, self.__started,
+                self.__status, self.__bytes))
+
+
+def _log_on_close(access_log, environ, started_at, started, status,
+                  app_iter):
+    """Makes a file wrapper log the request when it is closed.
+
+    The server must get the file wrapper itself, not a wrapper around it,
+    to be able to send the file with sendfile(), so its close method is
+    replaced instead. The bytes sent are taken from the Content-Length.
+
+    Returns:
+        False if the close method cannot be replaced.
+    """
+    # pylint: disable=too-many-arguments
+    close = getattr(app_iter, 'close', None)
+
+    def logging_close():
+        """Closes the file, and logs the request."""
+        try:
+            if close is not None:
+                close()
+        finally:
+            access_log.enqueue(_record(
+                environ, started_at, started, status,
+                status[1] if len(status) > 1 else 0))
+    try:
+        app_iter.close = logging_close
+    except AttributeError:
+        return False
+    return True
+
+
+class AccessLog(object):
+    """Logs one record per request, from a background thread.
+
+    Records are written to the named logger at the given level. If the
+    logger is not enabled for that level, requests are not timed or
+    recorded at all. Otherwise, each request is logged with probability
+    sample_rate.
+
+    Records are dropped, rather than slowing requests down, if the queue
+    fills up because the background thread cannot keep up; the dropped
+    attribute counts them.
+    """
+
+    def __init__(self, logger='pystapler.access', level=logging.INFO,
+                 sample_rate=1.0, max_queue=10000):
+        """Creates an access log.
+
+        Parameters:
+            logger:
+                The name of the logger to write records to, or a Logger.
+            level:
+                The level to log records at.
+            sample_rate:
+                The fraction of requests to log, between 0 and 1.
+            max_queue:
+                The maximum number of records waiting to be written.
+        """
+        if not isinstance(logger, logging.Logger):
+            logger = logging.getLogger(logger)
+        self.logger = logger
+        self.level = level
+        self.sample_rate = sample_rate
+        self.max_queue = max_queue
+        self.dropped = 0
+        self.__lock = threading.Lock()
+        # The (process ID, queue) of the writer thread, once it is started.
+        self.__writer = None
+
+    @staticmethod
+    def timer():
+        """Returns the current time, in seconds, for measuring latency."""
+        return _timer()
+
+    def sample(self):
+        """Decides whether the request that is starting should be logged."""
+        if not self.logger.isEnabledFor(self.level):
+            return False
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def log_request(self, application, environ, start_response,
+                    started=None):
+        """Calls a WSGI application, logging the request once it is done.
+
+        The request is logged when the server closes the response iterable,
+        so the latency includes sending the response body. A response that
+        is an instance of the server's wsgi.file_wrapper is returned as it
+        is, so that the server can still send the file efficiently.
+
+        Parameters:
+            application:
+                The WSGI application to call.
+            environ, start_response:
+                The arguments to call it with.
+            started:
+                The value of timer() when the request arrived, if that was
+                before the application is called.
+        """
+        now = _timer()
+        if started is None:
+            started = now
+        started_at = time.time() - (now - started)
+        status = []
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            """Records the status and length of the response."""
+            status[:] = [int(status_line.split(None, 1)[0])]
+            for name, value in headers:
+                if name.lower() == 'content-length' and value.isdigit():
+                    status.append(int(value))
+            return start_response(status_line, headers, exc_info)
+        app_iter = application(environ, recording_start_response)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if (inspect.isclass(file_wrapper)
+                and isinstance(app_iter, file_wrapper)
+                and _log_on_close(
+                    self, environ, started_at, started, status, app_iter)):
+            return app_iter
+        return _LoggedIterable(
+            self, environ, started_at, started, status, app_iter)
+
+    def enqueue(self, record):
+        """Hands a record, a tuple of values in _FIELDS order, to the writer.
+
+        The writer thread is started on first use, and again in a process
+        forked after it was started, since threads do not survive fork().
+        """
+        writer = self.__writer
+        if writer is None or writer[0] != os.getpid():
+            writer = self.__start_writer()
+        try:
+            writer[1].put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=None):
+        """Waits until every record enqueued so far has been written.
+
+        Returns:
+            True if the records were written, or False on timeout.
+        """
+        writer = self.__writer
+        if writer is None or writer[0] != os.getpid():
+            return True
+        written = threading.Event()
+        writer[1].put(written)
+        return written.wait(timeout)
+
+    def __start_writer(self):
+        """Starts the background thread that writes records.
+
+        Returns:
+            The (process ID, queue) of the writer thread.
+        """
+        with self.__lock:
+            writer = self.__writer
+            if writer is not None and writer[0] == os.getpid():
+                return writer
+            record_queue = queue.Queue(maxsize=self.max_queue)
+            thread = threading.Thread(
+                target=self.__write_records, args=(record_queue,),
+                name='pystapler-access-log')
+            thread.daemon = True
+            thread.start()
+            self.__writer = (os.getpid(), record_queue)
+            return self.__writer
+
+    def __write_records(self, record_queue):
+        """Background thread loop: writes records as they are enqueued."""
+        while True:
+            record = record_queue.get()
+            if not isinstance(record, tuple):
+                # An Event put by flush(). (On Python 2, threading.Event is
+                # a function, not a class that isinstance() accepts.)
+                record.set()
+                continue
+            try:
+                self.write(dict(zip(_FIELDS, record)))
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Failed to write access log record')
+
+    def write(self, access):
+        """Writes one record, given as a dictionary, to the logger.
+
+        This is called on the background thread. Subclasses may override it
+        to write records somewhere other than the logging module.
+        """
+        self.logger.log(
+            self.level, '%s "%s %s%s" %s %d %.3fms',
+            access['remote_addr'], access['method'], access['path'],
+            '?' + access['query_string'] if access['query_string'] else '',
+            access['status'] or '-', access['bytes'],
+            access['latency'] * 1000, extra={'access': access})
+
+
+# vim: et ts=4
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements admission control: limits on how many requests may
+call a method at once.
+
+When a method depends on something that has slowed down, such as a database
+or another service, the threads serving requests for it can pile up waiting,
+until there are none left for any other route of the application. A Limiter
+prevents that: it admits a bounded number of concurrent calls to the methods
+it is attached to, lets a bounded number of further requests wait a short
+while for a free slot, and rejects the rest straight away with 503 Service
+Unavailable and a Retry-After header. The other routes keep their threads,
+and so their latency, while one route is overloaded.
+
+A Limiter is attached to a method with the @limit decorator, or to every
+method traversable as a given name through StaplerConfig.route_limits. A
+Limiter may be shared by several methods, which then share its slots.
+
+The slot is held while the method runs, and released when it returns; the
+body of a streamed response is sent after that. Responses served from a
+@cached method's cache, from a memo, or as 304 Not Modified do not call the
+method, and so are never limited. Under ASGI, coroutine methods are never
+made to wait for a slot, since waiting would block the event loop: they are
+admitted or rejected at once.
+
+Limiters can be passed to pystapler.metrics.MetricsPage to export their
+counts, labelled with their names.
+
+Example Usage:
+
+    SEARCH_LIMIT = Limiter(max_concurrent=8, max_queued=16)
+
+    class Config(StaplerConfig):
+        route_limits = {'reports': Limiter(max_concurrent=2)}
+
+    class Root(StaplerRoot):
+        config = Config()
+
+        @traversable
+        @limit(SEARCH_LIMIT)
+        def search(self, q):
+            return search_backend.query(q)
+
+        @traversable
+        def metrics(self):
+            return MetricsPage(METRICS, SEARCH_LIMIT)
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+import threading
+import time
+
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.wrappers import Response
+
+from pystapler.dispatch import _decorate_impl
+from pystapler.metrics import render_samples
+
+
+class Limiter(object):
+    """Limits the number of concurrent calls to a set of methods.
+
+    The in_flight and queued attributes are the number of calls currently
+    admitted and waiting; admitted and rejected count the calls admitted
+    and rejected so far.
+    """
+    # The settings and counts are public, for tests and monitoring to read.
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, max_concurrent, max_queued=0, queue_timeout=1.0,
+                 retry_after=1, name=None):
+        """Creates a limiter.
+
+        Parameters:
+            max_concurrent:
+                The maximum number of calls admitted at once.
+            max_queued:
+                The maximum number of calls that wait for a slot when all
+                of them are taken. Calls beyond that are rejected at once.
+            queue_timeout:
+                The number of seconds a call waits for a slot before it is
+                rejected.
+            retry_after:
+                The number of seconds clients are told to wait before trying
+                a rejected request again.
+            name:
+                The route label of the limiter's metrics. By default, this
+                is the name of the first method that uses the limiter.
+        """
+        if max_concurrent < 1:
+            raise ValueError('max_concurrent must be at least 1')
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.name = name
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.__condition = threading.Condition(threading.Lock())
+
+    def rejection(self):
+        """Returns the error raised by a call that was not admitted."""
+        return ServiceUnavailable(response=Response(
+            'This resource is overloaded; try again later.',
+            status=503, content_type='text/plain',
+            headers=[('Retry-After', str(self.retry_after))]))
+
+    def acquire(self, block=True):
+        """Takes a slot, waiting for one if the queue has room.
+
+        Parameters:
+            block:
+                If false, a call is rejected rather than made to wait.
+
+        Raises:
+            ServiceUnavailable: if the call is not admitted.
+        """
+        with self.__condition:
+            # Calls that are already waiting go first.
+            if self.in_flight < self.max_concurrent and not self.queued:
+                self.in_flight += 1
+                self.admitted += 1
+                return
+            if not block or self.queued >= self.max_queued:
+                self.rejected += 1
+                raise self.rejection()
+            deadline = time.time() + self.queue_timeout
+            self.queued += 1
+            try:
+                while self.in_flight >= self.max_concurrent:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise self.rejection()
+                    self.__condition.wait(remaining)
+            finally:
+                self.queued -= 1
+            self.in_flight += 1
+            self.admitted += 1
+
+    def release(self):
+        """Gives back a slot taken by acquire()."""
+        with self.__condition:
+            self.in_flight -= 1
+            self.__condition.notify()
+
+    def run(self, compute):
+        """Returns compute(), called while holding a slot.
+
+        Raises:
+            ServiceUnavailable: if the call is not admitted.
+        """
+        self.acquire()
+        try:
+            return compute()
+        finally:
+            self.release()
+
+    def stats(self):
+        """Returns a dictionary of the limiter's current counts."""
+        with self.__condition:
+            return {
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+            }
+
+    def metric_samples(self):
+        """Returns the limiter's metrics, as render_samples() takes them."""
+        stats = self.stats()
+        labels = [('route', str(self.name))]
+        return [
+            ('pystapler_admission_in_flight', 'gauge',
+             'Calls being served.', labels, stats['in_flight']),
+            ('pystapler_admission_queued', 'gauge',
+             'Calls waiting to be admitted.', labels, stats['queued']),
+            ('pystapler_admission_admitted_total', 'counter',
+             'Calls admitted.', labels, stats['admitted']),
+            ('pystapler_admission_rejected_total', 'counter',
+             'Calls rejected with 503 Service Unavailable.', labels,
+             stats['rejected']),
+        ]
+
+    def render_metrics(self):
+        """Returns the limiter's metrics in the Prometheus text format."""
+        return render_samples(self.metric_samples())
+
+
+def limit(limiter=None, **kwargs):
+    """Limits the number of concurrent calls to a method.
+
+    The argument is a Limiter, which may be shared with other methods.
+    Alternatively, the keyword arguments of Limiter may be given, to create
+    one for this method alone.
+
+    Example Usage:
+
+        @traversable
+        @limit(max_concurrent=4, max_queued=8, queue_timeout=0.5)
+        def quote(self, symbol):
+            return pricing_service.quote(symbol)
+    """
+    if limiter is None:
+        limiter = Limiter(**kwargs)
+    elif kwargs:
+        raise TypeError('Give either a Limiter or its arguments, not both')
+
+    def decorator_closure(method):
+        """Decorator closure that attaches the limiter to the method."""
+        return _decorate_impl(method, admission=limiter)
+    return decorator_closure
+
+
+# vim: et ts=4
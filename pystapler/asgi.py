@@ -0,0 +1,612 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements the ASGI application protocol, so that a StaplerRoot
+can be served by an asynchronous server such as uvicorn or hypercorn:
+
+    uvicorn example:root.asgi
+
+When dispatching a request through ASGI, traversable and @default methods
+that are defined with "async def" are awaited on the event loop. All other
+methods are called on a thread pool, so that a method that blocks does not
+block the event loop. The WSGI response object that dispatching produces is
+compressed, if StaplerConfig.compression says so, and then sent back to the
+client.
+
+The request body is received from the client only when something reads it,
+so requests to methods that do not use it are dispatched straight away. The
+body cannot be read on the event loop: coroutine methods take it as their
+form, json, stream or files parameters, which are computed on the thread
+pool before the method is awaited, rather than reading request.stream.
+
+This module requires Python 3.5 or later.
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import io
+import logging
+import sys
+import threading
+
+from decorator import decorate
+
+from werkzeug.exceptions import (
+    ClientDisconnected, HTTPException, NotFound, RequestEntityTooLarge)
+from werkzeug.wrappers import Request
+
+from pystapler.accesslog import _timer
+from pystapler.dispatch import _Invocation, _MountInfo, _ObjectInfo
+from pystapler.memo import MISSING
+from pystapler.request import (
+    _BODY_INJECTABLES, RequestParams, check_body_size)
+from pystapler.response import PASSTHROUGH_TYPES, _passthrough_response
+
+
+LOGGER = logging.getLogger(__name__)
+
+_END_OF_BODY = object()
+
+
+def run_coroutine(coroutine):
+    """Runs a coroutine to completion on a new event loop.
+
+    This is used to call "async def" methods when dispatching a request from
+    a WSGI worker thread, where no event loop is running.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def decorate_coroutine(method, transform):
+    """Decorates an "async def" method to transform the result it returns.
+
+    This is the coroutine counterpart of the response decorators in
+    pystapler.response: the decorated method is itself a coroutine function,
+    which awaits the original method and returns transform(result).
+    """
+    async def caller(method, *args, **kwargs):
+        """Coroutine decorator closure."""
+        return transform(await method(*args, **kwargs))
+    return decorate(method, caller)
+
+
+def _build_environ(scope, body):
+    """Builds a WSGI environment dictionary from an ASGI HTTP scope.
+
+    The body is a file object from which the request body is read. If the
+    request does not declare the length of its body, the environment says
+    that the body ends where the file does.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8')
+                       .decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'asgi.scope': scope,
+    }
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+        environ['REMOTE_PORT'] = str(client[1])
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ and name != 'CONTENT_LENGTH':
+            value = environ[name] + ',' + value
+        environ[name] = value
+    if 'CONTENT_LENGTH' not in environ:
+        environ['wsgi.input_terminated'] = True
+    return environ
+
+
+async def _receive_message(receive):
+    """Returns the next message from an ASGI receive callable."""
+    return await receive()
+
+
+class _AsgiInput(io.RawIOBase):
+    """The body of an ASGI request, as a file read from worker threads.
+
+    Nothing is received from the client until the file is read. Each read
+    waits for the event loop to receive the next chunk, so the file cannot
+    be read on the event loop's own thread.
+    """
+
+    def __init__(self, receive, loop, max_body_size):
+        """Creates the body of a request.
+
+        Parameters:
+            receive:
+                The ASGI receive callable of the request.
+            loop:
+                The event loop the request is handled on.
+            max_body_size:
+                The maximum number of bytes to receive, or None.
+        """
+        io.RawIOBase.__init__(self)
+        self.__receive = receive
+        self.__loop = loop
+        self.__loop_thread = threading.get_ident()
+        self.__max_body_size = max_body_size
+        self.__chunk = memoryview(b'')
+        self.__length = 0
+        self.__more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """Reads into buffer, receiving the next chunk if needed.
+
+        Returns:
+            The number of bytes read, which is zero at the end of the body.
+
+        Raises:
+            ClientDisconnected: if the client went away.
+            RequestEntityTooLarge: if the body is longer than max_body_size.
+                The rest of it is not received.
+        """
+        while not self.__chunk and self.__more_body:
+            if threading.get_ident() == self.__loop_thread:
+                raise RuntimeError(
+                    'The body of an ASGI request cannot be read on the event '
+                    'loop; take form, json, stream or files as parameters')
+            message = asyncio.run_coroutine_threadsafe(
+                _receive_message(self.__receive), self.__loop).result()
+            # After an error, later reads find the end of the body, so that
+            # Werkzeug can drain it without receiving anything more.
+            self.__more_body = message.get('more_body', False)
+            if message['type'] == 'http.disconnect':
+                self.__more_body = False
+                raise ClientDisconnected()
+            chunk = message.get('body', b'')
+            self.__length += len(chunk)
+            if (self.__max_body_size is not None
+                    and self.__length > self.__max_body_size):
+                self.__more_body = False
+                raise RequestEntityTooLarge()
+            self.__chunk = memoryview(chunk)
+        size = min(len(buffer), len(self.__chunk))
+        buffer[:size] = self.__chunk[:size]
+        self.__chunk = self.__chunk[size:]
+        return size
+
+
+def _read_body_parameters(member, request_params):
+    """Computes the parameters of a method that read the request body.
+
+    request_params keeps their values, so that the method can then be
+    called on the event loop without reading the body there.
+    """
+    for parameter in member.parameters:
+        if parameter.name in _BODY_INJECTABLES:
+            request_params.get(parameter.name)
+
+
+class AsgiApplication(object):
+    """An ASGI application that serves a StaplerRoot.
+
+    Instances of this class are normally obtained through the asgi property
+    of a StaplerRoot, rather than created directly.
+    """
+
+    def __init__(self, root, executor=None):
+        """Creates an ASGI application.
+
+        Parameters:
+            root:
+                The StaplerRoot object to dispatch requests to.
+            executor:
+                A concurrent.futures.Executor used to call methods that are
+                not coroutines. If not provided, a thread pool is created
+                on first use, with root.config.asgi_threads threads.
+        """
+        self.__root = root
+        self.__executor = executor
+
+    @property
+    def executor(self):
+        """The executor used to call methods that are not coroutines."""
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(
+                max_workers=self.__root.config.asgi_threads)
+        return self.__executor
+
+    async def __call__(self, scope, receive, send):
+        """Implements the ASGI application protocol."""
+        if scope['type'] == 'http':
+            await self.__handle_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.__handle_lifespan(receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type: ' + scope['type'])
+
+    async def __handle_lifespan(self, receive, send):
+        """Handles the ASGI lifespan protocol."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                config = self.__root.config
+                for task_queue in config.task_queues:
+                    await asyncio.get_event_loop().run_in_executor(
+                        None, task_queue.drain, config.graceful_timeout)
+                if self.__executor is not None:
+                    self.__executor.shutdown(wait=True)
+                    self.__executor = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __handle_http(self, scope, receive, send):
+        """Handles a single HTTP request.
+
+        The body of the request is not received until something reads it,
+        on the executor, so a method that never reads it does not wait for
+        it.
+        """
+        started = _timer()
+        config = self.__root.config
+        body = io.BufferedReader(_AsgiInput(
+            receive, asyncio.get_event_loop(), config.max_body_size))
+        request_params = RequestParams(
+            Request(_build_environ(scope, body)), config)
+        try:
+            await self.__serve(request_params, send, started)
+        finally:
+            request_params.close()
+
+    async def __serve(self, request_params, send, started):
+        """Dispatches a request and sends the response.
+
+        The request is timed if StaplerConfig.metrics is set, and logged if
+        the access log samples it. started is the value of _timer() when the
+        request arrived.
+        """
+        config = self.__root.config
+        metrics = config.metrics
+        trace = None if metrics is None else []
+        parsed = _timer()
+        response = await self.__respond(request_params, trace)
+        on_start = None
+        if metrics is not None:
+            on_start = functools.partial(
+                _record_metrics, metrics, trace, (started, parsed, _timer()))
+        access_log = config.access_log
+        if access_log is not None and access_log.sample():
+            response = functools.partial(
+                access_log.log_request, response, started=started)
+        await self.__send_response(
+            response, request_params.request.environ, send, on_start)
+
+    async def __respond(self, request_params, trace=None):
+        """Dispatches a request, returning the response to send.
+
+        A request whose body is declared to be bigger than max_body_size is
+        rejected before anything reads it. The response is compressed here,
+        if StaplerConfig.compression says so.
+        """
+        request = request_params.request
+        config = self.__root.config
+        path_segments = request.path.lstrip('/').split('/')
+        try:
+            check_body_size(request, config.max_body_size)
+            response = await self.dispatch(
+                path_segments, request_params, trace)
+        except HTTPException as ex:
+            return ex
+        compression = config.compression
+        if compression is not None:
+            # Compressing a body in memory takes a while; keep it off the
+            # event loop.
+            response = await asyncio.get_event_loop().run_in_executor(
+                self.executor, compression.compress, request, response)
+        return response
+
+    async def call(self, member, obj, request_params):
+        """Invokes a _MethodInfo on obj, without blocking the event loop.
+
+        Coroutine methods are awaited directly; other methods are invoked on
+        the executor. Either way, the method is only called when
+        _MethodInfo.invoke() would call it: not if the client's copy is
+        current, or the result is memoized or cached, for example. The @etag
+        and @last_modified methods of a coroutine method are called in the
+        same way, before it. The parameters of a coroutine method that read
+        the request body are computed on the executor before it is awaited.
+        """
+        loop = asyncio.get_event_loop()
+        if not member.is_coroutine:
+            return await loop.run_in_executor(
+                self.executor, member.invoke, obj, request_params)
+        if any(parameter.name in _BODY_INJECTABLES
+               for parameter in member.parameters):
+            await loop.run_in_executor(
+                self.executor, _read_body_parameters, member, request_params)
+        validators = member.validators
+        validator_values = None
+        if validators is not None:
+            validator_values = []
+            for method in (validators.etag_method,
+                           validators.last_modified_method):
+                validator_values.append(
+                    None if method is None
+                    else await self.call(method, obj, request_params))
+            validator_values = validators.normalize(*validator_values)
+        invocation = _Invocation(member, obj, request_params, validator_values)
+        result = invocation.lookup()
+        if result is MISSING:
+            result = invocation.finish(
+                await self.__await_method(member, obj, request_params))
+        return result
+
+    async def __await_method(self, member, obj, request_params):
+        """Awaits a coroutine method, if its limiter admits the call.
+
+        The call never waits for a slot of the limiter, since that would
+        block the event loop: it is rejected at once if there is none.
+        """
+        limiter = member.limiter(request_params.config)
+        if limiter is None:
+            return await self.__await_coalesced(member, obj, request_params)
+        limiter.acquire(block=False)
+        try:
+            return await self.__await_coalesced(member, obj, request_params)
+        finally:
+            limiter.release()
+
+    @staticmethod
+    async def __await_coalesced(member, obj, request_params):
+        """Awaits a coroutine method, coalescing identical requests.
+
+        If the method was decorated with @coalesce and an identical request
+        is already running it, on this event loop or on a WSGI thread, this
+        waits for that request's result instead of calling the method.
+        """
+        coalescer = member.coalesce
+        joined = None
+        if coalescer is not None:
+            joined = coalescer.join(request_params)
+        if joined is None:
+            return _passthrough(
+                member, await member.binder(obj, request_params))
+        key, flight, leader = joined
+        if leader:
+            try:
+                result = _passthrough(
+                    member, await member.binder(obj, request_params))
+            except BaseException as ex:
+                coalescer.land(key, flight, error=ex)
+                raise
+            coalescer.land(key, flight, result)
+        else:
+            loop = asyncio.get_event_loop()
+            landed = loop.create_future()
+            flight.add_done_callback(
+                lambda: loop.call_soon_threadsafe(_resolve, landed))
+            try:
+                await asyncio.wait_for(landed, coalescer.timeout)
+            except asyncio.TimeoutError:
+                raise coalescer.timed_out()
+        return flight.outcome()
+
+    async def dispatch(self, path_segments, request_params, trace=None):
+        """Dispatches a request to the root object.
+
+        This follows the same rules as _ObjectInfo.dispatch, but iteratively,
+        awaiting each method in turn. If trace is not None, it is filled in
+        as by _ObjectInfo.dispatch.
+
+        Returns:
+            A Werkzeug response object or other WSGI application object, which
+            will be used to create the HTTP response.
+        """
+        obj = self.__root
+        while True:
+            member, path_segments = _ObjectInfo(obj).select(
+                path_segments, request_params)
+            if member is None:
+                return NotFound()
+            if isinstance(member, _MountInfo):
+                loop = asyncio.get_event_loop()
+                return await loop.run_in_executor(
+                    self.executor, member.traverse,
+                    obj, path_segments, request_params, trace)
+            if trace is None:
+                result = await self.call(member, obj, request_params)
+            else:
+                started = _timer()
+                result = await self.call(member, obj, request_params)
+                trace.append((member, result, _timer() - started))
+            if callable(result):
+                return result
+            obj = result
+
+    async def __send_response(self, response, environ, send, on_start=None):
+        """Sends a WSGI response object to an ASGI client.
+
+        The WSGI application is called on the executor, as is iteration over
+        its body unless the body is already a list or tuple. If on_start is
+        not None, it is called with the status code once the response has
+        started, before its body is sent.
+        """
+        loop = asyncio.get_event_loop()
+        # The (status, headers) pairs start_response was called with.
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            """WSGI start_response callable."""
+            # pylint: disable=unused-argument
+            started.append((status, headers))
+            return lambda data: None
+
+        app_iter = await loop.run_in_executor(
+            self.executor, response, environ, start_response)
+        iterator = iter(app_iter)
+        if isinstance(app_iter, (list, tuple)):
+            async def next_chunk():
+                """Returns the next chunk of an in-memory body."""
+                return next(iterator, _END_OF_BODY)
+        else:
+            async def next_chunk():
+                """Returns the next chunk of a body, computed on a thread."""
+                return await loop.run_in_executor(
+                    self.executor, next, iterator, _END_OF_BODY)
+        try:
+            # The first chunk must be produced before the status is sent,
+            # since a WSGI application may call start_response lazily.
+            chunk = await next_chunk()
+            status, headers = started[-1]
+            status = int(status.split(' ', 1)[0])
+            if on_start is not None:
+                on_start(status)
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': [
+                    (name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers],
+            })
+            while chunk is not _END_OF_BODY:
+                if chunk:
+                    await send({'type': 'http.response.body',
+                                'body': chunk, 'more_body': True})
+                chunk = await next_chunk()
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            close = getattr(app_iter, 'close', None)
+            if close is not None:
+                close()
+
+
+def _record_metrics(metrics, trace, times, status):
+    """Records the timings of a request that has started its response.
+
+    times is the (started, parsed, dispatched) values of _timer() when the
+    request arrived, when its parameters were built and when it had been
+    dispatched; calling the response object counts as serializing it.
+    """
+    started, parsed, dispatched = times
+    finished = _timer()
+    metrics.record(
+        trace, params_time=parsed - started,
+        serialize_time=finished - dispatched,
+        total_time=finished - started, status=str(status))
+
+
+def _passthrough(member, result):
+    """Turns bytes, buffers, files and generators into responses.
+
+    As in _MethodInfo.call, the results of @etag and @last_modified methods
+    are left alone.
+    """
+    if member.validator is None and isinstance(result, PASSTHROUGH_TYPES):
+        return _passthrough_response(result)
+    return result
+
+
+def _resolve(future):
+    """Marks a future as done, unless it was cancelled in the meantime."""
+    if not future.done():
+        future.set_result(None)
+
+
+class TestResponse(object):
+    """A response received by the ASGI TestClient."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+
+
+class TestClient(object):
+    """An in-process client for testing an ASGI application.
+
+    Requests are sent straight to the application object, without a server
+    or any sockets. The async methods can be used to send many requests
+    concurrently from a test running on an event loop; the others run their
+    own event loop for the duration of a single request.
+    """
+
+    def __init__(self, application):
+        self.__application = application
+
+    async def request_async(self, method, path, query_string=b'',
+                            headers=(), data=b''):
+        """Sends a request and returns a TestResponse."""
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'root_path': '',
+            'query_string': query_string,
+            'headers': [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers],
+            'client': ('127.0.0.1', 0),
+            'server': ('localhost', 80),
+        }
+        request_messages = [
+            {'type': 'http.request', 'body': data, 'more_body': False}]
+        response_messages = []
+
+        async def receive():
+            """ASGI receive callable."""
+            if request_messages:
+                return request_messages.pop(0)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            """ASGI send callable."""
+            response_messages.append(message)
+
+        await self.__application(scope, receive, send)
+        start = response_messages[0]
+        return TestResponse(
+            start['status'],
+            [(name.decode('latin-1'), value.decode('latin-1'))
+             for name, value in start['headers']],
+            b''.join(message.get('body', b'')
+                     for message in response_messages[1:]))
+
+    async def get_async(self, path, query_string=b'', headers=()):
+        """Sends a GET request and returns a TestResponse."""
+        return await self.request_async('GET', path, query_string, headers)
+
+    def get(self, path, query_string=b'', headers=()):
+        """Sends a GET request and returns a TestResponse."""
+        return run_coroutine(self.get_async(path, query_string, headers))
+
+    def post(self, path, data=b'', headers=()):
+        """Sends a POST request and returns a TestResponse."""
+        return run_coroutine(
+            self.request_async('POST', path, headers=headers, data=data))
+
+
+# vim: et ts=4
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements an endpoint that serves several GET requests at once.
+
+A client that needs many small resources can send their paths to the batch
+endpoint in a single HTTP request, instead of making one request for each.
+The request body is a JSON array, each element of which is either a path
+(which may include a query string) or an object with a "path" and an
+optional "params" object of query string parameters:
+
+    ["/users/42", {"path": "/users/42/posts", "params": {"page": "2"}}]
+
+A GET request may list the paths as repeated "path" query string parameters
+instead. The response is a JSON array with one element per sub-request, in
+the same order, each an object with the keys "path", "status",
+"content_type" and "body". The body is included as a JSON value if the
+sub-response was JSON, as text if it was text, and otherwise base64-encoded,
+in which case the element also has "base64": true.
+
+Each sub-request is dispatched like a GET request with the same headers as
+the batch request (except for conditional and content negotiation headers),
+and the headers parsed for one sub-request, such as cookies, are parsed
+only once for the whole batch. Objects returned by traversable methods are
+reused by later sub-requests in the same batch that traverse the same
+method on the same object with the same arguments, so sub-requests for
+/users/42 and /users/42/posts look the user up once.
+
+Example Usage:
+
+    BATCH = Batch(threads=8)
+
+    class Root(StaplerRoot):
+        @traversable
+        def batch(self):
+            return BatchPage(BATCH, self)
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import json
+import os
+import threading
+
+import six
+from six import string_types
+
+from werkzeug.exceptions import BadRequest
+from werkzeug.urls import url_encode
+from werkzeug.wrappers import Request, Response
+
+from pystapler.dispatch import default
+from pystapler.memo import MISSING
+from pystapler.request import _INJECTABLES
+from pystapler.response import _json_encoder
+
+
+# Headers of the batch request that are not passed on to sub-requests, since
+# they describe what the client expects of the batch response as a whole.
+_UNSHARED_HEADERS = (
+    'HTTP_ACCEPT_ENCODING', 'HTTP_IF_MATCH', 'HTTP_IF_NONE_MATCH',
+    'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_RANGE', 'HTTP_IF_UNMODIFIED_SINCE',
+    'HTTP_RANGE', 'CONTENT_TYPE')
+
+# Request properties that sub-requests take from the batch request, so that
+# they are parsed once per batch.
+_SHARED_PROPERTIES = (
+    'accept_charsets', 'accept_languages', 'accept_mimetypes',
+    'authorization', 'cookies', 'user_agent')
+
+_encode_json = _json_encoder(None)
+
+
+def _wsgi_string(text):
+    """Converts text to the form WSGI uses for paths and query strings."""
+    if six.PY2:
+        return text.encode('utf-8')
+    return text.encode('utf-8').decode('latin-1')
+
+
+def _shared_property(name):
+    """Returns a property that reads an attribute of the parent request."""
+    return property(
+        lambda self: getattr(self.parent, name),
+        doc='The {} of the batch request.'.format(name))
+
+
+class _SubRequest(Request):
+    """A sub-request of a batch, sharing parsed headers with its parent.
+
+    Its shared_results are the _SharedResults of the batch, which
+    RequestParams passes on to the dispatcher.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, environ, parent, shared_results):
+        Request.__init__(self, environ)
+        self.parent = parent
+        self.shared_results = shared_results
+
+
+for _name in _SHARED_PROPERTIES:
+    setattr(_SubRequest, _name, _shared_property(_name))
+del _name
+
+
+def _reuse_key(member, request_params):
+    """Returns the arguments member would be called with, or None.
+
+    None means that the member's result cannot be reused, because it takes
+    **kwargs or parameters injected from the request.
+    """
+    arguments = []
+    for parameter in member.parameters:
+        if (parameter.kind == parameter.VAR_KEYWORD
+                or parameter.name in _INJECTABLES):
+            return None
+        arguments.append(request_params.get(parameter.name, parameter.default))
+    return tuple(arguments)
+
+
+class _SharedResults(object):
+    """The objects returned by traversals in one batch, for reuse.
+
+    Sub-requests may be dispatched on several threads at once, so the
+    results are only accessed with the lock held.
+    """
+
+    def __init__(self):
+        # Results of traversals, by (member, id(obj), arguments), as
+        # (obj, result) pairs; obj is kept so that its id is not reused.
+        self.__results = {}
+        self.__lock = threading.Lock()
+
+    def lookup(self, member, obj, request_params):
+        """Returns what member returned for obj in this batch, or MISSING."""
+        arguments = _reuse_key(member, request_params)
+        if arguments is None:
+            return MISSING
+        with self.__lock:
+            reused = self.__results.get((member, id(obj), arguments))
+        if reused is None or reused[0] is not obj:
+            return MISSING
+        return reused[1]
+
+    def store(self, member, obj, request_params, result):
+        """Records what member returned for obj, if it can be reused."""
+        arguments = _reuse_key(member, request_params)
+        if arguments is None:
+            return
+        with self.__lock:
+            self.__results[(member, id(obj), arguments)] = (obj, result)
+
+
+class _BatchState(object):
+    """What the sub-requests of one batch share."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, root, request):
+        self.root = root
+        self.request = request
+        environ = dict(request.environ)
+        for name in _UNSHARED_HEADERS:
+            environ.pop(name, None)
+        environ['REQUEST_METHOD'] = 'GET'
+        environ['CONTENT_LENGTH'] = '0'
+        self.environ = environ
+        self.results = _SharedResults()
+
+
+class Batch(object):
+    """Dispatches the sub-requests of batch requests.
+
+    A Batch is shared by all the requests to a batch endpoint; see
+    BatchPage. It holds the thread pool that sub-requests are dispatched on,
+    if they are dispatched in parallel.
+    """
+
+    def __init__(self, threads=0, max_requests=64):
+        """Creates a Batch.
+
+        Parameters:
+            threads:
+                The number of threads to dispatch sub-requests on. If zero,
+                the sub-requests of a batch are dispatched one after the
+                other on the thread handling the batch request.
+            max_requests:
+                The maximum number of sub-requests in one batch. Larger
+                batches are rejected with 400 Bad Request.
+        """
+        self.threads = threads
+        self.max_requests = max_requests
+        self.__executor = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    @property
+    def executor(self):
+        """The executor sub-requests are dispatched on, created on first use.
+
+        A new one is created in a process forked after it was created, since
+        threads do not survive fork().
+        """
+        if self.__pid != os.getpid():
+            with self.__lock:
+                if self.__pid != os.getpid():
+                    self.__executor = ThreadPoolExecutor(
+                        max_workers=self.threads)
+                    self.__pid = os.getpid()
+        return self.__executor
+
+    def parse(self, request):
+        """Returns the (path, query_string) pairs a batch request asks for.
+
+        Raises:
+            BadRequest: if the request is malformed or asks for too much.
+        """
+        if request.method in ('GET', 'HEAD'):
+            items = request.args.getlist('path')
+        else:
+            try:
+                items = json.loads(request.get_data(as_text=True))
+            except ValueError:
+                raise BadRequest('The batch is not valid JSON')
+            if not isinstance(items, list):
+                raise BadRequest('The batch must be a JSON array')
+        if len(items) > self.max_requests:
+            raise BadRequest('A batch may contain at most {} requests'.format(
+                self.max_requests))
+        sub_requests = []
+        for item in items:
+            params = None
+            if isinstance(item, dict):
+                params = item.get('params')
+                item = item.get('path')
+            if not isinstance(item, string_types) or not (
+                    params is None or isinstance(params, dict)):
+                raise BadRequest('Malformed batch item: {!r}'.format(item))
+            path, _, query_string = item.partition('?')
+            if params:
+                query_string = '&'.join(
+                    part for part in (query_string, url_encode(params)) if part)
+            sub_requests.append((path, query_string))
+        return sub_requests
+
+    def run(self, root, request, sub_requests):
+        """Dispatches sub-requests, and returns their responses.
+
+        Parameters:
+            root:
+                The StaplerRoot to dispatch the sub-requests to.
+            request:
+                The batch request.
+            sub_requests:
+                A list of (path, query_string) pairs, as returned by parse().
+
+        Returns:
+            A list of Werkzeug responses, in the order of sub_requests.
+        """
+        state = _BatchState(root, request)
+        if self.threads and len(sub_requests) > 1:
+            return list(self.executor.map(
+                lambda sub_request: self.respond(state, *sub_request),
+                sub_requests))
+        return [self.respond(state, path, query_string)
+                for path, query_string in sub_requests]
+
+    def respond(self, state, path, query_string):
+        """Dispatches one sub-request, and returns its buffered response.
+
+        The sub-request is served by the root like any other request, with
+        its route plans, metrics and limits, but without access logging.
+        """
+        environ = dict(state.environ)
+        environ['PATH_INFO'] = _wsgi_string(path)
+        environ['QUERY_STRING'] = _wsgi_string(query_string)
+        environ['wsgi.input'] = BytesIO()
+        request = _SubRequest(environ, state.request, state.results)
+        return Response.from_app(
+            lambda environ, start_response: state.root.serve(
+                request, start_response),
+            environ, buffered=True)
+
+
+def _describe(path, response):
+    """Returns the element of a batch response describing a sub-response."""
+    data = response.get_data()
+    description = {
+        'path': path,
+        'status': response.status_code,
+        'content_type': response.content_type,
+    }
+    mimetype = response.mimetype or ''
+    if mimetype == 'application/json' or mimetype.endswith('+json'):
+        try:
+            description['body'] = json.loads(data.decode('utf-8'))
+            return description
+        except ValueError:
+            pass
+    if mimetype.startswith('text/') or 'json' in mimetype or (
+            'xml' in mimetype):
+        description['body'] = data.decode(
+            response.mimetype_params.get('charset', 'utf-8'), 'replace')
+    else:
+        description['body'] = base64.b64encode(data).decode('ascii')
+        description['base64'] = True
+    return description
+
+
+class BatchPage(object):
+    """A traversable object that serves batch requests to an application."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, batch, root):
+        self.batch = batch
+        self.root = root
+
+    @default
+    def render(self, request):
+        """Dispatches the sub-requests of a batch request.
+
+        A sub-request for a batch is rejected, since nesting batches would
+        multiply the work of a request, and could exhaust the thread pool
+        that the outer batch runs on.
+        """
+        if isinstance(request, _SubRequest):
+            raise BadRequest('A batch cannot contain batch requests')
+        sub_requests = self.batch.parse(request)
+        responses = self.batch.run(self.root, request, sub_requests)
+        body = _encode_json([
+            _describe(path, response)
+            for (path, _), response in zip(sub_requests, responses)])
+        return Response(body, content_type='application/json')
+
+
+# vim: et ts=4
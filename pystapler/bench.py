@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements a benchmark suite for the request dispatching path.
+
+Each benchmark sends requests of one kind straight to the WSGI callable of a
+small built-in application, with no sockets involved, and measures the
+number of requests served per second and the peak memory allocated while
+serving a single request. Results are printed as JSON and compared with a
+stored baseline, so that regressions in StaplerRoot.__call__ are caught.
+
+Usage:
+
+    python -m pystapler.bench                     # run and compare
+    python -m pystapler.bench --save-baseline     # record a new baseline
+    python -m pystapler.bench --filter deep       # run matching benchmarks
+
+The exit status is 1 if any benchmark regressed by more than the tolerance.
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no tracemalloc; allocations are not measured there.
+    tracemalloc = None
+
+from werkzeug.test import create_environ
+
+from pystapler.dispatch import StaplerRoot, default, traversable
+from pystapler.response import plaintext, template
+
+
+DEFAULT_BASELINE = os.path.join('benchmarks', 'baseline.json')
+
+DEPTH = 8
+
+
+class _Template(object):
+    """A minimal template object, so the suite does not need Jinja2."""
+    # pylint: disable=too-few-public-methods
+
+    def render(self, items):
+        """Renders a list of items as HTML."""
+        return u'<ul>{}</ul>'.format(
+            u''.join(u'<li>{}</li>'.format(item) for item in items))
+
+
+class _TemplateEnvironment(object):
+    """A minimal template environment, so the suite does not need Jinja2."""
+    # pylint: disable=too-few-public-methods
+
+    def get_template(self, name):
+        """Returns the template with the given name."""
+        # pylint: disable=unused-argument
+        return _Template()
+
+
+_ENV = _TemplateEnvironment()
+
+
+class _Node(object):
+    """A node in the benchmark application's deep URL tree."""
+
+    def __init__(self, depth):
+        self.depth = depth
+
+    @traversable
+    def child(self):
+        """Traverses one level deeper."""
+        return _Node(self.depth + 1)
+
+    @default
+    @plaintext
+    def render(self):
+        """Renders the node."""
+        return u'node {}'.format(self.depth)
+
+
+class _Root(StaplerRoot):
+    """The application that all benchmarks send requests to."""
+
+    @traversable
+    @plaintext
+    def hello(self, name='world'):
+        """A shallow traversal that renders plain text."""
+        return u'Hello, {}!'.format(name)
+
+    @traversable
+    def child(self):
+        """The top of the deep URL tree."""
+        return _Node(1)
+
+    def hidden(self):
+        """A method that is not traversable."""
+
+    @traversable
+    @plaintext
+    def query(self, a0, b0, c0, d0, e0):
+        """A method with several parameters."""
+        return u''.join([a0, b0, c0, d0, e0])
+
+    @traversable
+    @plaintext
+    def keywords(self, **kwargs):
+        """A method that receives every request parameter."""
+        return u'{}'.format(len(kwargs))
+
+    @traversable
+    @template(_ENV, 'list.html')
+    def listing(self):
+        """A method that renders a template."""
+        return {'items': range(100)}
+
+    @traversable
+    @plaintext
+    def upload(self, form):
+        """A method that reads a form posted in the request body."""
+        return u'{}'.format(len(form['data']))
+
+
+def _query(count):
+    """Returns a query string with count parameters."""
+    return '&'.join(
+        '{}{}={}'.format(chr(ord('a') + index % 26), index // 26, index)
+        for index in range(count))
+
+
+# The benchmarks, as (name, path, query string, form body) tuples.
+BENCHMARKS = [
+    ('shallow', '/hello', '', None),
+    ('deep', '/' + '/'.join(['child'] * DEPTH), '', None),
+    ('not_found', '/nothing/here', '', None),
+    ('not_traversable', '/hidden', '', None),
+    ('many_query_params', '/query', _query(50), None),
+    ('kwargs', '/keywords', _query(20), None),
+    ('plaintext', '/hello', 'name=benchmark', None),
+    ('template', '/listing', '', None),
+    ('large_post', '/upload', '', b'data=' + b'x' * (1024 * 1024)),
+]
+
+
+def _start_response(status, headers, exc_info=None):
+    """A WSGI start_response callable that discards its arguments."""
+    # pylint: disable=unused-argument
+    return lambda data: None
+
+
+def _make_request(root, path, query_string, body):
+    """Returns a function that sends one request to root."""
+    body_length = 0 if body is None else len(body)
+    if body is None:
+        environ = create_environ(path, query_string=query_string)
+    else:
+        environ = create_environ(
+            path, query_string=query_string, method='POST', data=body,
+            content_type='application/x-www-form-urlencoded')
+
+    def request():
+        """Sends the request and consumes the response."""
+        request_environ = dict(environ)
+        if body is not None:
+            request_environ['wsgi.input'] = io.BytesIO(body)
+            request_environ['CONTENT_LENGTH'] = str(body_length)
+        app_iter = root(request_environ, _start_response)
+        for _ in app_iter:
+            pass
+        close = getattr(app_iter, 'close', None)
+        if close is not None:
+            close()
+    return request
+
+
+def _peak_allocation(request, repeat=5):
+    """Returns the peak number of bytes allocated while serving a request."""
+    if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+        return None
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(repeat):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            request()
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        return min(peaks)
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmark(path, query_string, body, min_time=0.5):
+    """Runs one benchmark.
+
+    Returns:
+        A dictionary with requests_per_second, usec_per_request and
+        peak_alloc_bytes keys.
+    """
+    root = _Root()
+    request = _make_request(root, path, query_string, body)
+    # Warm up traversal maps, binders and route plans.
+    request()
+    timer = timeit.Timer(request)
+    number = 1
+    elapsed = timer.timeit(number)
+    while elapsed < min_time:
+        number *= 2
+        elapsed = timer.timeit(number)
+    return {
+        'requests_per_second': round(number / elapsed, 1),
+        'usec_per_request': round(elapsed / number * 1e6, 2),
+        'peak_alloc_bytes': _peak_allocation(request),
+    }
+
+
+def run_benchmarks(name_filter=None, min_time=0.5):
+    """Runs all the benchmarks whose names contain name_filter."""
+    results = {}
+    for name, path, query_string, body in BENCHMARKS:
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = run_benchmark(path, query_string, body, min_time)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Compares a report with a baseline report.
+
+    Returns:
+        A list of human-readable descriptions of the regressions found: any
+        benchmark that got slower, or allocates more memory, by more than the
+        given fraction.
+    """
+    regressions = []
+    for name, result in sorted(report['results'].items()):
+        expected = baseline.get('results', {}).get(name)
+        if expected is None:
+            continue
+        ratio = result['usec_per_request'] / expected['usec_per_request']
+        if ratio > 1 + tolerance:
+            regressions.append(
+                '{}: {:.2f} us/request, {:.0%} slower than baseline'.format(
+                    name, result['usec_per_request'], ratio - 1))
+        if result['peak_alloc_bytes'] and expected.get('peak_alloc_bytes'):
+            ratio = result['peak_alloc_bytes'] / float(
+                expected['peak_alloc_bytes'])
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    '{}: {} bytes allocated, {:.0%} more than baseline'.format(
+                        name, result['peak_alloc_bytes'], ratio - 1))
+    return regressions
+
+
+def main(argv=None):
+    """Runs the benchmark suite from the command line."""
+    parser = argparse.ArgumentParser(
+        prog='python -m pystapler.bench',
+        description='Benchmarks pystapler request dispatching.')
+    parser.add_argument(
+        '--baseline', default=DEFAULT_BASELINE,
+        help='baseline JSON file (default: %(default)s)')
+    parser.add_argument(
+        '--save-baseline', action='store_true',
+        help='write the results to the baseline file instead of comparing')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='fraction by which a result may be worse than the baseline '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--filter', help='only run benchmarks whose names contain this')
+    parser.add_argument(
+        '--min-time', type=float, default=0.5,
+        help='minimum seconds to spend on each benchmark')
+    args = parser.parse_args(argv)
+
+    # Some benchmarks exercise paths that log warnings; measure the cost of
+    # creating the log records, but don't print them.
+    logging.getLogger('pystapler').addHandler(logging.NullHandler())
+    report = run_benchmarks(args.filter, args.min_time)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at {}; not comparing.'.format(args.baseline),
+              file=sys.stderr)
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare(report, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: et ts=4
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements caching of rendered responses.
+
+Example Usage:
+
+    HOME_CACHE = ResponseCache(max_bytes=16 * 1024 * 1024, ttl=300)
+
+    class Root(StaplerRoot):
+        @default
+        @cached(HOME_CACHE, vary=['page'])
+        @template(env, 'home.html')
+        def home(self, page='1'):
+            ...
+
+    # Later, to decide how big the cache should be:
+    LOGGER.info('Home page cache: %s', HOME_CACHE.stats())
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+from werkzeug.wrappers import BaseResponse, Response
+
+from pystapler.dispatch import _decorate_impl
+
+
+# Rough per-entry overhead, in bytes, counted against max_bytes in addition
+# to the size of the body and headers.
+_ENTRY_OVERHEAD = 256
+
+_CACHEABLE_METHODS = frozenset(['GET', 'HEAD'])
+
+
+class _CacheEntry(object):
+    """A response stored in a ResponseCache."""
+    # A plain record, whose fields the cache reads and updates directly.
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+
+    def __init__(self, key, expires, status, headers, body, etag):
+        # pylint: disable=too-many-arguments
+        self.key = key
+        self.expires = expires
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        # Compressed forms of the body, by content coding.
+        self.variants = {}
+        self.size = _ENTRY_OVERHEAD + len(body) + sum(
+            len(name) + len(value) for name, value in headers)
+
+
+class _CachedResponse(Response):
+    """A response built from a cache entry.
+
+    The compression stage (see pystapler.compress) asks it for compressed
+    forms of its body through compressed_body(), and they are kept in the
+    cache entry, so that each is only computed once.
+    """
+
+    def __init__(self, response_cache, entry):
+        Response.__init__(self, entry.body, entry.status, entry.headers)
+        self.__cache = response_cache
+        self.__entry = entry
+
+    def compressed_body(self, encoding, compress):
+        """Returns the body compressed with a content coding.
+
+        Parameters:
+            encoding:
+                The content coding, such as "gzip".
+            compress:
+                A function that compresses the body with that coding, which
+                is called if the cache entry does not have it yet.
+        """
+        return self.__cache.compressed_body(self.__entry, encoding, compress)
+
+
+class ResponseCache(object):
+    """A bounded, thread-safe cache of rendered responses.
+
+    Entries are evicted when they are older than ttl seconds, and otherwise
+    in least-recently-used order whenever the cache would exceed max_entries
+    entries or max_bytes bytes.
+
+    Only successful (200) responses to GET and HEAD requests are cached. Every
+    response served through the cache carries an ETag and a Cache-Control
+    header, and a request whose If-None-Match header matches the ETag gets a
+    304 Not Modified response.
+
+    stats() returns counts of the hits, misses, evictions and expirations
+    since the cache was created, together with its current size.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl=60,
+                 cache_control='no-cache'):
+        """Creates a response cache.
+
+        Parameters:
+            max_entries:
+                The maximum number of responses to keep.
+            max_bytes:
+                The maximum total size of the responses to keep. Responses
+                bigger than this are never cached.
+            ttl:
+                The number of seconds for which a response is reused.
+            cache_control:
+                The value of the Cache-Control header sent with cached
+                responses. The default asks clients to revalidate their
+                copy, which the cache can answer with a cheap 304.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cache_control = cache_control
+        # The counts, and the total size of the entries, as bytes.
+        self.__stats = dict.fromkeys(
+            ('hits', 'misses', 'evictions', 'expirations', 'bytes'), 0)
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def stats(self):
+        """Returns a dictionary of counters describing the cache."""
+        with self.__lock:
+            return dict(self.__stats, entries=len(self.__entries))
+
+    def clear(self):
+        """Removes every response from the cache."""
+        with self.__lock:
+            self.__entries.clear()
+            self.__stats['bytes'] = 0
+
+    def lookup(self, key, request):
+        """Returns the cached response for key, or None on a miss."""
+        now = time.time()
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None and entry.expires <= now:
+                self.__stats['bytes'] -= entry.size
+                self.__stats['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.__stats['misses'] += 1
+                return None
+            # Re-insert the entry to mark it as the most recently used.
+            self.__entries[key] = entry
+            self.__stats['hits'] += 1
+        return self.respond(entry, request)
+
+    def store(self, key, request, response):
+        """Stores a response in the cache, if it can be cached.
+
+        Returns:
+            The response that should be sent for this request, which is
+            equivalent to the response passed in.
+        """
+        if (not isinstance(response, BaseResponse)
+                or response.status_code != 200):
+            return response
+        body = response.get_data()
+        headers = [
+            (name, value) for name, value in response.headers
+            if name.lower() not in ('content-length', 'etag', 'cache-control')]
+        etag = hashlib.sha1(body).hexdigest()
+        entry = _CacheEntry(
+            key, time.time() + self.ttl, response.status, headers, body, etag)
+        if entry.size <= self.max_bytes:
+            with self.__lock:
+                previous = self.__entries.pop(key, None)
+                if previous is not None:
+                    self.__stats['bytes'] -= previous.size
+                self.__entries[key] = entry
+                self.__stats['bytes'] += entry.size
+                self.__evict()
+        return self.respond(entry, request)
+
+    def compressed_body(self, entry, encoding, compress):
+        """Returns the body of a cache entry compressed with a content coding.
+
+        The compressed body is computed with compress(body) the first time
+        it is asked for, and then kept in the entry, counting towards the
+        size of the cache, for as long as the entry is.
+        """
+        variant = entry.variants.get(encoding)
+        if variant is not None:
+            return variant
+        variant = compress(entry.body)
+        with self.__lock:
+            if encoding in entry.variants:
+                return entry.variants[encoding]
+            entry.variants[encoding] = variant
+            if self.__entries.get(entry.key) is entry:
+                entry.size += len(variant)
+                self.__stats['bytes'] += len(variant)
+                self.__evict()
+        return variant
+
+    def __evict(self):
+        """Evicts entries until the cache is within its bounds.
+
+        The caller must hold the lock.
+        """
+        while (self.__stats['bytes'] > self.max_bytes
+               or len(self.__entries) > self.max_entries):
+            _, evicted = self.__entries.popitem(last=False)
+            self.__stats['bytes'] -= evicted.size
+            self.__stats['evictions'] += 1
+
+    def respond(self, entry, request):
+        """Returns a response for a request, built from a cache entry."""
+        # If-None-Match uses the weak comparison (RFC 7232, section 3.2),
+        # so that a client holding a compressed copy, which carries the
+        # weak form of the ETag, gets a 304 too.
+        if request.if_none_match.contains_weak(entry.etag):
+            response = Response(status=304)
+        else:
+            response = _CachedResponse(self, entry)
+        response.set_etag(entry.etag)
+        response.headers['Cache-Control'] = self.cache_control
+        return response
+
+
+class _CachePolicy(object):
+    """Binds a ResponseCache to the request parameters a method varies on.
+
+    This is the object that the @cached decorator attaches to a method; the
+    dispatcher calls lookup() before invoking the method and store() after.
+    """
+
+    def __init__(self, response_cache, vary):
+        self.__cache = response_cache
+        self.__vary = tuple(vary)
+
+    def __key(self, request_params):
+        """Returns the cache key for a request."""
+        return (request_params.request.path,) + tuple(
+            request_params.get(name) for name in self.__vary)
+
+    def lookup(self, request_params):
+        """Returns the cached response for a request, or None."""
+        request = request_params.request
+        if request.method not in _CACHEABLE_METHODS:
+            return None
+        return self.__cache.lookup(self.__key(request_params), request)
+
+    def store(self, request_params, result):
+        """Caches the result of a method, and returns what to respond with."""
+        request = request_params.request
+        if request.method not in _CACHEABLE_METHODS:
+            return result
+        return self.__cache.store(self.__key(request_params), request, result)
+
+
+def cached(response_cache=None, vary=(), **kwargs):
+    """Marks a method whose response can be cached.
+
+    The decorated method should return a Werkzeug response, so it is usually
+    a @default method that is also decorated with @template or @plaintext.
+    Responses are cached by request path, plus the values of the request
+    parameters named in vary.
+
+    Parameters:
+        response_cache:
+            The ResponseCache to store responses in. If not given, a new
+            cache is created using the remaining keyword arguments, which are
+            passed to the ResponseCache constructor.
+        vary:
+            The names of the request parameters that the response depends on.
+
+    Example Usage:
+
+        @default
+        @cached(ttl=300, vary=['page'])
+        @template(env, 'catalog.html')
+        def catalog(self, page='1'):
+            ...
+    """
+    if callable(response_cache):
+        # Used as a bare @cached decorator.
+        return cached()(response_cache)
+    if response_cache is None:
+        response_cache = ResponseCache(**kwargs)
+    elif kwargs:
+        raise TypeError('Cannot configure an existing ResponseCache')
+    policy = _CachePolicy(response_cache, vary)
+
+    def decorator_closure(method):
+        """Decorator closure that attaches the cache to the method."""
+        return _decorate_impl(method, response_cache=policy)
+    return decorator_closure
+
+
+# vim: et ts=4
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements coalescing of identical concurrent requests.
+
+Example Usage:
+
+    class Catalog(object):
+        @default
+        @coalesce(vary=['page'], timeout=10)
+        @template(env, 'catalog.html')
+        def render(self, page='1'):
+            ...
+
+If many clients request the same catalog page at once, the page is rendered
+only once, and every client gets a copy of the same response.
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+import threading
+
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.wrappers import BaseResponse, Response
+
+from pystapler.dispatch import _decorate_impl
+
+
+_COALESCED_METHODS = frozenset(['GET', 'HEAD'])
+
+
+class _SharedResponse(object):
+    """A response that was rendered once, to be copied for every waiter."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, response):
+        self.status = response.status
+        self.headers = list(response.headers)
+        self.body = response.get_data()
+
+    def copy(self):
+        """Returns a new response with the same status, headers and body."""
+        return Response(self.body, self.status, self.headers)
+
+
+class _Flight(object):
+    """A computation in progress, which any number of requests wait for."""
+
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__lock = threading.Lock()
+        self.__callbacks = []
+        self.__result = None
+        self.__error = None
+
+    def land(self, result=None, error=None):
+        """Records the outcome of the computation, and wakes every waiter."""
+        if isinstance(result, BaseResponse):
+            result = _SharedResponse(result)
+        self.__result = result
+        self.__error = error
+        with self.__lock:
+            self.__done.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def wait(self, timeout):
+        """Waits for the computation; returns False if it timed out."""
+        return self.__done.wait(timeout)
+
+    def add_done_callback(self, callback):
+        """Arranges for callback() to be called once the flight has landed.
+
+        The callback is called on the thread that computed the result, or
+        immediately if the flight has already landed.
+        """
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(callback)
+                return
+        callback()
+
+    def outcome(self):
+        """Returns the result of the computation, or raises its error.
+
+        A response is copied, so that every waiter gets its own.
+        """
+        if self.__error is not None:
+            raise self.__error
+        if isinstance(self.__result, _SharedResponse):
+            return self.__result.copy()
+        return self.__result
+
+
+class _CoalescePolicy(object):
+    """Tracks the computations in progress for one coalesced method.
+
+    This is the object that the @coalesce decorator attaches to a method.
+    The dispatcher calls join() before calling the method; the first
+    request for a key becomes the leader of a flight, calls the method and
+    reports the outcome with land(), while the others wait for it.
+    """
+
+    def __init__(self, vary, timeout):
+        self.vary = tuple(vary)
+        self.timeout = timeout
+        self.__flights = {}
+        self.__lock = threading.Lock()
+
+    def join(self, request_params):
+        """Joins the flight for a request, starting one if needed.
+
+        Returns:
+            A (key, flight, leader) tuple, where leader is True if the caller
+            must compute the result and land the flight; or None, if the
+            request cannot be coalesced.
+        """
+        if request_params.request.method not in _COALESCED_METHODS:
+            return None
+        key = (request_params.request.path,) + tuple(
+            request_params.get(name) for name in self.vary)
+        with self.__lock:
+            flight = self.__flights.get(key)
+            if flight is not None:
+                return key, flight, False
+            flight = self.__flights[key] = _Flight()
+        return key, flight, True
+
+    def land(self, key, flight, result=None, error=None):
+        """Records the outcome of the flight a leader computed.
+
+        Requests that arrive after this start a new flight.
+        """
+        with self.__lock:
+            del self.__flights[key]
+        flight.land(result, error)
+
+    def timed_out(self):
+        """Returns the error raised by a request that waited too long."""
+        return ServiceUnavailable(
+            'Timed out waiting for an identical request to complete')
+
+    def run(self, request_params, compute):
+        """Returns compute(), sharing the result with identical requests."""
+        joined = self.join(request_params)
+        if joined is None:
+            return compute()
+        key, flight, leader = joined
+        if leader:
+            try:
+                result = compute()
+            except BaseException as ex:
+                # Even on KeyboardInterrupt, the waiters must not be left
+                # waiting for a flight that will never land.
+                self.land(key, flight, error=ex)
+                raise
+            self.land(key, flight, result)
+        elif not flight.wait(self.timeout):
+            raise self.timed_out()
+        return flight.outcome()
+
+
+def coalesce(obj=None, vary=(), timeout=30):
+    """Makes identical concurrent requests share one call to a method.
+
+    While a GET or HEAD request is calling the decorated method, other
+    requests for the same path (and the same values of the request
+    parameters named in vary) wait for it to finish, instead of calling the
+    method too. They then all respond with copies of the same response, or
+    fail with the same exception. This is meant for expensive @default
+    methods of popular pages, so that when they are requested by many
+    clients at once, they are only rendered once.
+
+    The response body is read into memory to be shared, so streamed
+    responses lose their streaming. If the decorated method returns an
+    object rather than a response, every request gets the same object.
+
+    Parameters:
+        vary:
+            The names of the request parameters that the response depends
+            on. Requests whose values differ are not coalesced.
+        timeout:
+            The number of seconds a request waits for an identical request
+            to finish, after which it fails with 503 Service Unavailable.
+            None waits indefinitely.
+
+    Example Usage:
+
+        @default
+        @coalesce(vary=['page'], timeout=5)
+        @template(env, 'catalog.html')
+        def catalog(self, page='1'):
+            ...
+    """
+    if callable(obj):
+        # Used as a bare @coalesce decorator.
+        return coalesce()(obj)
+    policy = _CoalescePolicy(vary, timeout)
+
+    def decorator_closure(method):
+        """Decorator closure that attaches the policy to the method."""
+        return _decorate_impl(method, coalesce=policy)
+    return decorator_closure
+
+
+# vim: et ts=4
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements compression of response bodies.
+
+A StaplerRoot compresses the response to every request through the
+Compressor in its configuration (StaplerConfig.compression), after the
+request has been dispatched. The content coding is negotiated from the
+request's Accept-Encoding header: brotli ("br") is preferred if the brotli
+package is installed, then gzip, then deflate.
+
+Responses are left alone if they are not successful, are smaller than a
+threshold, already have a Content-Encoding (such as pre-compressed static
+files), have a type that does not compress well (such as images), or carry
+Cache-Control: no-transform. Bodies that are in memory are compressed in one
+go; streamed bodies, such as those of @template(stream=True), are compressed
+chunk by chunk as they are sent, and each chunk is flushed to the client
+without waiting for the rest.
+
+A response may keep compressed forms of its body for reuse by providing a
+compressed_body(encoding, compress) method, which returns the body encoded
+with the given content coding, calling compress(body) only if it does not
+have one yet. Responses served from a pystapler.cache.ResponseCache do this,
+so a cached response is compressed once per content coding, not on every hit.
+
+Example Usage:
+
+    class Config(StaplerConfig):
+        compression = Compressor(min_size=512)
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+import zlib
+
+from werkzeug.wrappers import BaseResponse
+
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional; without it, only gzip and deflate are offered.
+    brotli = None
+
+
+# Types of content that are worth compressing, besides text/* and types
+# with a +json or +xml suffix.
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/x-javascript',
+    'application/x-ndjson',
+    'image/svg+xml',
+    'image/x-icon',
+])
+
+# Status codes of responses whose bodies are never compressed.
+_UNCOMPRESSED_STATUSES = frozenset([204, 206, 304])
+
+# The zlib window bits that select the container format of each content
+# coding: gzip has a gzip header, and HTTP "deflate" means the zlib format.
+_ZLIB_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def _zlib_compressobj(level, encoding):
+    """Returns a zlib compressor for the gzip or deflate content coding."""
+    return zlib.compressobj(level, zlib.DEFLATED, _ZLIB_WBITS[encoding])
+
+
+class _ZlibStream(object):
+    """Incrementally compresses a body with zlib."""
+
+    def __init__(self, level, encoding):
+        self.__compressor = _zlib_compressobj(level, encoding)
+
+    def compress(self, chunk):
+        """Compresses a chunk, and flushes everything compressed so far."""
+        return (self.__compressor.compress(chunk)
+                + self.__compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        """Returns the end of the compressed body."""
+        return self.__compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliStream(object):
+    """Incrementally compresses a body with brotli."""
+
+    def __init__(self, quality):
+        self.__compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, chunk):
+        """Compresses a chunk, and flushes everything compressed so far."""
+        return self.__compressor.process(chunk) + self.__compressor.flush()
+
+    def finish(self):
+        """Returns the end of the compressed body."""
+        return self.__compressor.finish()
+
+
+class Compressor(object):
+    """Compresses response bodies for clients that accept it.
+
+    The compressed, skipped and streamed attributes count the responses that
+    were compressed in one go, that could have been compressed but were not
+    because of their size, and that were compressed while streaming.
+    """
+    # The settings and counts are public, for tests and monitoring to read.
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, min_size=1024, level=6, brotli_quality=4,
+                 encodings=None, compressible_types=COMPRESSIBLE_TYPES):
+        """Creates a compressor.
+
+        Parameters:
+            min_size:
+                Bodies smaller than this many bytes are sent uncompressed.
+                Streamed bodies are compressed regardless of size, unless
+                they declare a smaller Content-Length.
+            level:
+                The zlib compression level for gzip and deflate, from 1
+                (fastest) to 9 (smallest).
+            brotli_quality:
+                The brotli quality, from 0 (fastest) to 11 (smallest).
+            encodings:
+                The content codings to offer, in order of preference. By
+                default, this is br (if brotli is installed), gzip and
+                deflate.
+            compressible_types:
+                The MIME types to compress, besides text/* and types with a
+                +json or +xml suffix.
+        """
+        if encodings is None:
+            encodings = ('br', 'gzip', 'deflate') if brotli else (
+                'gzip', 'deflate')
+        elif 'br' in encodings and brotli is None:
+            raise ValueError('The brotli package is not installed')
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.encodings = tuple(encodings)
+        self.compressible_types = frozenset(compressible_types)
+        self.compressed = 0
+        self.skipped = 0
+        self.streamed = 0
+
+    def is_compressible(self, mimetype):
+        """Returns whether bodies of the given MIME type are compressed."""
+        if not mimetype:
+            return False
+        return (mimetype.startswith('text/')
+                or mimetype in self.compressible_types
+                or mimetype.endswith(('+json', '+xml')))
+
+    def negotiate(self, request):
+        """Returns the content coding to send a request, or None."""
+        accept_encodings = request.accept_encodings
+        best = None
+        best_quality = 0
+        for encoding in self.encodings:
+            quality = accept_encodings.quality(encoding)
+            if quality > best_quality:
+                best = encoding
+                best_quality = quality
+        return best
+
+    def compress_body(self, encoding, body):
+        """Returns a body of bytes compressed with a content coding."""
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        compressor = _zlib_compressobj(self.level, encoding)
+        return compressor.compress(body) + compressor.flush()
+
+    def __stream(self, encoding, chunks):
+        """Yields the compressed form of an iterable of bytes."""
+        if encoding == 'br':
+            stream = _BrotliStream(self.brotli_quality)
+        else:
+            stream = _ZlibStream(self.level, encoding)
+        for chunk in chunks:
+            if chunk:
+                yield stream.compress(chunk)
+        yield stream.finish()
+
+    def compress(self, request, response):
+        """Compresses a response to a request, if it should be compressed.
+
+        Parameters:
+            request:
+                The Werkzeug request being responded to.
+            response:
+                The response returned by dispatching the request. Anything
+                other than a Werkzeug response is returned unchanged.
+
+        Returns:
+            The response to send, which is the response passed in, with its
+            body and headers modified if it was compressed.
+        """
+        # pylint: disable=too-many-return-statements
+        if (not isinstance(response, BaseResponse)
+                or response.status_code < 200
+                or response.status_code in _UNCOMPRESSED_STATUSES
+                or 'Content-Encoding' in response.headers
+                or 'no-transform' in response.cache_control
+                or not self.is_compressible(response.mimetype)):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate(request)
+        if encoding is None:
+            return response
+        content_length = response.content_length
+        if content_length is not None and content_length < self.min_size:
+            self.skipped += 1
+            return response
+
+        if response.is_sequence:
+            body = response.get_data()
+            if len(body) < self.min_size:
+                self.skipped += 1
+                return response
+            compressed_body = getattr(response, 'compressed_body', None)
+            if compressed_body is not None:
+                compressed = compressed_body(
+                    encoding,
+                    lambda body: self.compress_body(encoding, body))
+            else:
+                compressed = self.compress_body(encoding, body)
+            if len(compressed) >= len(body):
+                return response
+            response.set_data(compressed)
+            self.compressed += 1
+        else:
+            close = getattr(response.response, 'close', None)
+            if close is not None:
+                # The body is replaced below, but must still be closed.
+                response.call_on_close(close)
+            response.response = self.__stream(
+                encoding, response.iter_encoded())
+            response.direct_passthrough = True
+            response.headers.pop('Content-Length', None)
+            self.streamed += 1
+        response.headers['Content-Encoding'] = encoding
+        # Ranges of the uncompressed body do not apply to the compressed one.
+        response.headers.pop('Accept-Ranges', None)
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            # The compressed body is a different sequence of bytes, so it
+            # can only be described by a weak entity tag.
+            response.set_etag(etag, weak=True)
+        return response
+
+
+# vim: et ts=4
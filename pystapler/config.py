@@ -11,6 +11,8 @@ See the LICENSE file for licensing details.
 
 import logging
 
+from pystapler.memo import MISSING
+
 
 LOGGER = logging.getLogger(__name__)
 
@@ -23,8 +25,76 @@ class StaplerConfig(object):
     """
     # pylint: disable=too-few-public-methods
     # TODO(dpryden): Implement config mechanism
+    host = '0.0.0.0'
     port = 8080
     debug = True
+    # In debug mode, whether changed modules are reloaded in place (see
+    # pystapler.reload), rather than by restarting the whole server.
+    hot_reload = True
+    # Whether StaplerRoot caches flattened traversal chains per request path.
+    route_plans = True
+    # Maximum number of threads the ASGI application uses to call methods
+    # that are not coroutines. None uses the concurrent.futures default.
+    asgi_threads = None
+    # A pystapler.metrics.Metrics object that every request is timed into,
+    # or None to not collect metrics.
+    metrics = None
+    # The maximum size of a request body, in bytes; larger bodies are
+    # rejected with 413 before they are read. None for no limit.
+    max_body_size = None
+    # The maximum size of the non-file fields of a form, in bytes; larger
+    # forms are rejected with 413. None for no limit, as in Werkzeug.
+    max_form_memory_size = None
+    # Request bodies bigger than this many bytes are spooled to a temporary
+    # file in spool_directory (None for the system default) rather than
+    # kept in memory.
+    spool_memory_size = 512 * 1024
+    spool_directory = None
+    # Admission control (see pystapler.admission): a dictionary mapping the
+    # names that methods are traversable as to the Limiter of those methods,
+    # for methods that are not decorated with @limit, or None. Each method's
+    # Limiter is looked up once per config, so set this before serving.
+    route_limits = None
+    # A pystapler.compress.Compressor that compresses responses for clients
+    # that accept it, or None to send responses uncompressed.
+    compression = None
+
+    # Production server settings (see pystapler.server). When workers is zero,
+    # or debug is set, main() uses Werkzeug's development server instead.
+    workers = 0
+    threads = 8
+    backlog = 128
+    # Number of requests after which a worker is replaced; zero for never.
+    max_requests = 0
+    # Seconds to wait for workers to finish their requests on shutdown.
+    graceful_timeout = 30
+    # Whether to set SO_REUSEPORT on the listening socket, where available.
+    reuse_port = True
+    # pystapler.tasks.TaskQueue objects whose tasks in flight are finished,
+    # for up to graceful_timeout seconds, before the server exits.
+    task_queues = ()
+
+    __access_log = MISSING
+    __default_access_log = None
+
+    @property
+    def access_log(self):
+        """The AccessLog that requests are logged to, or None to not log them.
+
+        Unless it is set, this is an AccessLog with the default settings,
+        which is created on first use and shared by every configuration.
+        """
+        access_log = self.__access_log
+        if access_log is MISSING:
+            access_log = StaplerConfig.__default_access_log
+            if access_log is None:
+                from pystapler.accesslog import AccessLog
+                access_log = StaplerConfig.__default_access_log = AccessLog()
+        return access_log
+
+    @access_log.setter
+    def access_log(self, access_log):
+        self.__access_log = access_log
 
 
 # vim: et ts=4
@@ -10,35 +10,76 @@ See the LICENSE file for licensing details.
 """
 from __future__ import absolute_import
 
+from datetime import datetime
+import gc
 import inspect
 import logging
+import numbers
+import weakref
 
-from six import iteritems
+try:
+    from inspect import Parameter, signature
+except ImportError:
+    # Python 2 does not have inspect.signature; use the funcsigs backport.
+    from funcsigs import Parameter, signature
+
+from six import iteritems, string_types
 
 from werkzeug.exceptions import HTTPException, BadRequest, NotFound
+from werkzeug.http import http_date, is_resource_modified, quote_etag
 from werkzeug.serving import run_simple
 from werkzeug.test import Client
 from werkzeug.utils import cached_property
-from werkzeug.wrappers import BaseResponse, Request
-from werkzeug.wsgi import responder
+from werkzeug.wsgi import ClosingIterator
+from werkzeug.wrappers import BaseResponse, Request, Response
 
-from pystapler.request import RequestParams
+from pystapler.accesslog import _timer
+from pystapler.memo import MISSING, Memo
+from pystapler.request import _INJECTABLES, RequestParams, check_body_size
+from pystapler.response import PASSTHROUGH_TYPES, _passthrough_response
 
 
 PREFIX = '_pystapler_'
 DEFAULT = object()
+DYNAMIC = object()
+ETAG = object()
+LAST_MODIFIED = object()
 NOT_FOUND = object()
 NOT_TRAVERSABLE = object()
 
+# Upper bound on the number of route plans cached per StaplerRoot subclass.
+# Once this many distinct paths have been planned, further paths are simply
+# dispatched recursively without being recorded.
+MAX_ROUTE_PLANS = 4096
+
+# How conflicting members are described, for the special traversal map keys.
+_SPECIAL_KEY_DESCRIPTIONS = {
+    DEFAULT: 'the @default method',
+    DYNAMIC: 'the @traversable_dynamic method',
+    ETAG: 'the @etag method',
+    LAST_MODIFIED: 'the @last_modified method',
+}
+
+_CONDITIONAL_METHODS = frozenset(['GET', 'HEAD'])
+
+_POSITIONAL_KINDS = (
+    Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD)
+
+# Python 2 has no coroutine functions.
+_iscoroutinefunction = getattr(
+    inspect, 'iscoroutinefunction', lambda function: False)
+
 LOGGER = logging.getLogger(__name__)
 
 
 class StaplerRoot(object):
     """Base class for the root object of a Pystapler application.
 
-    An instance of this class is a valid WSGI application.
+    An instance of this class is a valid WSGI application. On Python 3, its
+    asgi property is a corresponding ASGI application.
     """
     __config = None
+    __asgi = None
 
     @property
     def config(self):
@@ -53,20 +94,179 @@ class StaplerRoot(object):
             self.__config = StaplerConfig()
         return self.__config
 
-    @responder
+    @property
+    def asgi(self):
+        """An ASGI application that serves this object.
+
+        In the ASGI application, methods defined with "async def" are awaited
+        on the event loop, and all other methods are called on a thread pool.
+        See the pystapler.asgi module for details. Requires Python 3.
+        """
+        if self.__asgi is None:
+            from pystapler.asgi import AsgiApplication
+            self.__asgi = AsgiApplication(self)
+        return self.__asgi
+
     def __call__(self, environ, start_response):
         """Implements the WSGI application protocol."""
-        request = Request(environ)
-        LOGGER.info('%s %s', request.method, request.path)
-        path_segments = request.path.lstrip('/').split('/')
+        access_log = self.config.access_log
+        if access_log is not None and access_log.sample():
+            return access_log.log_request(
+                self.__respond, environ, start_response)
+        return self.__respond(environ, start_response)
 
-        request_params = RequestParams(request)
+    def __respond(self, environ, start_response):
+        """Dispatches a request and calls the resulting WSGI application."""
+        return self.serve(Request(environ), start_response)
 
-        object_info = _ObjectInfo(self)
+    def serve(self, request, start_response):
+        """Dispatches a Werkzeug request and calls the resulting application.
+
+        This is what serving a WSGI request does once the request object is
+        built, apart from access logging. It is public so that requests of
+        other classes, such as the sub-requests of pystapler.batch, can be
+        served exactly like requests from a client.
+
+        Returns:
+            The WSGI application iterable of the response.
+        """
+        config = self.config
+        if config.metrics is not None:
+            return self.__serve_with_metrics(
+                config.metrics, request, start_response)
+        path_segments = request.path.lstrip('/').split('/')
+        request_params = RequestParams(request, config)
+        response = self.__dispatch(path_segments, request_params)
+        return _close_spool(
+            response(request.environ, start_response), request_params)
+
+    def __serve_with_metrics(self, metrics, request, start_response):
+        """Serves a request, timing each phase."""
+        started = _timer()
+        path_segments = request.path.lstrip('/').split('/')
+        request_params = RequestParams(request, self.config)
+        parsed = _timer()
+        trace = []
+        response = self.__dispatch(path_segments, request_params, trace)
+        dispatched = _timer()
+        recorder = _StatusRecorder(start_response)
+        app_iter = response(request.environ, recorder)
+        finished = _timer()
+        metrics.record(
+            trace, params_time=parsed - started,
+            serialize_time=finished - dispatched,
+            total_time=finished - started, status=recorder.status(response))
+        return _close_spool(app_iter, request_params)
+
+    def __dispatch(self, path_segments, request_params, trace=None):
+        """Dispatches a request, returning the WSGI application to call.
+
+        A request whose body is declared to be bigger than the configured
+        maximum is rejected here, before anything reads it. If compression
+        is configured, the response is compressed here.
+        """
+        config = request_params.config
         try:
-            return object_info.dispatch(path_segments, request_params)
+            check_body_size(request_params.request, config.max_body_size)
+            if config.route_plans:
+                response = _dispatch_with_plans(
+                    self, path_segments, request_params, trace)
+            else:
+                response = _ObjectInfo(self).dispatch(
+                    path_segments, request_params, trace)
         except HTTPException as ex:
             return ex
+        compression = config.compression
+        if compression is not None:
+            response = compression.compress(request_params.request, response)
+        return response
+
+    def build_route_plans(self, max_depth=8):
+        """Builds route plans ahead of time for all type-stable paths.
+
+        Every path that can be reached from this object by following
+        methods declared with @traversable(returns=...) gets a route plan,
+        so that the first request to such a path does not have to record
+        one. Paths are followed at most max_depth segments deep.
+
+        Returns:
+            The number of route plans that were built.
+        """
+        cls = type(self)
+        plans = _get_route_plans(cls)
+        count = 0
+        for path_segments in _type_stable_paths(cls, max_depth):
+            key = tuple(path_segments)
+            if key in plans or len(plans) >= MAX_ROUTE_PLANS:
+                continue
+            plan = _build_static_plan(cls, path_segments)
+            if plan is not None:
+                plans[key] = plan
+                count += 1
+        return count
+
+    def compile(self, max_depth=8):
+        """Prepares everything needed to dispatch requests ahead of time.
+
+        This builds the traversal map of every type that requests can reach,
+        the binder of every traversable method, and (if route plans are
+        enabled) the route plans of every type-stable path, so that the
+        first requests are not slowed down by building them. main() calls
+        this before forking worker processes, so that the workers share
+        the results instead of each building their own.
+
+        Types are found by starting from this object's type and following
+        the declared return type (@traversable(returns=...)) or return
+        annotation of every traversable method. Types that cannot be found
+        this way can be listed in the reachable_types class attribute.
+
+        Conflicting routes, such as two methods of a class that are
+        traversable under the same name, and routes that can never be
+        reached are logged as warnings and listed in the returned report.
+
+        Returns:
+            A CompileReport describing what was compiled.
+        """
+        report = CompileReport()
+        registered = list(getattr(type(self), 'reachable_types', ()))
+        pending = [type(self)] + registered
+        reached = set([type(self)])
+        while pending:
+            cls = pending.pop(0)
+            if cls in report.types:
+                continue
+            report.types.append(cls)
+            # Scan the type even if its map was already built, to find
+            # conflicts, but keep the existing map if there is one.
+            traversal_map = _build_traversal_map(cls, report.conflicts)
+            traversal_map = cls.__dict__.get(
+                PREFIX + 'traversal_map', traversal_map)
+            setattr(cls, PREFIX + 'traversal_map', traversal_map)
+            for key, member in iteritems(traversal_map):
+                if not isinstance(member, _MethodInfo):
+                    continue
+                if isinstance(key, string_types) and '/' in key:
+                    report.unreachable.append(
+                        '{}: "{}" contains a slash, so it can never match '
+                        'a path segment'.format(cls.__name__, key))
+                _prepare_method_info(member)
+                member.limiter(self.config)
+                report.methods += 1
+                result_type = member.result_type
+                if result_type is None or _renders(result_type):
+                    continue
+                reached.add(result_type)
+                pending.append(result_type)
+        for cls in registered:
+            if cls not in reached:
+                report.unreachable.append(
+                    '{} is listed in reachable_types, but no traversable '
+                    'method is known to return it'.format(cls.__name__))
+        for description in report.unreachable:
+            LOGGER.warning('Unreachable route: %s', description)
+        if self.config.route_plans:
+            report.route_plans = self.build_route_plans(max_depth)
+        return report
 
     def test_client(self, response_wrapper=BaseResponse):
         """Returns a Werkzeug test client for this application.
@@ -77,54 +277,225 @@ class StaplerRoot(object):
         return Client(self, response_wrapper=response_wrapper)
 
 
-def _build_traversal_map(cls):
+class CompileReport(object):
+    """The result of StaplerRoot.compile().
+
+    Attributes:
+        types:
+            The types whose traversal maps were built, in the order they
+            were found.
+        methods:
+            The number of traversable methods that were prepared.
+        route_plans:
+            The number of route plans that were built.
+        conflicts:
+            Descriptions of members of the same class that claim the same
+            path, only one of which is reachable.
+        unreachable:
+            Descriptions of routes that can never be reached.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.types = []
+        self.methods = 0
+        self.route_plans = 0
+        self.conflicts = []
+        self.unreachable = []
+
+
+class Mountable(object):
+    """Base class for objects that dispatch the rest of a path themselves.
+
+    An instance of a Mountable subclass that is assigned to a class attribute
+    is traversable under the name of that attribute. Rather than being
+    traversed into like an object returned by a method, it receives all the
+    remaining path segments at once. For example, static_root() returns a
+    Mountable that maps the remaining path to a file.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def dispatch(self, path_segments, request_params):
+        """Dispatches a request to this object.
+
+        Parameters:
+            path_segments:
+                The list of path segments following the one this object is
+                mounted as.
+            request_params:
+                A dictionary of parameters derived from the current request.
+
+        Returns:
+            A Werkzeug response object or other WSGI application object, which
+            will be used to create the HTTP response.
+        """
+        raise NotImplementedError()
+
+
+def _close_spool(app_iter, request_params):
+    """Returns app_iter, made to close the request's spooled body if any.
+
+    The body stays open until the response has been sent, since a method
+    may return a generator that reads it. Requests that did not spool their
+    body, which are most of them, get their response iterable back as is.
+    """
+    if not request_params.spooled:
+        return app_iter
+    return ClosingIterator(app_iter, request_params.close)
+
+
+class _StatusRecorder(object):
+    """A WSGI start_response callable that records the response status."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, start_response):
+        self.__start_response = start_response
+        self.__status_line = None
+
+    def __call__(self, status, headers, exc_info=None):
+        self.__status_line = status
+        return self.__start_response(status, headers, exc_info)
+
+    def status(self, response):
+        """Returns the status code of a response started through this.
+
+        A response that starts lazily, when its body is iterated over, has
+        not called start_response yet; its status code is then taken from
+        the response object, or is None if it has none.
+        """
+        if self.__status_line is not None:
+            return self.__status_line.split(None, 1)[0]
+        return getattr(response, 'status_code', None) or getattr(
+            response, 'code', None)
+
+
+def _classify_member(member_name, member):
+    """Returns the traversal map key and value of a class member.
+
+    The key is the name the member is traversable as, or one of the special
+    keys DEFAULT, DYNAMIC, ETAG and LAST_MODIFIED. The value is a _MountInfo
+    or _MethodInfo. Both are None if the member is not traversable.
+    """
+    if isinstance(member, Mountable):
+        return member_name, _MountInfo(member_name, member)
+    if not callable(member) or (
+            getattr(member, PREFIX + 'traversable_as', None) is None
+            and not getattr(member, PREFIX + 'default', None)
+            and not getattr(member, PREFIX + 'dynamic', None)
+            and not getattr(member, PREFIX + 'validator', None)):
+        return None, None
+    value = _MethodInfo(member)
+    key = value.traversable_as
+    if key is None:
+        if value.default:
+            key = DEFAULT
+        elif value.dynamic:
+            key = DYNAMIC
+        else:
+            key = value.validator
+    return key, value
+
+
+def _build_traversal_map(cls, conflicts=None):
     """Computes the traversal map for a given type.
 
     This is a dictionary mapping traversable members of the type to
-    _MethodInfo objects that contain metadata about those members.
+    _MethodInfo objects that contain metadata about those members (or, for
+    Mountable class attributes, _MountInfo objects).
+
+    Members inherited from base classes are included. A member defined in a
+    subclass replaces whatever its base classes defined under the same
+    attribute name, even if the base class member was traversable under a
+    different name.
+
+    Parameters:
+        cls:
+            The type to compute the traversal map of.
+        conflicts:
+            If not None, a list to which a description is appended for every
+            pair of members of the same class that claim the same path.
     """
-    LOGGER.debug('Scanning for traversable paths on %s', cls)
     result = {}
-    for member_name, member in iteritems(cls.__dict__):
-        if callable(member):
-            method_info = _MethodInfo(member)
-            traversable_as = method_info.traversable_as
-            if traversable_as is not None:
-                result[traversable_as] = method_info
-                LOGGER.debug(
-                    'Found traversable path "%s" on %s', traversable_as, cls)
+    keys_by_member_name = {}
+    for klass in reversed(cls.__mro__):
+        if klass is object:
+            continue
+        claimed = {}
+        # A snapshot, since other threads may cache their maps and route
+        # plans on the same classes meanwhile.
+        for member_name, member in list(iteritems(klass.__dict__)):
+            if member_name.startswith(PREFIX):
                 continue
-            if method_info.default:
-                result[DEFAULT] = method_info
-                LOGGER.debug(
-                    'Found default path "%s" on %s', member_name, cls)
+            previous_key = keys_by_member_name.pop(member_name, None)
+            if previous_key is not None:
+                result.pop(previous_key, None)
+            key, value = _classify_member(member_name, member)
+            if value is None:
+                if result.get(member_name, NOT_TRAVERSABLE) is (
+                        NOT_TRAVERSABLE):
+                    result[member_name] = NOT_TRAVERSABLE
                 continue
-        LOGGER.debug(
-            'Found non-traversable path "%s" on %s', member_name, cls)
-        result[member_name] = NOT_TRAVERSABLE
+            if key in claimed:
+                description = '{0}.{1} and {0}.{2} are both {3}'.format(
+                    klass.__name__, claimed[key], member_name,
+                    _SPECIAL_KEY_DESCRIPTIONS.get(key)
+                    or 'traversable as "{}"'.format(key))
+                LOGGER.warning('Conflicting routes: %s', description)
+                if conflicts is not None:
+                    conflicts.append(description)
+            claimed[key] = member_name
+            result[key] = value
+            keys_by_member_name[member_name] = key
+    default_method = result.get(DEFAULT)
+    if isinstance(default_method, _MethodInfo) and (
+            ETAG in result or LAST_MODIFIED in result):
+        default_method.set_validators(_Validators(
+            result.get(ETAG), result.get(LAST_MODIFIED)))
+    LOGGER.debug(
+        'Found %d traversable paths on %s',
+        sum(1 for member in result.values() if member is not NOT_TRAVERSABLE),
+        cls)
     return result
 
 
-def _get_traversal_map(obj):
-    """Returns the traversal map for an object.
+def _get_traversal_map(cls):
+    """Returns the traversal map for a type.
 
-    This map is built from the type of the object, and is cached on the
-    type object itself, to avoid recomputing it every time.
+    The map is cached on the type object itself, to avoid recomputing it
+    every time. It is looked up in the type's own __dict__, since a subclass
+    must not reuse the map of its base class.
     """
-    cls = type(obj)
     attribute_name = PREFIX + 'traversal_map'
-    traversal_map = getattr(cls, attribute_name, None)
+    traversal_map = cls.__dict__.get(attribute_name)
     if traversal_map is None:
         traversal_map = _build_traversal_map(cls)
         setattr(cls, attribute_name, traversal_map)
     return traversal_map
 
 
+def _invalidate_traversal_map(cls):
+    """Forgets the traversal maps of a type and all its subclasses.
+
+    This is used when the members of the type change, as they do when its
+    module is reloaded. The binders of its methods are forgotten with them,
+    since they are held by the traversal map, and so are the route plans of
+    the type, if it is a StaplerRoot. The maps are rebuilt when next needed.
+    """
+    pending = [cls]
+    while pending:
+        klass = pending.pop()
+        for attribute_name in (PREFIX + 'traversal_map',
+                               PREFIX + 'route_plans'):
+            if attribute_name in klass.__dict__:
+                delattr(klass, attribute_name)
+        pending.extend(klass.__subclasses__())
+
+
 class _ObjectInfo(object):
     """Wrapper around an object that is used for request dispatching."""
     def __init__(self, obj):
         self.__object = obj
-        self.__traversal_map = _get_traversal_map(obj)
+        self.__traversal_map = _get_traversal_map(type(obj))
 
     def lookup(self, member_name):
         """Looks up a member of the wrapped object by name.
@@ -147,7 +518,7 @@ class _ObjectInfo(object):
         """
         return self.__traversal_map.get(member_name, NOT_FOUND)
 
-    def dispatch(self, path_segments, request_params):
+    def dispatch(self, path_segments, request_params, trace=None):
         """Dispatches a request to this object.
 
         Parameters:
@@ -159,15 +530,58 @@ class _ObjectInfo(object):
             request_params:
                 A dictionary of parameters derived from the current request
                 which can be used to satisfy method arguments.
+            trace:
+                If not None, a list to which a (member, result, seconds)
+                tuple is appended for every member traversed, where seconds
+                is the time the member itself took. This is used to record
+                route plans and request metrics.
 
         Returns:
             A Werkzeug response object or other WSGI application object, which
             will be used to create the HTTP response.
         """
+        member, extra_path_segments = self.select(
+            path_segments, request_params)
+        if member is None:
+            return NotFound()
+        return member.traverse(
+            self.__object, extra_path_segments, request_params, trace)
+
+    def select(self, path_segments, request_params):
+        """Selects the member of the wrapped object that handles a path.
+
+        If no member is traversable as the first path segment, but the
+        object has a @traversable_dynamic method, that method is selected,
+        and the path segment is bound to its first parameter in
+        request_params. This includes segments that name members that are
+        not traversable, such as helper methods, which would otherwise be a
+        404; but not an empty segment, as in "/users/", which is a 404.
+
+        Parameters:
+            path_segments:
+                A list of remaining path segment(s) relative to this object.
+            request_params:
+                The RequestParams of the request.
+
+        Returns:
+            A (member, extra_path_segments) pair. The member is the object
+            from the traversal map that should handle the first path segment
+            (or the @default method, if there are no path segments), or None
+            if there is no such member, in which case the response should
+            be a 404. The extra_path_segments are the segments remaining
+            after the one the member handles.
+        """
         if path_segments:
             path_segment = path_segments[0]
             extra_path_segments = path_segments[1:]
             member = self.lookup(path_segment)
+            if path_segment and (
+                    member is NOT_FOUND or member is NOT_TRAVERSABLE):
+                dynamic = self.lookup(DYNAMIC)
+                if dynamic is not NOT_FOUND:
+                    member = dynamic
+                    request_params.bind_segment(
+                        member.segment_parameter, path_segment)
         else:
             path_segment = '<default>'
             extra_path_segments = []
@@ -175,47 +589,103 @@ class _ObjectInfo(object):
         if member is NOT_FOUND:
             LOGGER.debug(
                 'Path segment "%s" not found on %s', path_segment, self.__object)
-            return NotFound()
+            return None, extra_path_segments
         if member is NOT_TRAVERSABLE:
             LOGGER.warning(
                 'Attempted to traverse member "%s" of %s, but it is '
                 'not traversable.',
                 path_segment, self.__object)
-            return NotFound()
-        return member.traverse(
-            self.__object, extra_path_segments, request_params)
+            return None, extra_path_segments
+        return member, extra_path_segments
 
 
 class _MethodInfo(object):
     """Wrapper around a method object is used for request dispatching.
 
-    Any attribute that was added using a keyword argument passed to
-    _decorate_impl will be exposed as a member of this object.
+    Every attribute that was added using a keyword argument passed to
+    _decorate_impl is exposed as a member of this object, read once when the
+    object is created: traversable_as, default, dynamic, validator, returns,
+    response_cache, memoize, coalesce and admission. Each is None if the
+    method was not decorated with it.
     """
+    # One attribute per decorator, so that dispatching reads plain attributes.
+    # pylint: disable=too-many-instance-attributes
+
     def __init__(self, method):
         self.__method = method
-        self.__attributes = {}
+        self.traversable_as = getattr(method, PREFIX + 'traversable_as', None)
+        self.name = self.traversable_as
+        if self.name is None:
+            self.name = method.__name__
+        self.default = getattr(method, PREFIX + 'default', None)
+        self.dynamic = getattr(method, PREFIX + 'dynamic', None)
+        self.validator = getattr(method, PREFIX + 'validator', None)
+        self.returns = getattr(method, PREFIX + 'returns', None)
+        self.response_cache = getattr(method, PREFIX + 'response_cache', None)
+        self.memoize = getattr(method, PREFIX + 'memoize', None)
+        self.coalesce = getattr(method, PREFIX + 'coalesce', None)
+        self.admission = getattr(method, PREFIX + 'admission', None)
+        if self.admission is not None and self.admission.name is None:
+            self.admission.name = self.name
+        # The _Validators of a @default method, set by _build_traversal_map.
+        self.validators = None
+        # The Limiters from StaplerConfig.route_limits, by config.
+        self.__route_limiters = weakref.WeakKeyDictionary()
+        # Whether the method was defined with "async def".
+        self.is_coroutine = _iscoroutinefunction(method)
+        # A function that invokes the wrapped method for a request. It takes
+        # the object to call the method on and the request parameters, and
+        # calls the method with the arguments it declares. It is built once
+        # per method, specialized to the shape of the method's signature, so
+        # that as little work as possible is done on each request.
+        self.binder = _build_binder(
+            method, self.name, self.parameters,
+            next(iter(self.signature.parameters), None))
+        self.__plain = self.__is_plain()
+
+    def __is_plain(self):
+        """Returns whether invoke() only has to call the method.
+
+        That is the case for most methods: those that are not coroutines,
+        and have no validators, memo, response cache, coalescing or @limit,
+        and are not @traversable_dynamic or @etag/@last_modified methods.
+        """
+        return (not self.is_coroutine and self.validators is None
+                and self.validator is None and not self.dynamic
+                and self.memoize is None and self.response_cache is None
+                and self.coalesce is None and self.admission is None)
 
-    def __getattr__(self, attribute):
-        assert not attribute.startswith('_')
-        if attribute in self.__attributes:
-            return self.__attributes[attribute]
-        qualified_attribute = PREFIX + attribute
-        value = getattr(self.__method, qualified_attribute, None)
-        self.__attributes[attribute] = value
-        return value
+    def set_validators(self, validators):
+        """Attaches the _Validators of the object to its @default method."""
+        self.validators = validators
+        self.__plain = self.__is_plain()
 
     @cached_property
-    def name(self):
-        """Returns the name that this method is traversable as."""
-        if self.traversable_as is not None:
-            return self.traversable_as
-        return self.__method.__name__
+    def signature(self):
+        """Returns an inspect.Signature object for the wrapped method."""
+        return signature(self.__method)
 
     @cached_property
-    def argspec(self):
-        """Returns an ArgSpec named tuple for the wrapped method."""
-        return inspect.getargspec(self.__method)
+    def parameters(self):
+        """Returns the injectable parameters of the wrapped method.
+
+        This is a list of inspect.Parameter objects, in declaration order,
+        excluding the first positional parameter (the "self" parameter), which
+        is always supplied automatically, and any *args parameter.
+        """
+        # I tried using inspect.ismethod to detect the "self" parameter, but
+        # it doesn't work because the function object can be decorated (and,
+        # in our case, usually is), and the decorated function object is NOT
+        # a method. Since only functions found on a class are ever wrapped,
+        # the first positional parameter is always the receiver.
+        parameters = []
+        receiver_found = False
+        for parameter in self.signature.parameters.values():
+            if parameter.kind in _POSITIONAL_KINDS and not receiver_found:
+                receiver_found = True
+            elif parameter.kind != Parameter.VAR_POSITIONAL:
+                parameters.append(parameter)
+        return parameters
 
     @cached_property
     def required_args(self):
@@ -225,19 +695,172 @@ class _MethodInfo(object):
         The "self" parameter of a method is not considered required, as it
         will be supplied automatically.
         """
-        args = self.argspec.args
-        defaults = self.argspec.defaults
-        if defaults:
-            args = args[:-len(defaults)]
-        # I tried using inspect.ismethod to detect this case, but it doesn't
-        # work because the function object can be decorated (and, in our case,
-        # usually is), and the decorated function object is NOT a method.
-        # So I make do with this hacky solution.
-        if args[0] == 'self':
-            args = args[1:]
-        return args
-
-    def traverse(self, obj, extra_path_segments, request_params):
+        return [
+            parameter.name for parameter in self.parameters
+            if parameter.kind != Parameter.VAR_KEYWORD
+            and parameter.default is Parameter.empty]
+
+    @cached_property
+    def segment_parameter(self):
+        """Returns the name of the parameter a path segment is bound to.
+
+        This is the first parameter of a @traversable_dynamic method, after
+        the "self" parameter.
+
+        Raises:
+            TypeError: if the method has no such parameter.
+        """
+        for parameter in self.parameters:
+            if parameter.kind in _POSITIONAL_KINDS:
+                return parameter.name
+        raise TypeError(
+            'Dynamic method "{}" takes no parameter for the path '
+            'segment'.format(self.name))
+
+    @cached_property
+    def result_type(self):
+        """Returns the type the wrapped method is known to return, or None.
+
+        This is the type declared with @traversable(returns=...), or else
+        the return annotation of the method, if that is a class.
+        """
+        if self.returns is not None:
+            return self.returns
+        annotation = self.signature.return_annotation
+        if isinstance(annotation, type):
+            return annotation
+        return None
+
+    @cached_property
+    def memo_key(self):
+        """Returns a function that computes the memo key for a request.
+
+        The key is the tuple of the values of the method's parameters, with
+        defaults filled in. Returns None if the method is not memoized.
+
+        Raises:
+            TypeError: if the method accepts **kwargs, or a parameter that
+                is injected from the request (such as "request" or "form"),
+                since its results then cannot be told apart by key.
+        """
+        if self.memoize is None:
+            return None
+        arguments = []
+        for parameter in self.parameters:
+            if (parameter.kind == Parameter.VAR_KEYWORD
+                    or parameter.name in _INJECTABLES):
+                raise TypeError(
+                    'Cannot memoize "{}", which takes parameter "{}"'.format(
+                        self.name, parameter.name))
+            arguments.append((parameter.name, parameter.default))
+        arguments = tuple(arguments)
+
+        def memo_key(request_params):
+            """Returns the memo key for a request."""
+            return tuple(
+                request_params.get(name, default_value)
+                for name, default_value in arguments)
+        return memo_key
+
+    def limiter(self, config):
+        """Returns the pystapler.admission.Limiter of the method, or None.
+
+        This is the Limiter given with @limit, or else the one configured
+        for the method's name in the route_limits of the given StaplerConfig.
+        That is looked up once per config, and remembered.
+        """
+        if self.admission is not None:
+            return self.admission
+        if not config.route_limits:
+            return None
+        limiter = self.__route_limiters.get(config, MISSING)
+        if limiter is MISSING:
+            limiter = config.route_limits.get(self.name)
+            if limiter is not None and limiter.name is None:
+                limiter.name = self.name
+            self.__route_limiters[config] = limiter
+        return limiter
+
+    def call(self, obj, request_params):
+        """Calls the wrapped method on obj, and returns what it returned.
+
+        Unlike invoke(), this always calls the method. If the method was
+        defined with "async def", the coroutine is run to completion. If
+        the method returned bytes, a buffer, a file or a generator (see
+        pystapler.response.PASSTHROUGH_TYPES), it is turned into a response
+        that sends it as the body, unless the method is an @etag or
+        @last_modified method: their results are values, such as a str on
+        Python 2 (where that is bytes), not bodies.
+        """
+        result = self.binder(obj, request_params)
+        if self.is_coroutine:
+            # We are on a WSGI worker thread, so nothing else is waiting on
+            # this thread: just run the coroutine to completion.
+            from pystapler.asgi import run_coroutine
+            result = run_coroutine(result)
+        if self.validator is None and isinstance(result, PASSTHROUGH_TYPES):
+            result = _passthrough_response(result)
+        return result
+
+    def invoke(self, obj, request_params):
+        """Calls the wrapped method on obj, without dispatching further.
+
+        Arguments to the method are supplied using the request_params
+        dictionary (see the module documentation for details). If the method
+        accepts an argument but the request_params dictionary does not
+        contain the given key, a BadRequest exception is raised.
+
+        If the method was decorated with @cached, the response may come from
+        the cache instead, without calling the method at all. Likewise, if
+        the method was declared with @traversable(memoize=...), the object
+        it returned for obj and the same arguments before may be reused.
+        If the method is the @default method of an object that has @etag
+        or @last_modified methods, a 304 Not Modified response is returned
+        without calling it when the client's copy is current. And if the
+        method was decorated with @coalesce, an identical request that is
+        already calling it may supply the result. Within a batch (see
+        pystapler.batch), an object that an earlier sub-request got from
+        the method is reused. If the method has a
+        Limiter (see pystapler.admission), it is only called once admitted,
+        and the request fails with 503 Service Unavailable if it is not.
+        A @traversable_dynamic method that returns None results in a 404.
+
+        Returns:
+            Whatever the wrapped method returned.
+        """
+        if self.__plain and request_params.shared_results is None and (
+                self.limiter(request_params.config) is None):
+            # Nothing but the call itself to do.
+            result = self.binder(obj, request_params)
+            if isinstance(result, PASSTHROUGH_TYPES):
+                result = _passthrough_response(result)
+            return result
+        validators = self.validators
+        validator_values = None
+        if validators is not None:
+            validator_values = validators.compute(obj, request_params)
+        invocation = _Invocation(self, obj, request_params, validator_values)
+        result = invocation.lookup()
+        if result is not MISSING:
+            return result
+        limiter = self.limiter(request_params.config)
+        coalescer = self.coalesce
+        if coalescer is None and limiter is None:
+            result = self.call(obj, request_params)
+        else:
+            def compute():
+                """Calls the method, once the limiter admits the call."""
+                if limiter is None:
+                    return self.call(obj, request_params)
+                return limiter.run(lambda: self.call(obj, request_params))
+            if coalescer is None:
+                result = compute()
+            else:
+                # Requests that wait for an identical one take no slot.
+                result = coalescer.run(request_params, compute)
+        return invocation.finish(result)
+
+    def traverse(self, obj, extra_path_segments, request_params, trace=None):
         """Traverses to the given method, and continues dispatching if needed.
 
         The underlying method may accept any number of arguments. Arguments to
@@ -263,38 +886,481 @@ class _MethodInfo(object):
             request_params:
                 A dictionary of parameters derived from the current request
                 which can be used to satisfy method arguments.
+            trace:
+                If not None, a list to which a (_MethodInfo, result, seconds)
+                tuple is appended for this method and every member traversed
+                after it.
 
         Returns:
             A Werkzeug response object or other WSGI application object, which
             will be used to create the HTTP response.
         """
-        for required_arg in self.required_args:
-            if required_arg not in request_params:
-                LOGGER.warning(
-                    'Attempted to invoke method "%s" but required '
-                    'parameter "%s" was not provided.',
-                    self.name, required_arg)
-                raise BadRequest(
-                    'Required parameter "{}" not provided'.format(
-                        required_arg))
-        if self.argspec.keywords:
-            # If the method accepts kwargs, give it all the request params.
-            kwargs = dict(request_params)
+        if trace is None:
+            result = self.invoke(obj, request_params)
         else:
-            # Otherwise, just give it the ones it's asked for.
-            kwargs = {
-                key : request_params[key]
-                for key in self.argspec.args
-                if key in request_params}
-        kwargs['self'] = obj
-        method = self.__method
-        result = method(**kwargs)
-        LOGGER.info(
-            'Traversing "%s" resulted in an object of type %s',
-            self.name, type(result))
+            started = _timer()
+            result = self.invoke(obj, request_params)
+            trace.append((self, result, _timer() - started))
         if callable(result):
             return result
-        return _ObjectInfo(result).dispatch(extra_path_segments, request_params)
+        return _ObjectInfo(result).dispatch(
+            extra_path_segments, request_params, trace)
+
+
+def _prepare_method_info(method_info):
+    """Computes everything about a method that dispatching may need."""
+    for attribute in ('required_args', 'result_type', 'memo_key'):
+        getattr(method_info, attribute)
+    if method_info.dynamic:
+        getattr(method_info, 'segment_parameter')
+
+
+def _renders(cls):
+    """Returns whether instances of cls are responses, not traversed into."""
+    return any('__call__' in vars(klass) for klass in cls.__mro__
+               if klass is not object)
+
+
+class _Validators(object):
+    """The @etag and @last_modified methods of an object.
+
+    These are attached to the _MethodInfo of the object's @default method,
+    which consults them before rendering the object.
+    """
+
+    def __init__(self, etag_method, last_modified_method):
+        self.etag_method = etag_method
+        self.last_modified_method = last_modified_method
+
+    def compute(self, obj, request_params):
+        """Returns the (etag, last_modified) pair describing obj.
+
+        Either value is None if obj has no method to compute it, or if the
+        method returned None. The last modification time is returned as a
+        naive UTC datetime, truncated to whole seconds like HTTP dates are.
+        """
+        etag_value = None
+        last_modified_value = None
+        if self.etag_method is not None:
+            etag_value = self.etag_method.invoke(obj, request_params)
+        if self.last_modified_method is not None:
+            last_modified_value = self.last_modified_method.invoke(
+                obj, request_params)
+        return self.normalize(etag_value, last_modified_value)
+
+    @staticmethod
+    def normalize(etag_value, last_modified_value):
+        """Returns the (etag, last_modified) pair for the methods' results.
+
+        This is the second half of compute(), for callers that invoke the
+        methods themselves.
+        """
+        if isinstance(last_modified_value, numbers.Real):
+            last_modified_value = datetime.utcfromtimestamp(
+                int(last_modified_value))
+        elif last_modified_value is not None:
+            last_modified_value = last_modified_value.replace(microsecond=0)
+        return etag_value, last_modified_value
+
+    @staticmethod
+    def not_modified(request, etag_value, last_modified_value):
+        """Returns a 304 response if the client's copy is current, or None."""
+        if (request.method not in _CONDITIONAL_METHODS
+                or (not request.if_none_match
+                    and request.if_modified_since is None)
+                or is_resource_modified(
+                    request.environ, etag=etag_value,
+                    last_modified=last_modified_value)):
+            return None
+        response = Response(status=304)
+        _Validators.stamp(response, etag_value, last_modified_value)
+        return response
+
+    @staticmethod
+    def stamp(response, etag_value, last_modified_value):
+        """Adds ETag and Last-Modified headers to a response.
+
+        Headers the response already has are left alone, as is anything
+        other than a 200 or 304 response.
+        """
+        if (not isinstance(response, BaseResponse)
+                or response.status_code not in (200, 304)):
+            return
+        headers = response.headers
+        if etag_value is not None and 'ETag' not in headers:
+            headers['ETag'] = quote_etag(etag_value)
+        if last_modified_value is not None and 'Last-Modified' not in headers:
+            headers['Last-Modified'] = http_date(last_modified_value)
+
+
+class _Invocation(object):
+    """One call of a _MethodInfo, apart from calling the method itself.
+
+    This is what _MethodInfo.invoke() does before and after calling the
+    method. The ASGI application (see pystapler.asgi) goes through the same
+    steps for coroutine methods, but computes the validators and calls the
+    method in its own way, so that it does not block the event loop.
+    """
+
+    def __init__(self, method_info, obj, request_params, validator_values):
+        """Starts an invocation.
+
+        Parameters:
+            method_info:
+                The _MethodInfo of the method to call.
+            obj:
+                The object to call the method on.
+            request_params:
+                The RequestParams of the request.
+            validator_values:
+                The (etag, last_modified) pair computed by the validators of
+                the method (see _Validators.compute), or None if it has none.
+        """
+        self.__method_info = method_info
+        self.__obj = obj
+        self.__request_params = request_params
+        self.__validator_values = validator_values
+        self.__memo_key = None
+
+    def lookup(self):
+        """Returns a result that makes calling the method unnecessary.
+
+        This is a 304 Not Modified response, an object reused from an earlier
+        sub-request of a batch, a memoized object or a cached response, in
+        that order of preference.
+
+        Returns:
+            The result, or MISSING if the method has to be called.
+        """
+        method_info = self.__method_info
+        obj = self.__obj
+        request_params = self.__request_params
+        if self.__validator_values is not None:
+            response = method_info.validators.not_modified(
+                request_params.request, *self.__validator_values)
+            if response is not None:
+                return response
+        shared_results = request_params.shared_results
+        if shared_results is not None:
+            result = shared_results.lookup(method_info, obj, request_params)
+            if result is not MISSING:
+                return result
+        memo = method_info.memoize
+        if memo is not None:
+            self.__memo_key = method_info.memo_key(request_params)
+            result = memo.lookup(obj, self.__memo_key)
+            if result is not MISSING:
+                return result
+        response_cache = method_info.response_cache
+        if response_cache is not None:
+            response = response_cache.lookup(request_params)
+            if response is not None:
+                return response
+        return MISSING
+
+    def finish(self, result):
+        """Records what the method returned, for the lookup of later calls.
+
+        Returns:
+            The result of the invocation: what the method returned, with
+            validator headers added, or a 404 Not Found response if it is a
+            @traversable_dynamic method that returned None.
+        """
+        method_info = self.__method_info
+        obj = self.__obj
+        request_params = self.__request_params
+        if result is None and method_info.dynamic:
+            # A dynamic method found nothing for the path segment.
+            return NotFound()
+        response_cache = method_info.response_cache
+        if response_cache is not None:
+            result = response_cache.store(request_params, result)
+        if not callable(result):
+            memo = method_info.memoize
+            if memo is not None:
+                memo.store(obj, self.__memo_key, result)
+            shared_results = request_params.shared_results
+            if shared_results is not None:
+                shared_results.store(method_info, obj, request_params, result)
+        if self.__validator_values is not None:
+            method_info.validators.stamp(result, *self.__validator_values)
+        return result
+
+
+def _missing_parameter(method_name, parameter_name):
+    """Raises the BadRequest error for a missing required parameter."""
+    LOGGER.warning(
+        'Attempted to invoke method "%s" but required '
+        'parameter "%s" was not provided.',
+        method_name, parameter_name)
+    raise BadRequest(
+        'Required parameter "{}" not provided'.format(parameter_name))
+
+
+def _build_binder(method, method_name, parameters, receiver_name):
+    """Builds a function that calls method with arguments from a request.
+
+    Parameters:
+        method:
+            The function to call. Its first positional parameter receives the
+            object the method is being called on.
+        method_name:
+            The name of the method, used in error messages.
+        parameters:
+            The injectable inspect.Parameter objects of the method, as
+            returned by _MethodInfo.parameters.
+        receiver_name:
+            The name of the method's first parameter (usually "self"), which
+            must never be passed as a keyword argument.
+
+    Returns:
+        A function taking (obj, request_params) that calls the method and
+        returns its result, or raises BadRequest if a required parameter is
+        not present in request_params.
+    """
+    # Positional parameters are passed positionally, as (name, default)
+    # pairs; keyword-only parameters are passed as keywords.
+    positional = tuple(
+        (parameter.name, parameter.default) for parameter in parameters
+        if parameter.kind in _POSITIONAL_KINDS)
+    keyword_only = tuple(
+        (parameter.name, parameter.default) for parameter in parameters
+        if parameter.kind == Parameter.KEYWORD_ONLY)
+    accepts_kwargs = any(
+        parameter.kind == Parameter.VAR_KEYWORD for parameter in parameters)
+    empty = Parameter.empty
+
+    def bind(request_params, arguments):
+        """Returns the values for arguments, taken from request_params."""
+        values = []
+        for name, default_value in arguments:
+            value = request_params.get(name, empty)
+            if value is empty:
+                if default_value is empty:
+                    _missing_parameter(method_name, name)
+                value = default_value
+            values.append(value)
+        return values
+
+    if not accepts_kwargs and not keyword_only:
+        if not positional:
+            def call_without_arguments(obj, request_params):
+                """Binder for a method that takes no parameters."""
+                # pylint: disable=unused-argument
+                return method(obj)
+            return call_without_arguments
+
+        def call_positionally(obj, request_params):
+            """Binder for a method that only takes named parameters."""
+            return method(obj, *bind(request_params, positional))
+        return call_positionally
+
+    bound_names = tuple(
+        [receiver_name] + [name for name, _ in positional + keyword_only])
+
+    def call_with_keywords(obj, request_params):
+        """Binder for a method with keyword-only parameters or **kwargs."""
+        if accepts_kwargs:
+            # If the method accepts kwargs, give it the request params that
+            # are not already bound to a named parameter, except those that
+            # read the body, which it must name to get.
+            kwargs = request_params.keyword_arguments()
+            for name in bound_names:
+                kwargs.pop(name, None)
+        else:
+            kwargs = {}
+        kwargs.update(zip(
+            (name for name, _ in keyword_only),
+            bind(request_params, keyword_only)))
+        return method(obj, *bind(request_params, positional), **kwargs)
+    return call_with_keywords
+
+
+class _MountInfo(object):
+    """Wrapper around a Mountable class attribute used for dispatching.
+
+    Mounted objects are never part of a route plan, since the paths below
+    them are not resolved through traversal maps.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, name, mounted):
+        self.name = name
+        self.mounted = mounted
+
+    def traverse(self, obj, extra_path_segments, request_params, trace=None):
+        """Dispatches the remaining path to the mounted object."""
+        # pylint: disable=unused-argument
+        if trace is None:
+            return self.mounted.dispatch(extra_path_segments, request_params)
+        started = _timer()
+        response = self.mounted.dispatch(extra_path_segments, request_params)
+        trace.append((self, response, _timer() - started))
+        return response
+
+
+class _RoutePlan(object):
+    """A flattened traversal chain for a single request path.
+
+    A route plan is a sequence of steps, one per path segment (plus one for
+    the @default method, if the path ends on an object rather than on a
+    response). Each step is a (_MethodInfo, result_type) pair: the method to
+    invoke, and the exact type of the object it is expected to return.
+
+    Executing a plan invokes the same methods that recursive dispatching
+    would, but in a loop, without wrapping each intermediate object in an
+    _ObjectInfo or looking anything up in a traversal map. Each step is
+    guarded by checking the type of the object actually returned, so if a
+    method returns something other than what the plan expects, dispatching
+    falls back to ordinary recursive traversal from that point onwards.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, steps):
+        self.steps = tuple(steps)
+
+    def execute(self, root, path_segments, request_params, trace=None):
+        """Dispatches a request by executing this plan.
+
+        Parameters:
+            root:
+                The StaplerRoot object the request was made to.
+            path_segments:
+                The list of path segments of the request. These must be the
+                segments that this plan was built for.
+            request_params:
+                A dictionary of parameters derived from the current request
+                which can be used to satisfy method arguments.
+            trace:
+                If not None, a list to which a (member, result, seconds)
+                tuple is appended for every member traversed, as in
+                _ObjectInfo.dispatch.
+
+        Returns:
+            A Werkzeug response object or other WSGI application object, which
+            will be used to create the HTTP response.
+        """
+        # pylint: disable=unidiomatic-typecheck
+        obj = root
+        index = 0
+        for method_info, result_type in self.steps:
+            if trace is None:
+                result = method_info.invoke(obj, request_params)
+            else:
+                started = _timer()
+                result = method_info.invoke(obj, request_params)
+                trace.append((method_info, result, _timer() - started))
+            if callable(result):
+                return result
+            index += 1
+            if type(result) is not result_type:
+                LOGGER.debug(
+                    'Route plan for "%s" expected %s but got %s; falling '
+                    'back to recursive dispatch.',
+                    method_info.name, result_type, type(result))
+                return _ObjectInfo(result).dispatch(
+                    path_segments[index:], request_params, trace)
+            obj = result
+        return _ObjectInfo(obj).dispatch(
+            path_segments[index:], request_params, trace)
+
+
+def _get_route_plans(cls):
+    """Returns the dictionary of route plans for a StaplerRoot subclass.
+
+    The dictionary maps tuples of path segments to _RoutePlan objects. Like
+    traversal maps, it is cached on the type object itself.
+    """
+    attribute_name = PREFIX + 'route_plans'
+    route_plans = cls.__dict__.get(attribute_name)
+    if route_plans is None:
+        route_plans = {}
+        setattr(cls, attribute_name, route_plans)
+    return route_plans
+
+
+def _build_static_plan(cls, path_segments):
+    """Builds a route plan from type declarations alone, if possible.
+
+    This is only possible if every method along the path, except possibly
+    the last one, was declared with @traversable(returns=...), so that the
+    type it returns is known without calling it.
+
+    Returns:
+        A _RoutePlan, or None if the path is not statically type-stable.
+    """
+    steps = []
+    current_type = cls
+    for path_segment in path_segments:
+        if current_type is None:
+            # The previous method does not declare what it returns.
+            return None
+        member = _get_traversal_map(current_type).get(path_segment)
+        if not isinstance(member, _MethodInfo):
+            return None
+        current_type = member.returns
+        steps.append((member, current_type))
+    if current_type is not None:
+        member = _get_traversal_map(current_type).get(DEFAULT)
+        if not isinstance(member, _MethodInfo):
+            return None
+        steps.append((member, None))
+    return _RoutePlan(steps)
+
+
+def _type_stable_paths(cls, max_depth):
+    """Yields every path reachable from cls through typed traversals.
+
+    Each path yielded is a non-empty list of path segments, all but the last
+    of which correspond to methods declared with @traversable(returns=...).
+    """
+    if max_depth <= 0:
+        return
+    for path_segment, member in iteritems(_get_traversal_map(cls)):
+        if (not isinstance(path_segment, string_types)
+                or not isinstance(member, _MethodInfo)):
+            continue
+        yield [path_segment]
+        if member.returns is not None:
+            for path_suffix in _type_stable_paths(
+                    member.returns, max_depth - 1):
+                yield [path_segment] + path_suffix
+
+
+def _dispatch_with_plans(root, path_segments, request_params, trace=None):
+    """Dispatches a request using a cached route plan where possible.
+
+    If no plan exists yet for the requested path, one is built from type
+    declarations, or failing that, recorded while dispatching the request
+    recursively. Only paths that end in a response returned by a method are
+    recorded, so paths that result in a 404 do not occupy the cache, and
+    neither are paths through @traversable_dynamic methods, which would
+    otherwise take one plan per segment value.
+
+    If trace is not None, it is filled in as by _ObjectInfo.dispatch.
+    """
+    route_plans = _get_route_plans(type(root))
+    key = tuple(path_segments)
+    plan = route_plans.get(key)
+    if plan is None:
+        plan = _build_static_plan(type(root), path_segments)
+        if plan is None:
+            if trace is None:
+                trace = []
+            response = _ObjectInfo(root).dispatch(
+                path_segments, request_params, trace)
+            if (trace and callable(trace[-1][1])
+                    and len(route_plans) < MAX_ROUTE_PLANS
+                    and all(isinstance(member, _MethodInfo)
+                            and not member.dynamic
+                            for member, _, _ in trace)):
+                route_plans[key] = _RoutePlan(
+                    (method_info, type(result))
+                    for method_info, result, _ in trace)
+            return response
+        if len(route_plans) < MAX_ROUTE_PLANS:
+            route_plans[key] = plan
+    return plan.execute(root, path_segments, request_params, trace)
 
 
 def _decorate_impl(method, **kwargs):
@@ -314,13 +1380,104 @@ def default(method):
     return _decorate_impl(method, default=True)
 
 
-def traversable(obj):
+def traversable_dynamic(method):
+    """Marks a method that resolves path segments that are not names.
+
+    When a path segment does not match anything traversable on an object,
+    the object's @traversable_dynamic method is called instead, with the
+    segment as its first argument (after self). Its other parameters are
+    injected from the request, like those of any other method. Dispatching
+    continues with whatever it returns, as for @traversable methods, and a
+    method that returns None results in 404 Not Found. Traversable names
+    take precedence, so an object can have both; the names of members that
+    are not traversable do not, so /users/save reaches the dynamic method
+    even if the object has a plain save() method. An empty segment, as in
+    /users/, never reaches it.
+
+    To avoid a backend lookup per segment, a method can resolve its children
+    through a pystapler.loader.Loader, which batches lookups and remembers
+    what it resolved.
+
+    Example use:
+
+        class Users(object):
+            @traversable
+            def count(self):
+                # /users/count maps to this method.
+                ...
+
+            @traversable_dynamic
+            def user(self, user_id, request):
+                # /users/12345/orders maps to user('12345', ...), then to
+                # the "orders" member of the User object it returns.
+                return USERS.load(request, user_id)
+    """
+    return _decorate_impl(method, dynamic=True)
+
+
+def etag(method):
+    """Marks a method that computes the entity tag of an object.
+
+    The method is called before the object's @default method, and should be
+    much cheaper: it typically returns a version number or content hash that
+    the object already has at hand. If the client's If-None-Match header
+    matches the returned string, the response is 304 Not Modified and the
+    @default method is not called at all. Otherwise the string is sent in
+    the ETag header of the rendered response.
+
+    The method may take parameters from the request, like any other.
+
+    Example use:
+
+        class Article(object):
+            @etag
+            def revision(self):
+                return str(self.revision_id)
+
+            @default
+            @template(env, 'article.html')
+            def render(self):
+                ...
+    """
+    return _decorate_impl(method, validator=ETAG)
+
+
+def last_modified(method):
+    """Marks a method that computes when an object was last modified.
+
+    Like @etag, but the method returns a naive UTC datetime or a Unix
+    timestamp, which is compared with the client's If-Modified-Since header
+    and sent in the Last-Modified header. An object may have both an @etag
+    and a @last_modified method, in which case the client's copy is current
+    only if both match.
+    """
+    return _decorate_impl(method, validator=LAST_MODIFIED)
+
+
+def traversable(obj=None, returns=None, memoize=None):
     """Marks a method as traversable.
 
     This method is intended to be invoked as a decorator, but it optionally
     accepts a string argument indicating the path name that should correspond
     to the decorated method.
 
+    The optional returns argument declares the method as type-stable: it
+    always returns an instance of exactly the given type. This lets route
+    plans through the method be built ahead of time (see
+    StaplerRoot.build_route_plans). If a type-stable method returns
+    something else anyway, dispatching still works, just more slowly.
+
+    The optional memoize argument makes the method's results reusable: the
+    object it returns is remembered per object it was called on and per
+    combination of argument values, so later requests through the same path
+    skip calling it. This is meant for methods that look up a child object
+    which rarely changes, such as a loaded configuration or a parsed file.
+    The argument may be True, a number of seconds after which a result
+    expires, or a pystapler.memo.Memo object, which also allows results to
+    be invalidated explicitly. Responses (callable results) are never
+    memoized, and neither are methods that take **kwargs or parameters
+    injected from the request.
+
     Example use:
 
         class MyApp(StaplerRoot):
@@ -329,40 +1486,90 @@ def traversable(obj):
                 # The /spam URL will map to this method.
                 ...
 
-            @traversable('/something-completely-different')
+            @traversable('something-completely-different')
             def eggs(self):
                 # The /something-completely-different URL will map to this
                 # method. The /eggs URL will not be mapped to anything.
                 ...
+
+            @traversable(returns=Shrubbery)
+            def ni(self):
+                # The /ni URL will map to this method, which always returns
+                # a Shrubbery object.
+                return Shrubbery()
+
+            @traversable(memoize=60)
+            def grail(self, quest):
+                # Called at most once a minute per MyApp object and quest.
+                return find_grail(quest)
     """
     if callable(obj):
         name = obj.__name__
         return _decorate_impl(obj, traversable_as=name)
 
     # If the argument is not callable, assume it's a string which is the name
-    # we want to be traversable by.
+    # we want to be traversable by (or None to use the method name).
     name = obj
     def decorator_closure(method):
         """Decorator closure that will decorate with the given name."""
-        return _decorate_impl(method, traversable_as=name)
+        memo = memoize
+        if memo is True:
+            memo = Memo()
+        elif memo is False:
+            memo = None
+        elif memo is not None and not isinstance(memo, Memo):
+            memo = Memo(ttl=memo)
+        return _decorate_impl(
+            method,
+            traversable_as=name if name is not None else method.__name__,
+            returns=returns,
+            memoize=memo)
     return decorator_closure
 
 
 def main(root):
-    """Launches an application with a simple runner for debugging.
+    """Launches an application.
+
+    In debug mode, or if config.workers is zero, this runs the application
+    with Werkzeug's simple development server. Otherwise it compiles the
+    application (see StaplerRoot.compile) and runs it with the pre-forking
+    production server in pystapler.server. Either way, the background tasks
+    on config.task_queues are finished before the server exits.
+
+    In debug mode, changed modules are reloaded in place, as described in
+    pystapler.reload, or if config.hot_reload is turned off, the server is
+    restarted whenever a module changes.
 
     Parameters:
         root:
             An instance of StaplerRoot representing the application.
     """
     config = root.config
-    LOGGER.info('Launching server on http://localhost:%d', config.port)
-    run_simple(
-        hostname='0.0.0.0',
-        port=config.port,
-        application=root,
-        use_debugger=config.debug,
-        use_reloader=config.debug)
+    if config.debug or not config.workers:
+        LOGGER.info('Launching server on http://localhost:%d', config.port)
+        application = root
+        hot_reload = config.debug and config.hot_reload
+        if hot_reload:
+            from pystapler.reload import Reloader
+            application = Reloader(root)
+        run_simple(
+            hostname=config.host,
+            port=config.port,
+            application=application,
+            use_debugger=config.debug,
+            use_reloader=config.debug and not hot_reload)
+        for task_queue in config.task_queues:
+            task_queue.drain(config.graceful_timeout)
+        return
+    # Build what we can before forking, so workers share it.
+    root.compile()
+    if hasattr(gc, 'freeze'):
+        # Keep the garbage collector from touching (and so copying) every
+        # page of the objects built so far in each worker.
+        gc.collect()
+        gc.freeze()
+    from pystapler.server import PreforkServer
+    PreforkServer(root, config).serve_forever()
 
 
 # vim: et ts=4
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements a Jinja2 template environment for use with @template.
+
+A JinjaEnvironment loads templates from a directory, and keeps their
+compiled bytecode in a directory on disk, so that the worker processes of a
+server, and servers started later, load compiled templates instead of each
+compiling them again. Templates are compiled when they are first rendered,
+not when the module that uses them is imported (see @template).
+
+If the environment is given the application's StaplerConfig, and that is
+in debug mode (StaplerConfig.debug), every render checks whether the
+template's source file changed, and recompiles it if so. Otherwise templates
+are never checked again once loaded, which saves a stat() call per render.
+
+The bytecode cache can be filled before deployment, so that even the first
+request to each worker finds every template compiled:
+
+    python -m pystapler.jinja myapp.views:ENV
+
+Example Usage:
+
+    class Config(StaplerConfig):
+        debug = False
+
+    ENV = JinjaEnvironment('templates', Config)
+
+    class Root(StaplerRoot):
+        config = Config()
+
+        @default
+        @template(ENV, 'home.html')
+        def home(self):
+            return {'guestbook': self.guestbook}
+
+This module requires the jinja2 package.
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import importlib
+import logging
+import os
+import sys
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from jinja2.exceptions import TemplateError
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class JinjaEnvironment(Environment):
+    """A Jinja2 environment with a bytecode cache shared between processes."""
+
+    def __init__(self, directory, config=None, cache_directory=None,
+                 **options):
+        """Creates an environment.
+
+        Parameters:
+            directory:
+                The directory templates are loaded from. A relative path is
+                relative to the current directory.
+            config:
+                The StaplerConfig of the application. Templates are checked
+                for changes only if config.debug is set; if no config is
+                given, they are never checked.
+            cache_directory:
+                The directory compiled templates are kept in. It is created
+                if it does not exist. By default, this is a directory in the
+                system's temporary directory, shared by every application
+                of the current user; templates are told apart by their path.
+            options:
+                Any other keyword arguments of jinja2.Environment. By
+                default, autoescaping is on for HTML and XML templates.
+        """
+        self.directory = os.path.abspath(directory)
+        if cache_directory is not None:
+            cache_directory = os.path.abspath(cache_directory)
+            if not os.path.isdir(cache_directory):
+                os.makedirs(cache_directory)
+        options.setdefault('loader', FileSystemLoader(self.directory))
+        options.setdefault(
+            'bytecode_cache', FileSystemBytecodeCache(cache_directory))
+        options.setdefault(
+            'auto_reload', config is not None and bool(config.debug))
+        options.setdefault('autoescape', _autoescape)
+        Environment.__init__(self, **options)
+
+    def precompile(self):
+        """Compiles every template, filling the bytecode cache.
+
+        Returns:
+            A (compiled, failed) pair of lists of template names. Templates
+            that fail to compile are logged, and do not stop the others.
+        """
+        compiled = []
+        failed = []
+        for name in self.list_templates():
+            try:
+                self.get_template(name)
+            except TemplateError:
+                LOGGER.exception('Failed to compile template %s', name)
+                failed.append(name)
+            else:
+                compiled.append(name)
+        return compiled, failed
+
+
+def _autoescape(template_name):
+    """Returns whether a template is escaped by default, by its extension."""
+    if template_name is None:
+        return False
+    return template_name.endswith(('.html', '.htm', '.xml'))
+
+
+def _import_object(path):
+    """Returns the object a "module:attribute" path names."""
+    module_name, _, attribute = path.partition(':')
+    obj = importlib.import_module(module_name)
+    for name in attribute.split('.'):
+        if name:
+            obj = getattr(obj, name)
+    return obj
+
+
+def main(argv=None):
+    """Precompiles the templates of environments from the command line."""
+    parser = argparse.ArgumentParser(
+        prog='python -m pystapler.jinja',
+        description='Compiles templates into the bytecode cache of a '
+                    'JinjaEnvironment, ahead of deployment.')
+    parser.add_argument(
+        'environments', nargs='+', metavar='MODULE:ATTRIBUTE',
+        help='an environment to precompile, such as myapp.views:ENV')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig()
+    # Modules of the application are imported from the current directory,
+    # as when running it.
+    sys.path.insert(0, os.getcwd())
+    status = 0
+    for path in args.environments:
+        compiled, failed = _import_object(path).precompile()
+        print('{}: compiled {} templates, {} failed'.format(
+            path, len(compiled), len(failed)))
+        if failed:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: et ts=4
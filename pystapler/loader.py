@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements batched loading of the children of collections.
+
+A Loader wraps a function that looks up many objects by key in one backend
+call, such as a database query with "WHERE id IN (...)". Within a request,
+each key is looked up at most once: a @traversable_dynamic method that
+resolves /users/12345 and a collection page that lists the same user share
+the result. A page that lists many children can ask for all of them with
+load_many(), or defer() each one and have them all looked up in one call
+when the first is needed, rather than making one backend call per child.
+
+The request's results are kept with the request, so they are shared by the
+sub-requests of a pystapler.batch request, and forgotten when it ends. A
+Loader may also keep a bounded LRU of resolved children across requests,
+for objects that rarely change.
+
+Example Usage:
+
+    USERS = Loader(
+        lambda ids: dict((user.id, user) for user in db.users_by_id(ids)),
+        max_cached=10000)
+
+    class Users(object):
+        @traversable_dynamic
+        def user(self, user_id, request):
+            return USERS.load(request, user_id)
+
+        @default
+        @template(env, 'users.html')
+        def render(self, request, ids):
+            return {'users': USERS.load_many(request, ids.split(','))}
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+from collections import OrderedDict
+import threading
+
+from pystapler.memo import MISSING
+
+
+class _RequestScope(object):
+    """What a Loader has resolved and been asked for in one request."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.values = {}
+        self.pending = []
+        self.lock = threading.Lock()
+
+
+class _Deferred(object):
+    """A child that a Loader will resolve together with others."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, loader, request, key):
+        self.__loader = loader
+        self.__request = request
+        self.key = key
+
+    @property
+    def value(self):
+        """The child, resolving every pending child of the request."""
+        return self.__loader.load(self.__request, self.key)
+
+
+class Loader(object):
+    """Looks up objects by key in batches, at most once per request.
+
+    The calls and loaded attributes count the calls made to the load
+    function and the keys passed to it; hits counts the keys that were
+    found in the LRU.
+    """
+    # The settings and counts are public, for tests and monitoring to read.
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, load_many, max_cached=0, max_batch=None):
+        """Creates a loader.
+
+        Parameters:
+            load_many:
+                A function that takes a list of distinct keys and returns a
+                dictionary mapping keys to objects. Keys that are missing
+                from the dictionary resolve to None, which a
+                @traversable_dynamic method returns as 404 Not Found.
+            max_cached:
+                The number of resolved objects kept across requests, in an
+                LRU. If zero, objects are only kept for the request.
+            max_batch:
+                The maximum number of keys passed to load_many at once, or
+                None for no limit.
+        """
+        self.load_function = load_many
+        self.max_cached = max_cached
+        self.max_batch = max_batch
+        self.calls = 0
+        self.loaded = 0
+        self.hits = 0
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__attribute = '_pystapler_loader_{}'.format(id(self))
+
+    def __scope(self, request):
+        """Returns the _RequestScope of a request.
+
+        Sub-requests of a batch use the scope of the batch request.
+        """
+        request = getattr(request, 'parent', None) or request
+        scope = request.__dict__.get(self.__attribute)
+        if scope is None:
+            # setdefault, so that parallel sub-requests agree on one scope.
+            scope = request.__dict__.setdefault(
+                self.__attribute, _RequestScope())
+        return scope
+
+    def __cached(self, key):
+        """Returns the object the LRU holds for key, or MISSING."""
+        if not self.max_cached:
+            return MISSING
+        with self.__lock:
+            value = self.__cache.pop(key, MISSING)
+            if value is not MISSING:
+                # Re-insert the entry to mark it as the most recently used.
+                self.__cache[key] = value
+                self.hits += 1
+            return value
+
+    def __remember(self, values):
+        """Adds resolved objects to the LRU."""
+        if not self.max_cached:
+            return
+        with self.__lock:
+            for key, value in values.items():
+                self.__cache.pop(key, None)
+                self.__cache[key] = value
+            while len(self.__cache) > self.max_cached:
+                self.__cache.popitem(last=False)
+
+    def __resolve(self, scope, keys):
+        """Resolves keys that the scope does not have, in batches."""
+        with scope.lock:
+            missing = []
+            seen = set()
+            for key in list(keys) + scope.pending:
+                if key in scope.values or key in seen:
+                    continue
+                seen.add(key)
+                value = self.__cached(key)
+                if value is MISSING:
+                    missing.append(key)
+                else:
+                    scope.values[key] = value
+            del scope.pending[:]
+            batch_size = self.max_batch or max(len(missing), 1)
+            for start in range(0, len(missing), batch_size):
+                batch = missing[start:start + batch_size]
+                self.calls += 1
+                self.loaded += len(batch)
+                found = self.load_function(batch) or {}
+                values = dict((key, found.get(key)) for key in batch)
+                self.__remember(dict(
+                    (key, value) for key, value in values.items()
+                    if value is not None))
+                scope.values.update(values)
+            return scope.values
+
+    def load(self, request, key):
+        """Returns the object for key, or None if there is none.
+
+        Any keys deferred in the request are looked up in the same call.
+        """
+        scope = self.__scope(request)
+        values = scope.values
+        if key in values:
+            return values[key]
+        return self.__resolve(scope, [key])[key]
+
+    def load_many(self, request, keys):
+        """Returns the objects for keys, in order, in as few calls as possible.
+
+        Keys that have no object resolve to None.
+        """
+        keys = list(keys)
+        values = self.__resolve(self.__scope(request), keys)
+        return [values[key] for key in keys]
+
+    def defer(self, request, key):
+        """Returns a handle whose value attribute resolves key.
+
+        Nothing is looked up until the value of one of the request's
+        deferred handles is first needed; then every key deferred so far is
+        looked up together.
+        """
+        scope = self.__scope(request)
+        with scope.lock:
+            if key not in scope.values:
+                scope.pending.append(key)
+        return _Deferred(self, request, key)
+
+    def prime(self, request, key, value):
+        """Records the object for key, so that it is not looked up."""
+        scope = self.__scope(request)
+        with scope.lock:
+            scope.values[key] = value
+
+    def invalidate(self, *keys):
+        """Forgets objects held in the LRU; all of them if no keys are given.
+
+        This does not affect requests in progress.
+        """
+        with self.__lock:
+            if not keys:
+                self.__cache.clear()
+                return
+            for key in keys:
+                self.__cache.pop(key, None)
+
+
+# vim: et ts=4
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements memoization of the objects returned by traversable
+methods.
+
+Example Usage:
+
+    class Root(StaplerRoot):
+        @traversable(memoize=Memo(ttl=300))
+        def users(self, org='default'):
+            # Only called once per Root instance, org and five minutes.
+            return load_users(org)
+
+    # After changing the users of an organization:
+    memoized(Root.users).invalidate(root, 'acme')
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+import weakref
+
+# The value Memo.lookup returns when nothing is memoized.
+MISSING = object()
+
+
+class Memo(object):
+    """Remembers the objects a traversable method returned.
+
+    Results are remembered per object that the method was called on (the
+    parent) and per tuple of argument values. Parents are referenced weakly,
+    so memoizing their children does not keep them alive; a parent that
+    cannot be weakly referenced is simply not memoized.
+
+    Results expire after ttl seconds, if ttl is not None, and each parent
+    keeps at most max_entries results, evicting the least recently used.
+
+    A Memo must only be used for a single method, since results are not
+    told apart by the method that returned them.
+    """
+
+    def __init__(self, ttl=None, max_entries=128):
+        """Creates a memo.
+
+        Parameters:
+            ttl:
+                The number of seconds for which a result is reused, or None
+                to reuse it until it is evicted or invalidated.
+            max_entries:
+                The maximum number of results to keep per parent.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.__parents = weakref.WeakKeyDictionary()
+        self.__lock = threading.Lock()
+
+    def lookup(self, parent, key):
+        """Returns the result remembered for parent and key, or MISSING."""
+        now = time.time()
+        with self.__lock:
+            try:
+                entries = self.__parents.get(parent)
+            except TypeError:
+                # The parent cannot be weakly referenced.
+                entries = None
+            entry = None if entries is None else entries.pop(key, None)
+            if entry is None or (
+                    entry[0] is not None and entry[0] <= now):
+                self.misses += 1
+                return MISSING
+            # Re-insert the entry to mark it as the most recently used.
+            entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def store(self, parent, key, result):
+        """Remembers result for parent and key."""
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self.__lock:
+            try:
+                entries = self.__parents.get(parent)
+                if entries is None:
+                    entries = self.__parents[parent] = OrderedDict()
+            except TypeError:
+                return
+            entries.pop(key, None)
+            entries[key] = (expires, result)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def invalidate(self, *args, **kwargs):
+        """Forgets remembered results.
+
+        With no arguments, every result is forgotten. With only a parent,
+        every result for that parent is forgotten. Otherwise, the remaining
+        arguments are the values of the method's parameters, in the order
+        they are declared, and only the result for them is forgotten.
+        Parameters that have default values may be left out.
+
+        The parent is the first argument, or may be given as the parent
+        keyword argument, in which case every argument is a parameter value.
+        """
+        parent = kwargs.pop('parent', None)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: {}'.format(
+                ', '.join(sorted(kwargs))))
+        if parent is None and args:
+            parent, args = args[0], args[1:]
+        with self.__lock:
+            if parent is None:
+                self.__parents.clear()
+                return
+            try:
+                entries = self.__parents.get(parent)
+            except TypeError:
+                return
+            if entries is None:
+                return
+            if not args:
+                entries.clear()
+                return
+            for key in list(entries):
+                if key[:len(args)] == args:
+                    del entries[key]
+
+
+def memoized(method):
+    """Returns the Memo of a method declared with @traversable(memoize=...).
+
+    Returns None if the method is not memoized.
+    """
+    from pystapler.dispatch import PREFIX
+    return getattr(method, PREFIX + 'memoize', None)
+
+
+# vim: et ts=4
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements collection of per-request timing metrics, and a
+traversable page that exposes them in the Prometheus text format.
+
+Example Usage:
+
+    METRICS = Metrics()
+
+    class Config(StaplerConfig):
+        metrics = METRICS
+
+    class Root(StaplerRoot):
+        config = Config()
+
+        @traversable
+        def metrics(self):
+            return MetricsPage(METRICS)
+
+Every request is then timed, and /metrics serves the results. Requests are
+labelled by route: the names of the methods that were traversed to serve
+them, joined with slashes. For example, a request for /users/42 that is
+handled by a method traversable as "users", which returns an object whose
+@default method is named "show", has the route "users/show". This keeps the
+number of distinct labels bounded by the shape of the application rather
+than by the URLs that clients request.
+
+The following metrics are exported:
+
+    pystapler_request_duration_seconds{route, phase}:
+        A histogram of the time spent on each phase of a request: "params"
+        (parsing the request and building its parameters), "traverse"
+        (calling the methods that lead to the response), "render" (calling
+        the method that returned the response, usually the @default method),
+        "serialize" (starting the response) and "total".
+    pystapler_hop_duration_seconds{route, hop}:
+        A histogram of the time spent in each traversed method.
+    pystapler_responses_total{route, status}:
+        The number of responses sent, by status code.
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+
+from six import iteritems
+
+from werkzeug.wrappers import Response
+
+from pystapler.dispatch import default
+
+
+# Upper bounds of the histogram buckets, in seconds.
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# The route label of requests that did not traverse any method.
+NO_ROUTE = '<none>'
+
+
+class _Histogram(object):
+    """The bucket counts and sum of a histogram, as seen by one thread."""
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self, bucket_count):
+        # One count per bucket, plus one for values above the last bucket.
+        self.counts = [0] * (bucket_count + 1)
+        self.sum = 0.0
+
+
+class _ThreadMetrics(object):
+    """The metrics recorded by a single thread.
+
+    Only the owning thread ever modifies these dictionaries, so recording
+    needs no locks. Other threads only read them, when rendering.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.phases = {}
+        self.hops = {}
+        self.statuses = {}
+
+    def add(self, other):
+        """Adds the metrics of another _ThreadMetrics to these."""
+        for source, target in ((other.phases, self.phases),
+                               (other.hops, self.hops)):
+            # Copy the dictionary first, since its thread may be adding to
+            # it while we iterate.
+            for key, histogram in list(source.items()):
+                total = target.get(key)
+                if total is None:
+                    total = target[key] = _Histogram(
+                        len(histogram.counts) - 1)
+                total.counts = [
+                    a + b for a, b in zip(total.counts, histogram.counts)]
+                total.sum += histogram.sum
+        for key, count in list(other.statuses.items()):
+            self.statuses[key] = self.statuses.get(key, 0) + count
+
+
+class Metrics(object):
+    """Aggregates request timings, per thread, without taking locks.
+
+    Each thread records into its own set of histograms and counters; the
+    per-thread values are only added up when the metrics are rendered. A
+    lock is taken only the first time each thread records anything.
+
+    The metrics of threads that have exited are folded into a single total,
+    the next time a thread records its first request or the metrics are
+    rendered, so a server that keeps replacing its threads does not keep a
+    set of metrics for every thread it ever had.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Creates a metrics collector.
+
+        Parameters:
+            buckets:
+                The upper bounds of the histogram buckets, in seconds, in
+                increasing order.
+        """
+        self.buckets = tuple(buckets)
+        self.__local = threading.local()
+        self.__threads = []
+        self.__exited = _ThreadMetrics()
+        self.__lock = threading.Lock()
+
+    def __thread_metrics(self):
+        """Returns the _ThreadMetrics of the current thread."""
+        thread_metrics = getattr(self.__local, 'metrics', None)
+        if thread_metrics is None:
+            thread_metrics = _ThreadMetrics(threading.current_thread())
+            self.__local.metrics = thread_metrics
+            with self.__lock:
+                self.__prune()
+                self.__threads.append(thread_metrics)
+        return thread_metrics
+
+    def __prune(self):
+        """Folds the metrics of threads that have exited into one total.
+
+        This must be called with the lock held.
+        """
+        live = []
+        for thread_metrics in self.__threads:
+            if thread_metrics.thread.is_alive():
+                live.append(thread_metrics)
+            else:
+                self.__exited.add(thread_metrics)
+        self.__threads = live
+
+    def __observe(self, histograms, key, seconds):
+        """Adds a value to the histogram for key."""
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = _Histogram(len(self.buckets))
+        histogram.counts[bisect_left(self.buckets, seconds)] += 1
+        histogram.sum += seconds
+
+    def record(self, trace, params_time, serialize_time, total_time, status):
+        """Records the timings of one request.
+
+        Parameters:
+            trace:
+                The (member, result, seconds) tuples of the members that
+                were traversed to serve the request, in order.
+            params_time:
+                The seconds spent parsing the request.
+            serialize_time:
+                The seconds spent calling the response object.
+            total_time:
+                The seconds spent on the whole request.
+            status:
+                The status code of the response, or None if not known.
+        """
+        thread_metrics = self.__thread_metrics()
+        route = '/'.join(member.name for member, _, _ in trace) or NO_ROUTE
+        phases = thread_metrics.phases
+        traverse_time, render_time = self.__observe_hops(
+            thread_metrics.hops, route, trace)
+        self.__observe(phases, (route, 'params'), params_time)
+        self.__observe(phases, (route, 'traverse'), traverse_time)
+        self.__observe(phases, (route, 'render'), render_time)
+        self.__observe(phases, (route, 'serialize'), serialize_time)
+        self.__observe(phases, (route, 'total'), total_time)
+        key = (route, str(status))
+        statuses = thread_metrics.statuses
+        statuses[key] = statuses.get(key, 0) + 1
+
+    def __observe_hops(self, hops, route, trace):
+        """Adds the time spent in each traversed member to its histogram.
+
+        Returns:
+            The seconds spent traversing and rendering: members that
+            returned a response are counted as rendering.
+        """
+        traverse_time = 0.0
+        render_time = 0.0
+        for member, result, seconds in trace:
+            self.__observe(hops, (route, member.name), seconds)
+            if callable(result):
+                render_time += seconds
+            else:
+                traverse_time += seconds
+        return traverse_time, render_time
+
+    def __merged(self):
+        """Returns the metrics of all threads, added together."""
+        merged = _ThreadMetrics()
+        with self.__lock:
+            self.__prune()
+            merged.add(self.__exited)
+            threads = list(self.__threads)
+        for thread_metrics in threads:
+            merged.add(thread_metrics)
+        return merged
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        merged = self.__merged()
+        lines = []
+        self.__render_histograms(
+            lines, 'pystapler_request_duration_seconds',
+            'Time spent on each phase of handling a request.',
+            ('route', 'phase'), merged.phases)
+        self.__render_histograms(
+            lines, 'pystapler_hop_duration_seconds',
+            'Time spent in each method traversed to handle a request.',
+            ('route', 'hop'), merged.hops)
+        lines.append(
+            '# HELP pystapler_responses_total Responses sent, by status.')
+        lines.append('# TYPE pystapler_responses_total counter')
+        for key, count in sorted(iteritems(merged.statuses)):
+            lines.append('pystapler_responses_total{{{}}} {}'.format(
+                _labels(zip(('route', 'status'), key)), count))
+        return '\n'.join(lines) + '\n'
+
+    def __render_histograms(self, lines, name, description, label_names,
+                            histograms):
+        """Appends the lines describing a family of histograms to lines."""
+        # pylint: disable=too-many-arguments
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} histogram'.format(name))
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for key in sorted(histograms):
+            histogram = histograms[key]
+            labels = list(zip(label_names, key))
+            cumulative = 0
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    name, _labels(labels + [('le', bound)]), cumulative))
+            lines.append('{}_sum{{{}}} {!r}'.format(
+                name, _labels(labels), histogram.sum))
+            lines.append('{}_count{{{}}} {}'.format(
+                name, _labels(labels), cumulative))
+
+
+def _labels(pairs):
+    """Formats (name, value) pairs as a Prometheus label list."""
+    return ','.join(
+        '{}="{}"'.format(name, value.replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+
+def render_samples(samples):
+    """Renders samples of metrics in the Prometheus text format.
+
+    Each metric gets its HELP and TYPE lines once, followed by all of its
+    samples, as Prometheus requires, however the samples are ordered. This
+    is how collectors such as pystapler.admission.Limiter render their
+    metrics, and how MetricsPage renders those of several collectors that
+    export the same metrics.
+
+    Parameters:
+        samples:
+            An iterable of (name, kind, description, labels, value) tuples,
+            where kind is the metric type, such as "gauge" or "counter", and
+            labels is a list of (label name, value) pairs.
+    """
+    families = OrderedDict()
+    for name, kind, description, labels, value in samples:
+        family = families.get(name)
+        if family is None:
+            family = families[name] = (kind, description, [])
+        family[2].append((labels, value))
+    lines = []
+    for name, (kind, description, family) in iteritems(families):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in family:
+            lines.append('{}{{{}}} {}'.format(name, _labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsPage(object):
+    """A traversable object that renders a Metrics object for Prometheus.
+
+    Any further arguments are other collectors whose metrics are rendered
+    after those of the Metrics object, such as pystapler.tasks.TaskQueue
+    and pystapler.admission.Limiter objects. Each must have either a
+    metric_samples() method that returns samples as render_samples() takes
+    them, so that the samples of collectors exporting the same metrics are
+    rendered together, or a render_metrics() method that returns metrics in
+    the Prometheus text format.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, metrics, *collectors):
+        self.metrics = metrics
+        self.collectors = collectors
+
+    @default
+    def render(self):
+        """Renders the metrics in the Prometheus text format."""
+        texts = [self.metrics.render()]
+        samples = []
+        for collector in self.collectors:
+            metric_samples = getattr(collector, 'metric_samples', None)
+            if metric_samples is not None:
+                samples.extend(metric_samples())
+            else:
+                texts.append(collector.render_metrics())
+        if samples:
+            texts.append(render_samples(samples))
+        return Response(''.join(texts), content_type=CONTENT_TYPE)
+
+
+# vim: et ts=4
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements reloading changed modules without restarting.
+
+In debug mode, main() serves the application through a Reloader (unless
+StaplerConfig.hot_reload is turned off, in which case Werkzeug's reloader
+restarts the whole interpreter on every change). Before each request, at
+most once per interval, the Reloader checks the modification times of the
+application's modules, and re-executes the ones that changed.
+
+Classes defined in a re-executed module are updated in place: the old class
+object receives the new class's methods and attributes, and the module's
+name for it is pointed back at the old class object. So objects that
+already exist, most importantly the StaplerRoot and whatever it holds, keep
+their state and start using the new code, and other modules that imported
+the class see the new code too. Functions defined at the top level of the
+module are updated in place in the same way, where possible. The traversal
+maps (and with them the argument binders) of the updated classes and their
+subclasses, and the route plans of the root, are dropped, to be rebuilt on
+the next request; those of every other class are kept.
+
+Some changes cannot be applied this way, such as changing the base classes
+of a class; those still need a restart.
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+import logging
+import os
+import sys
+import threading
+import types
+
+from six import iteritems
+from six.moves import reload_module
+
+from pystapler.accesslog import _timer
+from pystapler.dispatch import PREFIX, _invalidate_traversal_map
+
+LOGGER = logging.getLogger(__name__)
+
+# Class attributes that are never copied from a re-executed class.
+_UNCOPIED_ATTRIBUTES = frozenset(['__dict__', '__weakref__'])
+
+# The name the __main__ module is re-executed under, so that its
+# "if __name__ == '__main__'" block does not run again.
+_RELOADING_MAIN = '__pystapler_reloading_main__'
+
+
+class ReloadReport(object):
+    """The result of Reloader.reload().
+
+    Attributes:
+        modules:
+            The names of the modules that were re-executed.
+        classes:
+            The classes that were updated in place.
+        failed:
+            The names of the modules that could not be re-executed, because
+            they raised an exception; their old code is still in use.
+        seconds:
+            How long the reload took.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.modules = []
+        self.classes = []
+        self.failed = []
+        self.seconds = 0.0
+
+
+def _source_file(module):
+    """Returns the path of a module's source file, or None."""
+    path = getattr(module, '__file__', None)
+    if not path:
+        return None
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    if not path.endswith('.py'):
+        # Extension modules cannot be reloaded.
+        return None
+    return os.path.abspath(path)
+
+
+def _default_directory(root):
+    """Returns the directory of the package that defines a root's class."""
+    module = sys.modules[type(root).__module__]
+    top_level = sys.modules.get(module.__name__.split('.')[0], module)
+    path = _source_file(top_level) or _source_file(module)
+    if path is None:
+        return os.getcwd()
+    return os.path.dirname(path)
+
+
+def _functions(value):
+    """Yields the functions that make up a class attribute.
+
+    This includes the functions wrapped by decorators that set __wrapped__,
+    and the functions underlying static methods, class methods and
+    properties.
+    """
+    if isinstance(value, (staticmethod, classmethod)):
+        value = value.__func__
+    if isinstance(value, property):
+        for accessor in (value.fget, value.fset, value.fdel):
+            for function in _functions(accessor):
+                yield function
+        return
+    seen = set()
+    while isinstance(value, types.FunctionType) and id(value) not in seen:
+        seen.add(id(value))
+        yield value
+        value = getattr(value, '__wrapped__', None)
+
+
+def _rebind_class_cell(value, new_class, old_class):
+    """Points the __class__ cells of a class's functions at old_class.
+
+    Functions that use zero-argument super() refer to their class through a
+    __class__ cell, which would otherwise still refer to the new class.
+    """
+    for function in _functions(value):
+        code = function.__code__
+        if '__class__' not in code.co_freevars or not function.__closure__:
+            continue
+        cell = function.__closure__[code.co_freevars.index('__class__')]
+        if cell.cell_contents is new_class:
+            try:
+                cell.cell_contents = old_class
+            except (AttributeError, TypeError):
+                # Cells are only writable on Python 3.7 and later.
+                LOGGER.warning(
+                    'Cannot update super() in %s; restart to apply it',
+                    function.__name__)
+
+
+def _update_class(old_class, new_class):
+    """Copies the attributes of new_class onto old_class."""
+    if old_class.__bases__ != new_class.__bases__:
+        LOGGER.warning(
+            'The base classes of %s changed; restart to apply this',
+            old_class.__name__)
+    old_attributes = vars(old_class)
+    new_attributes = vars(new_class)
+    for name in list(old_attributes):
+        if (name not in new_attributes and name not in _UNCOPIED_ATTRIBUTES
+                and not name.startswith(PREFIX)):
+            delattr(old_class, name)
+    for name, value in list(iteritems(new_attributes)):
+        if name in _UNCOPIED_ATTRIBUTES or name.startswith(PREFIX):
+            continue
+        _rebind_class_cell(value, new_class, old_class)
+        try:
+            setattr(old_class, name, value)
+        except (AttributeError, TypeError):
+            LOGGER.warning(
+                'Cannot update %s.%s; restart to apply it',
+                old_class.__name__, name)
+
+
+def _update_function(old_function, new_function):
+    """Gives old_function the code of new_function, if possible.
+
+    Returns:
+        True if old_function was updated.
+    """
+    if (len(old_function.__code__.co_freevars)
+            != len(new_function.__code__.co_freevars)):
+        return False
+    old_function.__code__ = new_function.__code__
+    old_function.__defaults__ = new_function.__defaults__
+    old_function.__doc__ = new_function.__doc__
+    old_function.__dict__.update(new_function.__dict__)
+    return True
+
+
+def _reexecute(module):
+    """Executes the current source of a module again, in its namespace."""
+    if module.__name__ != '__main__':
+        reload_module(module)
+        return
+    # The main script cannot be reloaded by name, so run its source again,
+    # under another name, so that it does not start another server.
+    with open(_source_file(module)) as source_file:
+        code = compile(source_file.read(), module.__file__, 'exec')
+    namespace = vars(module)
+    namespace['__name__'] = _RELOADING_MAIN
+    try:
+        exec(code, namespace)  # pylint: disable=exec-used
+    finally:
+        namespace['__name__'] = '__main__'
+
+
+class Reloader(object):
+    """A WSGI application that reloads changed modules of another one.
+
+    The reloads attribute lists the ReloadReport of every reload so far.
+    """
+
+    def __init__(self, root, directory=None, interval=1.0):
+        """Creates a reloader.
+
+        Parameters:
+            root:
+                The StaplerRoot to serve.
+            directory:
+                The modules whose source files are in this directory, or
+                below it, are watched. By default, this is the directory of
+                the package (or script) that defines the root's class.
+            interval:
+                The minimum number of seconds between checks for changes.
+        """
+        self.root = root
+        self.directory = os.path.abspath(
+            directory or _default_directory(root))
+        self.interval = interval
+        self.reloads = []
+        self.__mtimes = {}
+        self.__last_check = _timer()
+        self.__lock = threading.Lock()
+        self.__scan()
+
+    def __call__(self, environ, start_response):
+        """Implements the WSGI application protocol."""
+        if _timer() - self.__last_check >= self.interval:
+            self.check()
+        return self.root(environ, start_response)
+
+    def __watched_modules(self):
+        """Yields (module, source path) pairs for the watched modules."""
+        prefix = os.path.join(self.directory, '')
+        for module in list(sys.modules.values()):
+            if not isinstance(module, types.ModuleType):
+                continue
+            if module.__name__.split('.')[0] == 'pystapler':
+                continue
+            path = _source_file(module)
+            if path is not None and path.startswith(prefix):
+                yield module, path
+
+    def __scan(self):
+        """Returns the watched modules that changed since the last scan."""
+        changed = []
+        for module, path in self.__watched_modules():
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            previous = self.__mtimes.get(module.__name__)
+            self.__mtimes[module.__name__] = mtime
+            if previous is not None and previous != mtime:
+                changed.append(module)
+        return changed
+
+    def check(self):
+        """Reloads the watched modules that changed, if any.
+
+        Returns:
+            A ReloadReport, or None if nothing changed.
+        """
+        with self.__lock:
+            self.__last_check = _timer()
+            changed = self.__scan()
+            if not changed:
+                return None
+            return self.reload(changed)
+
+    def reload(self, modules):
+        """Re-executes modules, and updates their classes in place.
+
+        Returns:
+            A ReloadReport.
+        """
+        report = ReloadReport()
+        started = _timer()
+        for module in modules:
+            namespace = vars(module)
+            classes = dict(
+                (name, value) for name, value in iteritems(namespace)
+                if isinstance(value, type)
+                and value.__module__ == module.__name__)
+            functions = dict(
+                (name, value) for name, value in iteritems(namespace)
+                if isinstance(value, types.FunctionType)
+                and value.__module__ == module.__name__)
+            try:
+                _reexecute(module)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Failed to reload %s', module.__name__)
+                report.failed.append(module.__name__)
+                # Whatever the failed execution left behind is undone.
+                namespace.update(classes)
+                namespace.update(functions)
+                continue
+            report.modules.append(module.__name__)
+            for name, old_class in iteritems(classes):
+                new_class = namespace.get(name)
+                if not isinstance(new_class, type) or new_class is old_class:
+                    continue
+                _update_class(old_class, new_class)
+                namespace[name] = old_class
+                _invalidate_traversal_map(old_class)
+                report.classes.append(old_class)
+            for name, old_function in iteritems(functions):
+                new_function = namespace.get(name)
+                if (isinstance(new_function, types.FunctionType)
+                        and new_function is not old_function
+                        and _update_function(old_function, new_function)):
+                    namespace[name] = old_function
+        if report.classes:
+            _invalidate_traversal_map(type(self.root))
+        report.seconds = _timer() - started
+        self.reloads.append(report)
+        LOGGER.info(
+            'Reloaded %s in %.1fms; updated %d classes',
+            ', '.join(report.modules) or 'nothing',
+            report.seconds * 1000, len(report.classes))
+        return report
+
+
+# vim: et ts=4
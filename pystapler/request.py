@@ -7,21 +7,276 @@ Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
 See the LICENSE file for licensing details.
 """
 
+import json
+import tempfile
 
-class RequestParams(dict):
+from six.moves import collections_abc
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from pystapler.config import StaplerConfig
+
+
+# Size of the chunks in which a request body is copied into a spool file.
+_CHUNK_SIZE = 64 * 1024
+
+def _parse_json(request):
+    """Returns the parsed JSON body of a request, or None.
+
+    Werkzeug has had Request.get_json since 0.15, but only in JSONMixin,
+    which its Request class does not include before 1.0; dispatching builds
+    plain Request objects, so the body is parsed here instead.
+    """
+    mimetype = request.mimetype
+    if mimetype != 'application/json' and not (
+            mimetype.startswith('application/')
+            and mimetype.endswith('+json')):
+        return None
+    try:
+        return json.loads(request.get_data(as_text=True))
+    except ValueError:
+        return None
+
+
+def check_body_size(request, max_body_size):
+    """Raises RequestEntityTooLarge if a request declares too big a body.
+
+    This only looks at the Content-Length header, so it is cheap enough to
+    do before dispatching, without reading any of the body.
+    """
+    if max_body_size is None:
+        return
+    content_length = request.content_length
+    if content_length is not None and content_length > max_body_size:
+        raise RequestEntityTooLarge()
+
+
+def _spool_body(request, memory_size, max_size, directory):
+    """Copies a request body into a spooled temporary file.
+
+    The body is read from the WSGI input a chunk at a time. It is kept in
+    memory while it is smaller than memory_size bytes, and written to a
+    temporary file in directory after that.
+
+    Raises:
+        RequestEntityTooLarge: if the body is longer than max_size bytes,
+            even if it did not declare its length.
+    """
+    check_body_size(request, max_size)
+    spool = tempfile.SpooledTemporaryFile(
+        max_size=memory_size, dir=directory)
+    stream = request.stream
+    length = 0
+    while True:
+        chunk = stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        length += len(chunk)
+        if max_size is not None and length > max_size:
+            spool.close()
+            raise RequestEntityTooLarge()
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+# Parameters that are derived from the request itself rather than from the
+# query string. Each value is a function that computes the parameter from
+# the RequestParams object. These take precedence over query string
+# parameters with the same name.
+_INJECTABLES = {
+    'request': lambda params: params.request,
+    'args': lambda params: params.request.args,
+    'form': lambda params: params.request.form,
+    'json': lambda params: params.json,
+    'stream': lambda params: params.stream,
+    'files': lambda params: params.request.files,
+}
+
+# The injectables that read the request body. They are only computed for
+# methods that name them, never to fill **kwargs.
+_BODY_INJECTABLES = frozenset(['form', 'json', 'stream', 'files'])
+
+
+class RequestParams(collections_abc.Mapping):
     """Injectable parameters of a request.
 
-    TODO(dpryden): Document the parameters available in this dictionary.
+    This is a read-only mapping containing the following keys:
+
+        request:
+            The Werkzeug Request object for the current request.
+        args:
+            The query string parameters, as a Werkzeug MultiDict. This can be
+            used to get all the values of a multi-valued parameter, using
+            args.getlist(name).
+        form:
+            The form data in the request body, as a Werkzeug MultiDict.
+        json:
+            The parsed JSON request body, or None if the request does not
+            have a JSON content type or the body is not valid JSON.
+        stream:
+            The raw request body, as a binary file object positioned at the
+            start. The body is read from the client into a spooled temporary
+            file, which is only written to disk if the body is bigger than
+            StaplerConfig.spool_memory_size. The file is closed when the
+            response has been sent.
+        files:
+            The files uploaded in a multipart/form-data body, as a Werkzeug
+            MultiDict of FileStorage objects. Werkzeug's parser writes the
+            files of a large body to temporary files as it reads them from
+            the client.
+        any other name:
+            The path segment bound to that name by a @traversable_dynamic
+            method earlier in the traversal, if any, or else the first value
+            of the query string parameter with that name.
+
+    The names above are reserved: they always mean the injectable, even if
+    the query string has a parameter with the same name. A query string
+    parameter named, say, "json" or "files" can still be read through args,
+    as args['json'] or args.getlist('files').
+
+    The mapping is lazy: nothing is read from the request until a key is
+    looked up, so in particular the request body is only read if a method
+    asks for the form, json, stream or files parameter. Since the body can
+    only be read once, a method should ask for only one of those.
+
+    The limits in the StaplerConfig (max_body_size, max_form_memory_size)
+    are applied to the request; a body that exceeds them is rejected with
+    413 Request Entity Too Large.
     """
-    # pylint: disable=too-few-public-methods
-    # TODO(dpryden): Make this lazy rather than eager?
-
-    def __init__(self, request):
-        dict.__init__(self)
-        for parameter in request.args:
-            self[parameter] = request.args[parameter]
-        self['request'] = request
-        self['form'] = request.form
+
+    __json = None
+    __json_parsed = False
+    __stream = None
+    __segments = None
+
+    def __init__(self, request, config=None):
+        """Creates the parameters of a request.
+
+        Parameters:
+            request:
+                The Werkzeug request.
+            config:
+                The StaplerConfig whose limits apply to the request body. If
+                not given, the defaults of StaplerConfig are used.
+        """
+        if config is None:
+            config = StaplerConfig
+        self.__request = request
+        self.__config = config
+        # Where objects returned by traversed methods are shared with other
+        # requests, as they are between the sub-requests of a batch.
+        self.shared_results = getattr(request, 'shared_results', None)
+        request.max_content_length = config.max_body_size
+        request.max_form_memory_size = config.max_form_memory_size
+
+    @property
+    def request(self):
+        """The Werkzeug Request object these parameters are derived from."""
+        return self.__request
+
+    @property
+    def config(self):
+        """The StaplerConfig of the application serving the request."""
+        return self.__config
+
+    @property
+    def json(self):
+        """The parsed JSON request body, or None. Parsed at most once."""
+        if not self.__json_parsed:
+            self.__json = _parse_json(self.__request)
+            self.__json_parsed = True
+        return self.__json
+
+    @property
+    def stream(self):
+        """The request body, as a spooled file. Read at most once."""
+        if self.__stream is None:
+            config = self.__config
+            self.__stream = _spool_body(
+                self.__request, config.spool_memory_size,
+                config.max_body_size, config.spool_directory)
+        return self.__stream
+
+    @property
+    def spooled(self):
+        """Whether the stream parameter was computed, spooling the body."""
+        return self.__stream is not None
+
+    def close(self):
+        """Closes the spooled request body, if there is one."""
+        if self.__stream is not None:
+            self.__stream.close()
+
+    def bind_segment(self, name, value):
+        """Binds a path segment to a parameter name, for later methods."""
+        if self.__segments is None:
+            self.__segments = {}
+        self.__segments[name] = value
+
+    def __getitem__(self, key):
+        injectable = _INJECTABLES.get(key)
+        if injectable is not None:
+            return injectable(self)
+        segments = self.__segments
+        if segments is not None and key in segments:
+            return segments[key]
+        args = self.__request.args
+        if key in args:
+            return args[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        """Returns the parameter named key, or default if there is none.
+
+        A reserved name returns the injectable, as with self[key], rather
+        than a query string parameter of the same name.
+        """
+        injectable = _INJECTABLES.get(key)
+        if injectable is not None:
+            return injectable(self)
+        segments = self.__segments
+        if segments is not None and key in segments:
+            return segments[key]
+        return self.__request.args.get(key, default)
+
+    def keyword_arguments(self):
+        """Returns the parameters to pass to a method that takes **kwargs.
+
+        This is a dictionary of every parameter except those that read the
+        request body, so that such a method does not consume the body, or
+        parse it, on every request.
+        """
+        kwargs = dict(
+            (key, self.__request.args[key]) for key in self.__request.args)
+        if self.__segments:
+            kwargs.update(self.__segments)
+        for key, injectable in _INJECTABLES.items():
+            if key not in _BODY_INJECTABLES:
+                kwargs[key] = injectable(self)
+        return kwargs
+
+    def getlist(self, key):
+        """Returns all the values of a query string parameter, as a list."""
+        return self.__request.args.getlist(key)
+
+    def __contains__(self, key):
+        return (key in _INJECTABLES or key in (self.__segments or ())
+                or key in self.__request.args)
+
+    def __iter__(self):
+        segments = self.__segments or {}
+        for key in self.__request.args:
+            if key not in _INJECTABLES and key not in segments:
+                yield key
+        for key in segments:
+            if key not in _INJECTABLES:
+                yield key
+        for key in _INJECTABLES:
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
 
 
 # vim: et ts=4
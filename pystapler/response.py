@@ -9,12 +9,81 @@ Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
 See the LICENSE file for licensing details.
 """
 
+import functools
+import inspect
+import io
+import json
+import mmap
+import os
+import types
+
 from decorator import decorator
+import six
 
 from werkzeug.wrappers import Response
+from werkzeug.wsgi import FileWrapper, wrap_file
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional; without it, JSON is encoded with the json module.
+    orjson = None
+
+
+# Python 2 has no coroutine functions.
+_iscoroutinefunction = getattr(
+    inspect, 'iscoroutinefunction', lambda function: False)
+
+
+# Size of the chunks in which files and buffers are sent.
+_CHUNK_SIZE = 64 * 1024
+
+# Types of results that are sent to the client as the response body.
+PASSTHROUGH_TYPES = (
+    bytes, bytearray, memoryview, io.IOBase, mmap.mmap, types.GeneratorType)
+if six.PY2:
+    PASSTHROUGH_TYPES += (file,)  # pylint: disable=undefined-variable
+
+
+def _transform_result(method, transform):
+    """Decorates a method to return transform(result) instead of result.
+
+    If the method was defined with "async def", the decorated method is a
+    coroutine function too.
+    """
+    if _iscoroutinefunction(method):
+        from pystapler.asgi import decorate_coroutine
+        return decorate_coroutine(method, transform)
+
+    @decorator
+    def decorator_closure(method, *args, **kwargs):
+        """Decorator closure that applies the transform."""
+        return transform(method(*args, **kwargs))
+    return decorator_closure(method)
+
 
+def _buffered(chunks, buffer_size, empty=u''):
+    """Joins consecutive chunks of text until they reach buffer_size.
 
-def template(template_environment, template_name):
+    Template engines typically generate output in many tiny pieces, each of
+    which would otherwise be written to the client separately. The chunks
+    may be bytes instead of text, if empty is b''.
+    """
+    buffered = []
+    buffered_length = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        buffered_length += len(chunk)
+        if buffered_length >= buffer_size:
+            yield empty.join(buffered)
+            buffered = []
+            buffered_length = 0
+    if buffered:
+        yield empty.join(buffered)
+
+
+def template(template_environment, template_name, stream=False,
+             buffer_size=8192, content_type='text/html; charset=utf-8'):
     """Decorates a method that renders its response using a template.
 
     Parameters:
@@ -23,7 +92,8 @@ def template(template_environment, template_name):
             rendered to HTML. This can be a Jinja2 Environment object, or it
             can be any other template environment, as long as it has a
             get_template() method that takes a string and returns an object
-            that has a method named render().
+            that has a method named render() (and, for streaming, a method
+            named generate() that returns an iterable of strings).
 
             The decorated function is expected to return a mapping object
             which will provide keyword arguments to be passed to the render()
@@ -31,36 +101,302 @@ def template(template_environment, template_name):
 
         template_name:
             The name of the template. The corresponding template object will
-            be looked up from the environment using this name.
+            be looked up from the environment using this name, when the
+            method is first called, so that importing a module does not
+            compile its templates. If the environment has a true auto_reload
+            attribute (as a Jinja2 environment in debug mode does), it is
+            looked up on every call instead, so that changes are noticed.
+
+        stream:
+            If true, the template is rendered incrementally while the
+            response is being sent, using the generate() method of the
+            template object, so that the beginning of the page reaches the
+            client before the rest of it has been rendered. Note that an
+            error while rendering a streamed template can only truncate the
+            response, since the status line has already been sent.
+
+        buffer_size:
+            When streaming, the number of characters to accumulate before
+            sending them to the client. If zero or None, every piece of
+            text the template generates is sent as soon as it is generated.
+
+        content_type:
+            The Content-Type of the response.
 
     Example Usage:
 
-        env = jinja2.Environment(...)
+        env = pystapler.jinja.JinjaEnvironment('templates')
 
         @template(env, 'my_template.html')
         def render_my_template(self):
             return {'spam': 1, 'eggs', 2}
 
+        @template(env, 'huge_listing.html', stream=True)
+        def render_huge_listing(self):
+            return {'items': self.items}
+
     """
-    template_obj = template_environment.get_template(template_name)
+    loaded = []
 
-    @decorator
-    def decorator_closure(method, *args, **kwargs):
+    def get_template():
+        """Returns the template object, looking it up on first use."""
+        if getattr(template_environment, 'auto_reload', False):
+            return template_environment.get_template(template_name)
+        if not loaded:
+            # Two threads may both look it up; either result will do.
+            loaded.append(template_environment.get_template(template_name))
+        return loaded[0]
+
+    def render(template_vars):
+        """Renders the template with the variables a method returned."""
+        return Response(
+            response=get_template().render(**template_vars),
+            content_type=content_type)
+
+    def render_stream(template_vars):
+        """Streams the template with the variables a method returned."""
+        chunks = get_template().generate(**template_vars)
+        if buffer_size:
+            chunks = _buffered(chunks, buffer_size)
+        return Response(response=chunks, content_type=content_type)
+
+    def decorator_closure(method):
         """@template decorator closure."""
-        template_vars = method(*args, **kwargs)
-        return template_obj.render(**template_vars)
+        return _transform_result(method, render_stream if stream else render)
+
+    return decorator_closure
+
+
+class _FileResponse(Response):
+    """A response whose body is read from a file object.
+
+    When the response is sent, the file is handed to the server's
+    wsgi.file_wrapper, which lets servers that support it send the file
+    with sendfile(), without the contents passing through Python.
+    """
+
+    def __init__(self, file_obj, content_type):
+        self.__file = file_obj
+        self.__file_wrapper = FileWrapper(file_obj, _CHUNK_SIZE)
+        Response.__init__(
+            self, self.__file_wrapper, content_type=content_type,
+            direct_passthrough=True)
+        content_length = _remaining_length(file_obj)
+        if content_length is not None:
+            self.headers['Content-Length'] = str(content_length)
+
+    def get_app_iter(self, environ):
+        """Returns the file, wrapped with the server's wsgi.file_wrapper."""
+        if (self.response is self.__file_wrapper
+                and self.status_code == 200
+                and environ['REQUEST_METHOD'] != 'HEAD'):
+            return wrap_file(environ, self.__file, _CHUNK_SIZE)
+        return Response.get_app_iter(self, environ)
+
+
+def _remaining_length(file_obj):
+    """Returns the number of bytes left to read from a file, or None."""
+    if isinstance(file_obj, mmap.mmap):
+        return len(file_obj) - file_obj.tell()
+    try:
+        return os.fstat(file_obj.fileno()).st_size - file_obj.tell()
+    except (AttributeError, EnvironmentError, ValueError,
+            io.UnsupportedOperation):
+        # Not a regular file, such as a pipe or an in-memory buffer.
+        return None
+
+
+def _buffer_chunks(view):
+    """Yields the contents of a memoryview as bytes, a chunk at a time."""
+    for start in range(0, len(view), _CHUNK_SIZE):
+        yield view[start:start + _CHUNK_SIZE].tobytes()
 
+
+def _passthrough_response(result, content_type='application/octet-stream'):
+    """Returns a response that sends result as the response body.
+
+    The result must be an instance of one of the PASSTHROUGH_TYPES:
+
+        bytes:
+            Sent as is, without being copied.
+        bytearray, memoryview:
+            Sent without being copied if the buffer covers a whole bytes
+            object, and otherwise in chunks, so that the whole body is never
+            copied at once.
+        a file object or mmap:
+            Sent with wsgi.file_wrapper, from the current position to the
+            end, and then closed.
+        a generator:
+            Streamed to the client as it generates chunks of bytes or text,
+            without a Content-Length, so that HTTP/1.1 servers send it with
+            chunked encoding.
+    """
+    if isinstance(result, bytes):
+        response = Response(
+            [result], content_type=content_type, direct_passthrough=True)
+        response.headers['Content-Length'] = str(len(result))
+        return response
+    if isinstance(result, (bytearray, memoryview)):
+        view = memoryview(result)
+        if view.ndim != 1 or view.itemsize != 1:
+            view = view.cast('B')
+        underlying = getattr(view, 'obj', None)
+        if isinstance(underlying, bytes) and len(view) == len(underlying):
+            chunks = [underlying]
+        else:
+            chunks = _buffer_chunks(view)
+        response = Response(
+            chunks, content_type=content_type, direct_passthrough=True)
+        response.headers['Content-Length'] = str(len(view))
+        return response
+    if isinstance(result, types.GeneratorType):
+        return Response(result, content_type=content_type)
+    return _FileResponse(result, content_type)
+
+
+def binary(obj=None, content_type='application/octet-stream'):
+    """Decorates a method that returns the body of a binary response.
+
+    The method may return bytes, a bytearray, a memoryview, a file object,
+    an mmap or a generator; see PASSTHROUGH_TYPES. The result is sent with
+    the given Content-Type, without being copied where possible.
+
+    Methods that are not decorated can return such results too, in which
+    case they are sent as application/octet-stream.
+
+    Example Usage:
+
+        @traversable
+        @binary(content_type='image/png')
+        def thumbnail(self):
+            return open(self.thumbnail_path, 'rb')
+    """
+    if callable(obj):
+        # Used as a bare @binary decorator.
+        return binary()(obj)
+
+    def transform(result):
+        """Turns the result of the decorated method into a response."""
+        return _passthrough_response(result, content_type)
+
+    def decorator_closure(method):
+        """@binary decorator closure."""
+        return _transform_result(method, transform)
     return decorator_closure
 
 
-@decorator
-def plaintext(method, *args, **kwargs):
+def _json_encoder(default):
+    """Returns a function that encodes a value as JSON, in UTF-8 bytes.
+
+    The orjson package is used if it is installed, and the json module
+    otherwise. The default function is called for values that cannot be
+    encoded otherwise, as with json.dumps. Either way, dictionary keys that
+    are not strings, such as numbers, are converted to strings.
+    """
+    if orjson is not None:
+        return functools.partial(
+            orjson.dumps, default=default, option=orjson.OPT_NON_STR_KEYS)
+    encode = json.JSONEncoder(separators=(',', ':'), default=default).encode
+    return lambda value: encode(value).encode('utf-8')
+
+
+def _json_array(encode, records):
+    """Yields a JSON array of records, one piece at a time."""
+    separator = b'['
+    for record in records:
+        yield separator
+        yield encode(record)
+        separator = b','
+    yield b'[]' if separator == b'[' else b']'
+
+
+def _json_lines(encode, records):
+    """Yields newline-delimited JSON records, one piece at a time."""
+    for record in records:
+        yield encode(record)
+        yield b'\n'
+
+
+def json_response(obj=None, ndjson=False, default=None, buffer_size=8192,
+                  content_type=None):
+    """Decorates a method whose result is sent as a JSON response.
+
+    The result is encoded with orjson, if it is installed, or with the json
+    module otherwise. If the method returns a generator, the records it
+    generates are encoded and sent one by one while the response is being
+    sent, as the elements of a JSON array, so a large result never has to be
+    held in memory all at once. As with streamed templates, an error while
+    generating records can only truncate the response.
+
+    Parameters:
+        ndjson:
+            If true, the result (which should be a generator or a list) is
+            sent as newline-delimited JSON, one record per line, with the
+            content type application/x-ndjson.
+        default:
+            A function that converts values JSON cannot represent, such as
+            datetimes, into ones it can, as with json.dumps.
+        buffer_size:
+            When streaming, the number of bytes to accumulate before sending
+            them to the client. If zero or None, every record is sent as
+            soon as it is encoded.
+        content_type:
+            The Content-Type of the response, if not the standard one.
+
+    Example Usage:
+
+        @default
+        @json_response
+        def render(self):
+            return {'name': self.name, 'tags': self.tags}
+
+        @traversable
+        @json_response(ndjson=True)
+        def export(self):
+            for row in self.db.execute('SELECT * FROM events'):
+                yield dict(row)
+    """
+    if callable(obj):
+        # Used as a bare @json_response decorator.
+        return json_response()(obj)
+    encode = _json_encoder(default)
+    if content_type is None:
+        content_type = (
+            'application/x-ndjson' if ndjson else 'application/json')
+
+    def transform(result):
+        """Turns the result of the decorated method into a response."""
+        if ndjson:
+            chunks = _json_lines(encode, result)
+        elif isinstance(result, types.GeneratorType):
+            chunks = _json_array(encode, result)
+        else:
+            body = encode(result)
+            response = Response(
+                [body], content_type=content_type, direct_passthrough=True)
+            response.headers['Content-Length'] = str(len(body))
+            return response
+        if buffer_size:
+            chunks = _buffered(chunks, buffer_size, b'')
+        return Response(chunks, content_type=content_type)
+
+    def decorator_closure(method):
+        """@json_response decorator closure."""
+        return _transform_result(method, transform)
+    return decorator_closure
+
+
+def _plaintext_response(text):
+    """Returns a text/plain response containing text."""
+    return Response(response=text, content_type='text/plain')
+
+
+def plaintext(method):
     """Decorates a method that returns a string.
 
     The returned string is served as a text/plain response.
     """
-    text = method(*args, **kwargs)
-    return Response(response=text, content_type='text/plain')
+    return _transform_result(method, _plaintext_response)
 
 
 # vim: et ts=4
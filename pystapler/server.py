@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements a pre-forking, multi-threaded HTTP server for running
+an application in production without an external WSGI server.
+
+A master process binds the listening socket and forks a configurable number
+of worker processes, which share that socket. Each worker accepts
+connections on its main thread and handles them on a fixed pool of threads.
+The master restarts any worker that exits, which lets workers be recycled
+after a configurable number of requests.
+
+Signals handled by the master process:
+
+    SIGTERM, SIGINT:
+        Graceful shutdown: workers stop accepting connections, finish the
+        requests they are handling and the tasks on StaplerConfig.task_queues,
+        and exit; any worker still running after
+        StaplerConfig.graceful_timeout seconds is killed.
+    SIGHUP:
+        Graceful restart of all the workers.
+
+The server is normally started through pystapler.dispatch.main(), which uses
+it when StaplerConfig.workers is non-zero and debug mode is off.
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+import errno
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+from six.moves import queue
+
+from werkzeug.serving import BaseWSGIServer
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of seconds between checks for signals and exited workers.
+_POLL_INTERVAL = 0.2
+
+# A worker that exits within this many seconds of starting is assumed to be
+# failing on startup, and is not restarted until this much time has passed.
+_MIN_WORKER_LIFETIME = 1.0
+
+
+def _bind(config):
+    """Creates the listening socket described by a StaplerConfig."""
+    address_info = socket.getaddrinfo(
+        config.host, config.port, 0, socket.SOCK_STREAM)[0]
+    sock = socket.socket(address_info[0], socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if config.reuse_port and hasattr(socket, 'SO_REUSEPORT'):
+        # Allows a new server to bind the same port while an old one is
+        # still draining, for zero-downtime restarts.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address_info[4])
+    sock.listen(config.backlog)
+    return sock
+
+
+class _WorkerServer(BaseWSGIServer):
+    """A WSGI server that handles connections on a fixed pool of threads.
+
+    Accepted connections are handed to the pool through a bounded queue, so
+    when every thread is busy the worker stops accepting connections, which
+    leaves them in the shared socket's backlog for other workers.
+    """
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, config, application, listen_socket):
+        BaseWSGIServer.__init__(
+            self, config.host, 0, application, fd=listen_socket.fileno())
+        self.timeout = _POLL_INTERVAL
+        self.requests_handled = 0
+        self.__queue = queue.Queue(maxsize=config.threads)
+        self.__threads = [
+            threading.Thread(
+                target=self.__handle_connections,
+                name='pystapler-worker-{}'.format(index))
+            for index in range(config.threads)]
+        for thread in self.__threads:
+            thread.daemon = True
+            thread.start()
+
+    def __handle_connections(self):
+        """Thread pool loop: handles connections until given None."""
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:  # pylint: disable=broad-except
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        """Hands an accepted connection to the thread pool."""
+        self.requests_handled += 1
+        self.__queue.put((request, client_address))
+
+    def drain(self):
+        """Waits for the connections being handled to finish."""
+        for _ in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+
+
+class PreforkServer(object):
+    """A pre-forking HTTP server for a WSGI application.
+
+    The server is configured by the following StaplerConfig attributes:
+    host, port, workers, threads, backlog, max_requests, reuse_port and
+    graceful_timeout.
+    """
+
+    def __init__(self, application, config):
+        self.application = application
+        self.config = config
+        self.__socket = None
+        self.__workers = {}
+        self.__stopping = False
+        self.__restart_requested = False
+
+    def serve_forever(self):
+        """Runs the master process until it is told to shut down."""
+        self.__socket = _bind(self.config)
+        LOGGER.info(
+            'Launching %d workers with %d threads each on http://%s:%d',
+            self.config.workers, self.config.threads,
+            self.config.host, self.config.port)
+        previous_handlers = {
+            signum: signal.signal(signum, self.__handle_signal)
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)}
+        try:
+            while not self.__stopping:
+                if self.__restart_requested:
+                    self.__restart_requested = False
+                    LOGGER.info('Restarting all workers')
+                    self.__signal_workers(signal.SIGTERM)
+                self.__reap_workers()
+                self.__spawn_workers()
+                time.sleep(_POLL_INTERVAL)
+            LOGGER.info('Shutting down')
+            self.__signal_workers(signal.SIGTERM)
+            deadline = time.time() + self.config.graceful_timeout
+            while self.__workers and time.time() < deadline:
+                self.__reap_workers()
+                time.sleep(_POLL_INTERVAL / 4)
+            if self.__workers:
+                LOGGER.warning(
+                    'Killing %d workers that did not exit in time',
+                    len(self.__workers))
+                self.__signal_workers(signal.SIGKILL)
+                while self.__workers:
+                    self.__reap_workers(block=True)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            self.__socket.close()
+
+    def __handle_signal(self, signum, frame):
+        """Signal handler for the master process."""
+        # pylint: disable=unused-argument
+        if signum == signal.SIGHUP:
+            self.__restart_requested = True
+        else:
+            self.__stopping = True
+
+    def __signal_workers(self, signum):
+        """Sends a signal to every worker."""
+        for pid in list(self.__workers):
+            try:
+                os.kill(pid, signum)
+            except OSError as ex:
+                if ex.errno != errno.ESRCH:
+                    raise
+
+    def __reap_workers(self, block=False):
+        """Forgets about workers that have exited."""
+        while self.__workers:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as ex:
+                if ex.errno == errno.ECHILD:
+                    self.__workers.clear()
+                    return
+                if ex.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                return
+            started = self.__workers.pop(pid, None)
+            if started is not None:
+                LOGGER.info('Worker %d exited with status %d', pid, status)
+            if block:
+                return
+
+    def __spawn_workers(self):
+        """Forks workers until there are config.workers of them."""
+        while len(self.__workers) < self.config.workers:
+            pid = os.fork()
+            if pid == 0:
+                self.__run_worker()
+            self.__workers[pid] = time.time()
+            LOGGER.info('Started worker %d', pid)
+
+    def __run_worker(self):
+        """Runs in a forked worker process; never returns."""
+        exit_code = 1
+        started = time.time()
+        try:
+            stopping = []
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(
+                    signum, lambda signum, frame: stopping.append(signum))
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            server = _WorkerServer(
+                self.config, self.application, self.__socket)
+            max_requests = self.config.max_requests
+            while not stopping and (
+                    not max_requests
+                    or server.requests_handled < max_requests):
+                server.handle_request()
+            server.drain()
+            server.server_close()
+            # os._exit() skips the interpreter's cleanup, so write out any
+            # access log records still queued, and finish any background
+            # tasks, before exiting.
+            access_log = getattr(
+                getattr(self.application, 'config', None), 'access_log', None)
+            if access_log is not None:
+                access_log.flush(self.config.graceful_timeout)
+            for task_queue in self.config.task_queues:
+                task_queue.drain(self.config.graceful_timeout)
+            exit_code = 0
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Worker %d failed', os.getpid())
+            remaining = _MIN_WORKER_LIFETIME - (time.time() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+        finally:
+            os._exit(exit_code)  # pylint: disable=protected-access
+
+
+# vim: et ts=4
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements serving static files from a directory.
+
+Example Usage:
+
+    class Root(StaplerRoot):
+        # Serves assets/css/site.css as /assets/css/site.css, and so on.
+        assets = static_root('assets')
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+from datetime import datetime
+import mimetypes
+import os
+import stat
+import time
+
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+from werkzeug.http import http_date, is_resource_modified, quote_etag
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+from pystapler.dispatch import Mountable
+
+
+# Pre-compressed variants that are looked for next to each file, in order of
+# preference, as (content coding, file name suffix) pairs.
+PRECOMPRESSED_VARIANTS = (('br', '.br'), ('gzip', '.gz'))
+
+
+class StaticRoot(Mountable):
+    """Serves the files in a directory.
+
+    Files are sent with wsgi.file_wrapper, which lets WSGI servers that
+    support it use sendfile(), so file contents never pass through Python.
+    Responses carry ETag and Last-Modified headers, conditional requests are
+    answered with 304 Not Modified without opening the file, and Range
+    requests are supported.
+
+    If the client accepts it, a pre-compressed sibling of the requested file
+    (such as site.css.br or site.css.gz) is served in its place, with the
+    appropriate Content-Encoding.
+
+    The results of stat() calls are kept in memory, so that a request for a
+    file does not hit the file system until refresh_interval seconds have
+    passed since the file was last looked at.
+    """
+
+    def __init__(self, directory, refresh_interval=2.0, precompressed=True,
+                 cache_control='no-cache', max_stat_entries=4096):
+        """Creates a StaticRoot.
+
+        Parameters:
+            directory:
+                The directory to serve files from. A relative path is
+                interpreted relative to the current directory at the time the
+                StaticRoot is created.
+            refresh_interval:
+                The number of seconds for which the result of stat() on a
+                file is reused. Zero disables the stat cache.
+            precompressed:
+                Whether to look for pre-compressed variants of each file.
+            cache_control:
+                The value of the Cache-Control header sent with each file.
+            max_stat_entries:
+                The maximum number of stat() results to keep in memory.
+        """
+        self.directory = os.path.abspath(directory)
+        self.refresh_interval = refresh_interval
+        self.precompressed = precompressed
+        self.cache_control = cache_control
+        self.max_stat_entries = max_stat_entries
+        self.__stat_cache = {}
+
+    def __stat(self, path):
+        """Returns os.stat(path) for a regular file, or None.
+
+        Results are cached for refresh_interval seconds, including negative
+        results, so that repeated requests for missing files are cheap too.
+        """
+        now = time.time()
+        cached = self.__stat_cache.get(path)
+        if cached is not None and now - cached[0] < self.refresh_interval:
+            return cached[1]
+        try:
+            result = os.stat(path)
+        except OSError:
+            result = None
+        if result is not None and not stat.S_ISREG(result.st_mode):
+            result = None
+        if self.refresh_interval > 0:
+            if len(self.__stat_cache) >= self.max_stat_entries:
+                self.__stat_cache.clear()
+            self.__stat_cache[path] = (now, result)
+        return result
+
+    def __resolve(self, path_segments):
+        """Returns the file system path for a list of path segments, or None.
+
+        Paths that could escape the directory are rejected.
+        """
+        for path_segment in path_segments:
+            if (not path_segment or path_segment in ('.', '..')
+                    or '/' in path_segment or '\0' in path_segment
+                    or (os.path.altsep and os.path.altsep in path_segment)
+                    or os.path.sep in path_segment):
+                return None
+        if not path_segments:
+            return None
+        return os.path.join(self.directory, *path_segments)
+
+    def dispatch(self, path_segments, request_params):
+        """Serves the file named by path_segments."""
+        request = request_params.request
+        if request.method not in ('GET', 'HEAD'):
+            raise MethodNotAllowed(valid_methods=['GET', 'HEAD'])
+        path = self.__resolve(path_segments)
+        file_stat = path and self.__stat(path)
+        if not file_stat:
+            return NotFound()
+
+        path, file_stat, content_encoding = self.__choose_variant(
+            request, path, file_stat)
+        etag = '{:x}-{:x}'.format(
+            int(file_stat.st_mtime * 1000000), file_stat.st_size)
+        if content_encoding is not None:
+            etag += '-' + content_encoding
+        last_modified = datetime.utcfromtimestamp(int(file_stat.st_mtime))
+        headers = [('Cache-Control', self.cache_control)]
+        if self.precompressed:
+            headers.append(('Vary', 'Accept-Encoding'))
+        headers.append(('ETag', quote_etag(etag)))
+        if not is_resource_modified(
+                request.environ, etag=etag, last_modified=last_modified):
+            return Response(status=304, headers=headers)
+        headers.append(('Last-Modified', http_date(last_modified)))
+        if content_encoding is not None:
+            headers.append(('Content-Encoding', content_encoding))
+        return _send_file(
+            request, path, mimetypes.guess_type(path_segments[-1])[0],
+            headers, file_stat.st_size)
+
+    def __choose_variant(self, request, path, file_stat):
+        """Picks the pre-compressed variant of a file to serve, if any.
+
+        Returns:
+            The path and stat() result of the file to serve, and its content
+            coding, or None if it is the file itself.
+        """
+        if self.precompressed:
+            accept_encodings = request.accept_encodings
+            for encoding, suffix in PRECOMPRESSED_VARIANTS:
+                if accept_encodings[encoding]:
+                    variant_stat = self.__stat(path + suffix)
+                    if variant_stat is not None:
+                        return path + suffix, variant_stat, encoding
+        return path, file_stat, None
+
+
+def _send_file(request, path, mimetype, headers, size):
+    """Returns a response that sends a file, or the requested range of it.
+
+    Range requests are answered with 206 Partial Content by Werkzeug's
+    make_conditional, which seeks the wrapped file to the start of the range.
+    """
+    try:
+        file_obj = open(path, 'rb')
+    except (IOError, OSError):
+        return NotFound()
+    response = Response(
+        wrap_file(request.environ, file_obj),
+        mimetype=mimetype or 'application/octet-stream',
+        headers=headers,
+        direct_passthrough=True)
+    response.headers['Content-Length'] = str(size)
+    return response.make_conditional(
+        request, accept_ranges=True, complete_length=size)
+
+
+def static_root(directory, **kwargs):
+    """Returns a traversable object that serves the files in a directory.
+
+    Assign the result to a class attribute, and the files in the directory
+    become available below the path with the same name as the attribute.
+    See StaticRoot for the available keyword arguments.
+    """
+    return StaticRoot(directory, **kwargs)
+
+
+# vim: et ts=4
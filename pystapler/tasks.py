@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""Pystapler: application server framework for Python.
+
+This module implements running the work of a request in the background.
+
+A method decorated with @background(task_queue) does not run on the request
+thread. Instead, calling it submits a task to the TaskQueue and immediately
+returns a 202 Accepted response, whose Location header (and JSON body) gives
+the URL at which the task's status can be polled. The TaskQueue is itself
+Mountable, and serves those status URLs: assign it to a class attribute of
+the root object named after its mount_path.
+
+A TaskQueue has a bounded number of worker threads (or processes) and a
+bounded number of tasks in flight. When it is full, submitting a task fails
+with 503 Service Unavailable and a Retry-After header, so that clients back
+off rather than tasks piling up in memory.
+
+Tasks are held in the memory of the process that accepted them, so when the
+application runs in several worker processes, a status URL can only be
+resolved by the worker that accepted the task.
+
+Example Usage:
+
+    TASKS = TaskQueue(workers=4, max_pending=100)
+
+    class Config(StaplerConfig):
+        # Finish the tasks in flight before a worker process exits.
+        task_queues = (TASKS,)
+
+    class Root(StaplerRoot):
+        # Serves /tasks/<id> with the status of each task.
+        tasks = TASKS
+
+        @traversable
+        @background(TASKS)
+        def reindex(self, collection):
+            search_index.rebuild(collection)
+
+Copyright 2017 Daniel Pryden <daniel@pryden.net>; All rights reserved.
+See the LICENSE file for licensing details.
+"""
+
+from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+import uuid
+
+from decorator import decorator
+
+from werkzeug.exceptions import MethodNotAllowed, NotFound, ServiceUnavailable
+from werkzeug.wrappers import Response
+
+from pystapler.dispatch import Mountable, signature
+from pystapler.metrics import render_samples
+from pystapler.response import _json_encoder
+
+
+LOGGER = logging.getLogger(__name__)
+
+# The states of a task.
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_encode_json = _json_encoder(repr)
+
+# The parameters injected from the request that are files, which are closed
+# when the response has been sent, before a background task runs.
+_CLOSED_INJECTABLES = ('stream', 'files')
+
+
+class Task(object):
+    """A unit of work submitted to a TaskQueue.
+
+    Attributes:
+        id:
+            A unique, unguessable identifier for the task.
+        state:
+            One of PENDING, RUNNING (only reported for thread pools), DONE
+            and FAILED.
+        result:
+            What the task returned, once it is DONE.
+        error:
+            A description of the exception the task raised, once it FAILED.
+        submitted, started, finished:
+            The Unix times at which these things happened, or None.
+    """
+    # pylint: disable=too-few-public-methods,invalid-name
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.state = PENDING
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def describe(self):
+        """Returns a JSON-compatible dictionary describing the task."""
+        description = {
+            'id': self.id,
+            'state': self.state,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+        }
+        if self.state == DONE:
+            description['result'] = self.result
+        elif self.state == FAILED:
+            description['error'] = self.error
+        return description
+
+
+class _QueueState(object):
+    """What a TaskQueue keeps track of, guarded by the queue's lock."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        # The tasks in flight and the finished tasks that are remembered,
+        # by id, the finished ones in the order they finished.
+        self.tasks = OrderedDict()
+        self.in_flight = 0
+        self.running = 0
+        self.draining = False
+        # The executor, and the process that created it.
+        self.executor = None
+        self.pid = None
+        # What the queue has done since it was created, for stats().
+        self.counts = dict.fromkeys(
+            ('submitted', 'completed', 'failed', 'rejected'), 0)
+
+
+class TaskQueue(Mountable):
+    """A bounded pool that runs tasks in the background.
+
+    Mounted on a traversable object, it serves the status of a task as JSON
+    at <mount_path>/<task id>. Finished tasks are remembered, for their
+    status to be retrieved, until max_finished newer tasks have finished.
+
+    stats() returns the number of tasks the queue has submitted, completed,
+    failed and rejected since it was created, and the number waiting and
+    running; metric_samples() returns them as metrics, for MetricsPage.
+    """
+    # The settings are public; the state is kept in a _QueueState.
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, workers=4, max_pending=64, processes=False,
+                 max_finished=1024, retry_after=5, mount_path='tasks',
+                 name='default'):
+        """Creates a task queue.
+
+        Parameters:
+            workers:
+                The number of threads (or processes) that run tasks.
+            max_pending:
+                The maximum number of tasks submitted but not yet finished,
+                including the ones running. Submitting more fails with 503.
+            processes:
+                If true, tasks run in a process pool instead of a thread
+                pool. The functions submitted, and their arguments and
+                results, must then be picklable, which rules out
+                @background methods.
+            max_finished:
+                The number of finished tasks whose status is kept.
+            retry_after:
+                The number of seconds clients are told to wait before trying
+                again, when the queue is full.
+            mount_path:
+                The path, relative to the application root, at which the
+                queue is mounted, used to build status URLs.
+            name:
+                The name of the queue, used in thread names and metrics.
+        """
+        # pylint: disable=too-many-arguments
+        self.workers = workers
+        self.max_pending = max_pending
+        self.processes = processes
+        self.max_finished = max_finished
+        self.retry_after = retry_after
+        self.mount_path = mount_path.strip('/')
+        self.name = name
+        self.__state = _QueueState()
+        # Notified, with the lock held, whenever a task finishes.
+        self.__idle = threading.Condition(threading.Lock())
+
+    def __get_executor(self):
+        """Returns the executor, creating it on first use.
+
+        The caller must hold the lock. A new executor is created in a
+        process forked after it was created, since threads do not survive
+        fork(); tasks submitted in the parent are forgotten.
+        """
+        state = self.__state
+        if state.pid != os.getpid():
+            from concurrent import futures
+            if self.processes:
+                state.executor = futures.ProcessPoolExecutor(self.workers)
+            else:
+                state.executor = futures.ThreadPoolExecutor(
+                    self.workers,
+                    thread_name_prefix='pystapler-tasks-' + self.name)
+            state.tasks.clear()
+            state.in_flight = 0
+            state.running = 0
+            state.pid = os.getpid()
+        return state.executor
+
+    def submit(self, function, *args, **kwargs):
+        """Submits function(*args, **kwargs) to run in the background.
+
+        Returns:
+            The Task, which is PENDING.
+
+        Raises:
+            ServiceUnavailable: if the queue is full or draining.
+        """
+        state = self.__state
+        with self.__idle:
+            executor = self.__get_executor()
+            if state.draining or state.in_flight >= self.max_pending:
+                state.counts['rejected'] += 1
+                raise ServiceUnavailable(response=Response(
+                    'Too many tasks are in progress; try again later.',
+                    status=503, content_type='text/plain',
+                    headers=[('Retry-After', str(self.retry_after))]))
+            task = Task()
+            state.tasks[task.id] = task
+            state.in_flight += 1
+            state.counts['submitted'] += 1
+            if self.processes:
+                future = executor.submit(function, *args, **kwargs)
+            else:
+                future = executor.submit(
+                    self.__run, task, function, args, kwargs)
+        future.add_done_callback(lambda future: self.__finish(task, future))
+        return task
+
+    def __run(self, task, function, args, kwargs):
+        """Runs a task on a pool thread."""
+        with self.__idle:
+            task.state = RUNNING
+            task.started = time.time()
+            self.__state.running += 1
+        return function(*args, **kwargs)
+
+    def __finish(self, task, future):
+        """Records the outcome of a task, once its future is done."""
+        error = future.exception()
+        if error is not None:
+            LOGGER.error(
+                'Task %s on queue %s failed: %r', task.id, self.name, error)
+        state = self.__state
+        with self.__idle:
+            if task.started is not None:
+                state.running -= 1
+            task.finished = time.time()
+            if error is None:
+                task.result = future.result()
+                task.state = DONE
+                state.counts['completed'] += 1
+            else:
+                task.error = repr(error)
+                task.state = FAILED
+                state.counts['failed'] += 1
+            state.in_flight -= 1
+            # Move the task to the end, to be forgotten after max_finished
+            # tasks that finish later.
+            state.tasks.pop(task.id, None)
+            state.tasks[task.id] = task
+            finished = len(state.tasks) - state.in_flight
+            while finished > self.max_finished:
+                oldest = next(iter(state.tasks.values()))
+                if oldest.finished is None:
+                    break
+                del state.tasks[oldest.id]
+                finished -= 1
+            self.__idle.notify_all()
+
+    def get(self, task_id):
+        """Returns the Task with the given id, or None."""
+        with self.__idle:
+            return self.__state.tasks.get(task_id)
+
+    def status_url(self, script_root, task):
+        """Returns the URL at which the status of a task is served.
+
+        Parameters:
+            script_root:
+                The path at which the application is mounted (the WSGI
+                SCRIPT_NAME), which is usually empty.
+            task:
+                The Task.
+        """
+        return '{}/{}/{}'.format(
+            script_root.rstrip('/'), self.mount_path, task.id)
+
+    def accepted(self, task):
+        """Returns the 202 Accepted response for a newly submitted task."""
+        return _AcceptedResponse(self, task)
+
+    def stats(self):
+        """Returns a dictionary of counters describing the queue.
+
+        Its keys are submitted, completed, failed and rejected, which count
+        tasks since the queue was created, and queued and running.
+        """
+        state = self.__state
+        with self.__idle:
+            stats = dict(state.counts)
+            stats['queued'] = state.in_flight - state.running
+            stats['running'] = state.running
+        return stats
+
+    def metric_samples(self):
+        """Returns the queue's metrics, as render_samples() takes them."""
+        stats = self.stats()
+        labels = [('queue', self.name)]
+        return [
+            ('pystapler_tasks_queued', 'gauge',
+             'Tasks waiting for a worker.', labels, stats['queued']),
+            ('pystapler_tasks_running', 'gauge',
+             'Tasks being run.', labels, stats['running']),
+            ('pystapler_tasks_submitted_total', 'counter',
+             'Tasks accepted.', labels, stats['submitted']),
+            ('pystapler_tasks_completed_total', 'counter',
+             'Tasks that finished successfully.', labels,
+             stats['completed']),
+            ('pystapler_tasks_failed_total', 'counter',
+             'Tasks that raised an exception.', labels, stats['failed']),
+            ('pystapler_tasks_rejected_total', 'counter',
+             'Tasks refused because the queue was full.', labels,
+             stats['rejected']),
+        ]
+
+    def render_metrics(self):
+        """Returns the queue's metrics in the Prometheus text format."""
+        return render_samples(self.metric_samples())
+
+    def drain(self, timeout=None):
+        """Stops accepting tasks, and waits for the ones in flight.
+
+        Returns:
+            True if every task finished, or False on timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        state = self.__state
+        with self.__idle:
+            state.draining = True
+            while state.in_flight and state.pid == os.getpid():
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        LOGGER.warning(
+                            'Abandoning %d tasks on queue %s',
+                            state.in_flight, self.name)
+                        return False
+                self.__idle.wait(remaining)
+            executor = state.executor
+        if executor is not None and state.pid == os.getpid():
+            executor.shutdown(wait=False)
+        return True
+
+    def dispatch(self, path_segments, request_params):
+        """Serves the status of the task named by path_segments."""
+        if request_params.request.method not in ('GET', 'HEAD'):
+            raise MethodNotAllowed(valid_methods=['GET', 'HEAD'])
+        if len(path_segments) != 1:
+            return NotFound()
+        task = self.get(path_segments[0])
+        if task is None:
+            return NotFound()
+        response = Response(
+            _encode_json(task.describe()), content_type='application/json')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+
+class _AcceptedResponse(Response):
+    """The 202 Accepted response for a task, pointing to its status URL.
+
+    The URL depends on where the application is mounted, which is only known
+    from the WSGI environment, so the response is completed when it is sent.
+    """
+
+    def __init__(self, task_queue, task):
+        Response.__init__(self, status=202, content_type='application/json')
+        self.__task_queue = task_queue
+        self.__task = task
+
+    def __call__(self, environ, start_response):
+        url = self.__task_queue.status_url(
+            environ.get('SCRIPT_NAME', ''), self.__task)
+        self.headers['Location'] = url
+        self.set_data(_encode_json({'id': self.__task.id, 'status_url': url}))
+        return Response.__call__(self, environ, start_response)
+
+
+def background(task_queue):
+    """Decorates a method whose work is done on a TaskQueue.
+
+    Calling the decorated method submits it, with the arguments taken from
+    the request, to the task queue, and returns a 202 Accepted response
+    pointing to the task's status URL. The method's return value, which
+    must be JSON-serializable to be reported, becomes the task's result.
+    If the queue is full, the response is 503 Service Unavailable instead.
+
+    Arguments injected from the request (such as form) are evaluated on the
+    request thread, before the task is submitted, so the method may use
+    them. The request itself must not be read from the method, since it is
+    over by the time the method runs. For the same reason, the method may
+    not take the stream or files parameters, whose files are closed when
+    the response has been sent: decorating such a method raises TypeError.
+    """
+    if task_queue.processes:
+        raise ValueError(
+            '@background methods cannot run on a process pool; submit a '
+            'module-level function with TaskQueue.submit instead')
+
+    def decorator_closure(method):
+        """@background decorator closure."""
+        parameters = signature(method).parameters
+        for name in _CLOSED_INJECTABLES:
+            if name in parameters:
+                raise TypeError(
+                    '@background method "{}" cannot take "{}", which is '
+                    'closed before the task runs'.format(
+                        method.__name__, name))
+        @decorator
+        def submit(method, *args, **kwargs):
+            """Submits the method to the task queue."""
+            return task_queue.accepted(
+                task_queue.submit(method, *args, **kwargs))
+        return submit(method)
+    return decorator_closure
+
+
+# vim: et ts=4
@@ -12,7 +12,9 @@ setup(
     packages=['pystapler'],
     install_requires=[
         'decorator>=4.0.11',
-        'six>=1.10.0',
-        'werkzeug>=0.11',
+        'funcsigs>=1.0;python_version<"3.3"',
+        'futures;python_version<"3"',
+        'six>=1.13.0',
+        'werkzeug>=0.15',
     ],
 )
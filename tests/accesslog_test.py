@@ -0,0 +1,165 @@
+"""Tests for sampled access logging."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import logging
+import os
+import tempfile
+import threading
+import unittest
+
+from werkzeug.test import create_environ
+
+from pystapler.accesslog import AccessLog
+from pystapler.config import StaplerConfig
+from pystapler.dispatch import StaplerRoot, traversable
+from pystapler.response import binary, plaintext
+
+
+class ServerFileWrapper(object):
+    """Stands in for a server's wsgi.file_wrapper, which uses sendfile()."""
+    def __init__(self, file_obj, block_size=8192):
+        self.file_obj = file_obj
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.file_obj.read(self.block_size), b'')
+
+    def close(self):
+        self.file_obj.close()
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.threads = []
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.append(threading.current_thread())
+
+
+class Root(StaplerRoot):
+    config = None
+    path = None
+
+    def __init__(self, access_log):
+        self.config = StaplerConfig()
+        self.config.access_log = access_log
+
+    @traversable
+    @plaintext
+    def spam(self, count='1'):
+        return 'spam' * int(count)
+
+    @traversable
+    @binary
+    def eggs_file(self):
+        return open(self.path, 'rb')
+
+
+class AccessLogTests(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('pystapler.test.access')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = RecordingHandler()
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    # The test client only closes the response, which is when the request
+    # is logged, if it is asked to buffer the response.
+
+    def test_record(self):
+        access_log = AccessLog(self.logger)
+        client = Root(access_log).test_client()
+        client.get('/spam?count=3', buffered=True,
+                   environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertTrue(access_log.flush(5))
+        self.assertEqual(1, len(self.handler.records))
+        record = self.handler.records[0]
+        access = record.access
+        self.assertEqual('GET', access['method'])
+        self.assertEqual('/spam', access['path'])
+        self.assertEqual('count=3', access['query_string'])
+        self.assertEqual(200, access['status'])
+        self.assertEqual(12, access['bytes'])
+        self.assertGreaterEqual(access['latency'], 0)
+        self.assertTrue(record.getMessage().startswith(
+            '10.0.0.1 "GET /spam?count=3" 200 12 '))
+        self.assertIsNot(threading.current_thread(), self.handler.threads[0])
+
+    def test_file_wrapper_passed_through(self):
+        """The server gets its own file wrapper back, to send the file."""
+        access_log = AccessLog(self.logger)
+        with tempfile.NamedTemporaryFile(delete=False) as eggs:
+            eggs.write(b'eggs' * 4)
+        self.addCleanup(os.remove, eggs.name)
+        root = Root(access_log)
+        root.path = eggs.name
+        environ = create_environ('/eggs_file')
+        environ['wsgi.file_wrapper'] = ServerFileWrapper
+        app_iter = root(environ, lambda *args: None)
+        self.assertIsInstance(app_iter, ServerFileWrapper)
+        self.assertEqual(b'eggs' * 4, b''.join(app_iter))
+        app_iter.close()
+        self.assertTrue(access_log.flush(5))
+        access = self.handler.records[0].access
+        self.assertEqual(200, access['status'])
+        self.assertEqual(16, access['bytes'])
+
+    def test_not_found(self):
+        access_log = AccessLog(self.logger)
+        Root(access_log).test_client().get('/eggs', buffered=True)
+        access_log.flush(5)
+        self.assertEqual(404, self.handler.records[0].access['status'])
+
+    def test_level_gate(self):
+        access_log = AccessLog(self.logger, level=logging.DEBUG)
+        Root(access_log).test_client().get('/spam')
+        access_log.flush(5)
+        self.assertEqual([], self.handler.records)
+
+    def test_sampling(self):
+        access_log = AccessLog(self.logger, sample_rate=0)
+        client = Root(access_log).test_client()
+        for _ in range(10):
+            client.get('/spam')
+        access_log.flush(5)
+        self.assertEqual([], self.handler.records)
+
+    def test_full_queue_drops_records(self):
+        access_log = AccessLog(self.logger, max_queue=1)
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def write(access):
+            # pylint: disable=unused-argument
+            blocked.set()
+            release.wait(5)
+        access_log.write = write
+        client = Root(access_log).test_client()
+        client.get('/spam', buffered=True)
+        blocked.wait(5)
+        client.get('/spam', buffered=True)
+        client.get('/spam', buffered=True)
+        release.set()
+        self.assertEqual(1, access_log.dropped)
+
+    def test_default_access_log(self):
+        """Configurations share one AccessLog unless they set their own."""
+        config = StaplerConfig()
+        self.assertIsInstance(config.access_log, AccessLog)
+        self.assertIs(config.access_log, StaplerConfig().access_log)
+        config.access_log = None
+        self.assertIsNone(config.access_log)
+        self.assertIsNotNone(StaplerConfig().access_log)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: et ts=4
@@ -0,0 +1,214 @@
+"""Tests for limiting concurrent calls to methods."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import json
+import threading
+import time
+import unittest
+
+from werkzeug.exceptions import ServiceUnavailable
+
+from pystapler.admission import Limiter, limit
+from pystapler.batch import Batch, BatchPage
+from pystapler.config import StaplerConfig
+from pystapler.dispatch import StaplerRoot, traversable
+from pystapler.metrics import Metrics, MetricsPage
+from pystapler.response import plaintext
+
+
+RELEASE = threading.Event()
+STARTED = threading.Semaphore(0)
+
+
+def make_root(slow_limiter, config_limiter):
+    class Config(StaplerConfig):
+        route_limits = {'configured': config_limiter}
+
+    class Root(StaplerRoot):
+        config = Config()
+
+        @traversable
+        @limit(slow_limiter)
+        @plaintext
+        def slow(self):
+            STARTED.release()
+            RELEASE.wait(5)
+            return u'slow'
+
+        @traversable
+        @plaintext
+        def configured(self):
+            STARTED.release()
+            RELEASE.wait(5)
+            return u'configured'
+
+        @traversable
+        @plaintext
+        def healthy(self):
+            return u'healthy'
+
+        @traversable
+        def metrics(self):
+            return MetricsPage(Metrics(), slow_limiter)
+
+        @traversable
+        def batch(self):
+            return BatchPage(Batch(), self)
+    return Root()
+
+
+class AdmissionTests(unittest.TestCase):
+    def setUp(self):
+        global STARTED  # pylint: disable=global-statement
+        STARTED = threading.Semaphore(0)
+        RELEASE.clear()
+        self.slow_limiter = Limiter(
+            max_concurrent=1, max_queued=1, queue_timeout=5, retry_after=3)
+        self.config_limiter = Limiter(max_concurrent=1)
+        self.client = make_root(
+            self.slow_limiter, self.config_limiter).test_client()
+        self.threads = []
+
+    def tearDown(self):
+        RELEASE.set()
+        for thread in self.threads:
+            thread.join(5)
+
+    def start(self, path, responses):
+        thread = threading.Thread(
+            target=lambda: responses.append(self.client.get(path)))
+        thread.start()
+        self.threads.append(thread)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_reject_when_full(self):
+        responses = []
+        self.start('/slow', responses)
+        STARTED.acquire()
+        self.start('/slow', responses)
+        self.wait_for(lambda: self.slow_limiter.queued == 1)
+
+        response = self.client.get('/slow')
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('3', response.headers['Retry-After'])
+        # Other routes are not affected.
+        self.assertEqual(b'healthy', self.client.get('/healthy').data)
+
+        RELEASE.set()
+        for thread in self.threads:
+            thread.join(5)
+        self.assertEqual([200, 200], [r.status_code for r in responses])
+        self.assertEqual(
+            {'in_flight': 0, 'queued': 0, 'admitted': 2, 'rejected': 1},
+            self.slow_limiter.stats())
+
+    def test_queue_timeout(self):
+        limiter = Limiter(max_concurrent=1, max_queued=1, queue_timeout=0.05)
+        limiter.acquire()
+        self.assertRaises(ServiceUnavailable, limiter.acquire)
+        self.assertEqual(1, limiter.rejected)
+        limiter.release()
+        limiter.acquire()
+        self.assertEqual(2, limiter.admitted)
+
+    def test_configured(self):
+        responses = []
+        self.start('/configured', responses)
+        STARTED.acquire()
+        self.assertEqual(503, self.client.get('/configured').status_code)
+        self.assertEqual('configured', self.config_limiter.name)
+        RELEASE.set()
+        self.threads[0].join(5)
+        self.assertEqual(200, responses[0].status_code)
+
+    def test_batched(self):
+        """Sub-requests of a batch are admitted like other requests."""
+        responses = []
+        self.start('/configured', responses)
+        STARTED.acquire()
+        response = self.client.get('/batch?path=/configured')
+        self.assertEqual(
+            [503], [item['status'] for item in json.loads(
+                response.data.decode('utf-8'))])
+        RELEASE.set()
+        self.threads[0].join(5)
+        response = self.client.get('/batch?path=/configured')
+        self.assertEqual(
+            [200], [item['status'] for item in json.loads(
+                response.data.decode('utf-8'))])
+        self.assertEqual(
+            {'in_flight': 0, 'queued': 0, 'admitted': 2, 'rejected': 1},
+            self.config_limiter.stats())
+
+    def test_metrics(self):
+        RELEASE.set()
+        self.client.get('/slow')
+        self.client.get('/slow')
+        data = self.client.get('/metrics').data.decode('utf-8')
+        self.assertIn(
+            'pystapler_admission_admitted_total{route="slow"} 2', data)
+        self.assertIn('pystapler_admission_in_flight{route="slow"} 0', data)
+
+    def test_metrics_of_several_limiters(self):
+        """Each metric is described once, followed by all its samples."""
+        first = Limiter(max_concurrent=1, name='first')
+        second = Limiter(max_concurrent=1, name='second')
+        first.acquire()
+        response = MetricsPage(Metrics(), first, second).render()
+        families = parse_families(response.get_data(as_text=True))
+        self.assertEqual(
+            [('route="first"', '1'), ('route="second"', '0')],
+            families['pystapler_admission_in_flight'])
+        self.assertEqual(
+            [('route="first"', '1'), ('route="second"', '0')],
+            families['pystapler_admission_admitted_total'])
+
+    def test_configured_limiter_is_resolved_by_compile(self):
+        limiter = Limiter(max_concurrent=1)
+
+        class Config(StaplerConfig):
+            route_limits = {'healthy': limiter}
+
+        class Root(StaplerRoot):
+            config = Config()
+
+            @traversable
+            @plaintext
+            def healthy(self):
+                return u'healthy'
+        Root().compile()
+        self.assertEqual('healthy', limiter.name)
+
+
+def parse_families(text):
+    """Parses Prometheus text, checking that each family is contiguous.
+
+    Returns:
+        A dictionary mapping each metric name to a list of its samples, as
+        (labels, value) pairs.
+    """
+    families = {}
+    current = None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            continue
+        if line.startswith('# TYPE '):
+            current = line.split()[2]
+            if current in families:
+                raise AssertionError('second TYPE line for ' + current)
+            families[current] = []
+            continue
+        name, rest = line.split('{', 1)
+        labels, value = rest.rsplit('} ', 1)
+        if current not in (name, name.rsplit('_', 1)[0]):
+            raise AssertionError(name + ' is not in its family')
+        families[current].append((labels, value))
+    return families
+
+
+# vim: et ts=4
@@ -0,0 +1,257 @@
+"""Tests for serving an application through ASGI.
+
+This module requires Python 3.5 or later.
+"""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import asyncio
+import threading
+import time
+import unittest
+
+from werkzeug.exceptions import BadRequest
+
+from pystapler.asgi import TestClient
+from pystapler.config import StaplerConfig
+from pystapler.dispatch import StaplerRoot, traversable, default, etag
+from pystapler.metrics import Metrics
+from pystapler.response import plaintext
+
+
+ETAG_THREADS = []
+
+
+class Root(StaplerRoot):
+    def __init__(self):
+        self.streams = []
+
+    @traversable
+    async def slow(self, delay='0.2'):
+        await asyncio.sleep(float(delay))
+        return Renderable('slow')
+
+    @traversable
+    @plaintext
+    def thread(self):
+        return threading.current_thread().name
+
+    @traversable
+    @plaintext
+    async def greeting(self, name='world'):
+        return 'Hello, {}!'.format(name)
+
+    @traversable
+    async def parrot(self):
+        raise BadRequest('resting!')
+
+    @traversable
+    @plaintext
+    def echo(self, form):
+        return form['spam']
+
+    @traversable
+    def revised(self):
+        return Revised()
+
+    @traversable
+    @plaintext
+    async def shout(self, form):
+        return form['spam'].upper()
+
+    @traversable
+    @plaintext
+    def upload(self, stream):
+        self.streams.append(stream)
+        return '{}:{}'.format(
+            stream.__class__.__name__, len(stream.read()))
+
+
+class SmallBodyConfig(StaplerConfig):
+    max_body_size = 16
+    spool_memory_size = 4
+
+
+class SmallBodyRoot(Root):
+    config = SmallBodyConfig()
+
+
+class MetricsRoot(Root):
+    # Replaces the StaplerRoot.config property with a plain attribute.
+    config = None
+
+    def __init__(self, metrics):
+        Root.__init__(self)
+        self.config = StaplerConfig()
+        self.config.metrics = metrics
+
+
+class Renderable(object):
+    def __init__(self, text):
+        self.text = text
+
+    @etag
+    def text_etag(self):
+        ETAG_THREADS.append(threading.current_thread().name)
+        return self.text
+
+    @default
+    @plaintext
+    async def render(self):
+        return self.text
+
+
+class Revised(object):
+    @etag
+    async def revision(self):
+        return 'r1'
+
+    @default
+    @plaintext
+    async def render(self):
+        return 'revised'
+
+
+class AsgiTests(unittest.TestCase):
+    def setUp(self):
+        self.root = Root()
+        self.client = TestClient(self.root.asgi)
+
+    def test_coroutine_traversal(self):
+        """Coroutine methods should be awaited at every hop."""
+        response = self.client.get('/slow', b'delay=0')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'slow', response.data)
+        self.assertIn(
+            ('content-type', 'text/plain'), response.headers)
+
+    def test_not_modified(self):
+        """A coroutine @default method should not run for a current copy."""
+        response = self.client.get(
+            '/slow', b'delay=0', headers=[('If-None-Match', '"slow"')])
+        self.assertEqual(304, response.status_code)
+        response = self.client.get('/slow', b'delay=0')
+        self.assertIn(('etag', '"slow"'), response.headers)
+
+    def test_coroutine_etag(self):
+        """An "async def" @etag method should be awaited on the loop."""
+        response = self.client.get(
+            '/revised', headers=[('If-None-Match', '"r1"')])
+        self.assertEqual(304, response.status_code)
+        response = self.client.get('/revised')
+        self.assertEqual(b'revised', response.data)
+        self.assertIn(('etag', '"r1"'), response.headers)
+
+    def test_etag_on_thread(self):
+        """An ordinary @etag method should not run on the loop's thread."""
+        del ETAG_THREADS[:]
+        self.client.get('/slow', b'delay=0')
+        self.assertEqual(1, len(ETAG_THREADS))
+        self.assertNotEqual(threading.current_thread().name, ETAG_THREADS[0])
+
+    def test_query_string(self):
+        response = self.client.get('/greeting', b'name=Daniel')
+        self.assertEqual(b'Hello, Daniel!', response.data)
+
+    def test_sync_method_on_thread(self):
+        """Ordinary methods should not run on the event loop's thread."""
+        response = self.client.get('/thread')
+        self.assertNotEqual(
+            threading.current_thread().name, response.data.decode('utf-8'))
+
+    def test_not_found(self):
+        self.assertEqual(404, self.client.get('/nothing').status_code)
+
+    def test_http_exception(self):
+        self.assertEqual(400, self.client.get('/parrot').status_code)
+
+    def test_form_body(self):
+        response = self.client.post(
+            '/echo', b'spam=eggs',
+            [('Content-Type', 'application/x-www-form-urlencoded')])
+        self.assertEqual(b'eggs', response.data)
+
+    def test_body_too_large(self):
+        client = TestClient(SmallBodyRoot().asgi)
+        headers = [('Content-Type', 'application/x-www-form-urlencoded')]
+        response = client.post('/echo', b'spam=eggs', headers)
+        self.assertEqual(b'eggs', response.data)
+        response = client.post('/echo', b'spam=' + b'eggs' * 8, headers)
+        self.assertEqual(413, response.status_code)
+        headers.append(('Content-Length', '37'))
+        response = client.post('/echo', b'spam=' + b'eggs' * 8, headers)
+        self.assertEqual(413, response.status_code)
+
+    def test_coroutine_form_body(self):
+        """The body is read on a thread for a coroutine that takes it."""
+        response = self.client.post(
+            '/shout', b'spam=eggs',
+            [('Content-Type', 'application/x-www-form-urlencoded')])
+        self.assertEqual(b'EGGS', response.data)
+
+    def test_stream(self):
+        """The body is spooled as the stream, and closed after the response."""
+        root = SmallBodyRoot()
+        response = TestClient(root.asgi).post('/upload', b'x' * 10)
+        self.assertEqual(b'SpooledTemporaryFile:10', response.data)
+        self.assertTrue(root.streams[0].closed)
+
+    def test_body_not_read(self):
+        """The body of a request is not received unless it is used."""
+        received = []
+        sent = []
+
+        async def receive():
+            received.append(True)
+            return {'type': 'http.request', 'body': b'spam=eggs'}
+
+        async def send(message):
+            sent.append(message)
+        scope = {'type': 'http', 'method': 'POST', 'path': '/thread',
+                 'headers': [(b'content-length', b'9')]}
+        asyncio.new_event_loop().run_until_complete(
+            self.root.asgi(scope, receive, send))
+        self.assertEqual(200, sent[0]['status'])
+        self.assertEqual([], received)
+
+    def test_concurrency(self):
+        """Slow coroutine methods should not hold up other requests."""
+        async def many_requests():
+            return await asyncio.gather(*[
+                self.client.get_async('/slow') for _ in range(20)])
+
+        start = time.time()
+        loop = asyncio.new_event_loop()
+        try:
+            responses = loop.run_until_complete(many_requests())
+        finally:
+            loop.close()
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual([b'slow'] * 20, [r.data for r in responses])
+
+    def test_metrics(self):
+        """Requests served through ASGI are timed, like WSGI requests."""
+        metrics = Metrics()
+        client = TestClient(MetricsRoot(metrics).asgi)
+        self.assertEqual(b'Hello, world!', client.get('/greeting').data)
+        self.assertEqual(b'revised', client.get('/revised').data)
+        self.assertEqual(404, client.get('/nothing').status_code)
+        text = metrics.render()
+        self.assertIn(
+            'pystapler_responses_total{route="greeting",status="200"} 1',
+            text)
+        self.assertIn(
+            'pystapler_hop_duration_seconds_count'
+            '{route="revised/render",hop="render"} 1', text)
+        self.assertIn(
+            'pystapler_request_duration_seconds_count'
+            '{route="revised/render",phase="traverse"} 1', text)
+        self.assertIn(
+            'pystapler_responses_total{route="<none>",status="404"} 1', text)
+
+    def test_coroutine_over_wsgi(self):
+        """Coroutine methods should also work through WSGI."""
+        response = self.root.test_client().get('/greeting')
+        self.assertEqual(b'Hello, world!', response.data)
+
+
+# vim: et ts=4
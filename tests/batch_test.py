@@ -0,0 +1,145 @@
+"""Tests for the batch endpoint."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import json
+import threading
+import unittest
+
+from werkzeug.wrappers import Response
+
+from pystapler.batch import Batch, BatchPage
+from pystapler.config import StaplerConfig
+from pystapler.dispatch import StaplerRoot, traversable, default
+from pystapler.metrics import Metrics
+from pystapler.response import json_response, plaintext
+
+
+class User(object):
+    def __init__(self, name):
+        self.name = name
+
+    @default
+    @json_response
+    def show(self):
+        return {'name': self.name}
+
+    @traversable
+    @plaintext
+    def greeting(self, greeting='Hello'):
+        return u'{}, {}'.format(greeting, self.name)
+
+    @traversable
+    def avatar(self):
+        return Response(b'\x89PNG', mimetype='image/png')
+
+    @traversable
+    @plaintext
+    def cookie(self, request):
+        return request.cookies.get('flavour', u'none')
+
+
+class Root(StaplerRoot):
+    def __init__(self, threads=0):
+        self.batch_config = Batch(threads=threads, max_requests=4)
+        self.lookups = []
+        self.lock = threading.Lock()
+
+    @traversable
+    def user(self, name):
+        with self.lock:
+            self.lookups.append(name)
+        return User(name)
+
+    @traversable
+    def batch(self):
+        return BatchPage(self.batch_config, self)
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        self.root = Root()
+        self.client = self.root.test_client()
+
+    def post(self, items, **kwargs):
+        response = self.client.post(
+            '/batch', data=json.dumps(items),
+            content_type='application/json', **kwargs)
+        self.assertEqual(200, response.status_code)
+        return json.loads(response.data.decode('utf-8'))
+
+    def test_batch(self):
+        results = self.post([
+            '/user?name=arthur',
+            {'path': '/user/greeting',
+             'params': {'name': 'arthur', 'greeting': 'Hi'}},
+            '/user/avatar?name=arthur',
+            '/nowhere',
+        ])
+        self.assertEqual([200, 200, 200, 404],
+                         [result['status'] for result in results])
+        self.assertEqual({'name': 'arthur'}, results[0]['body'])
+        self.assertEqual(u'Hi, arthur', results[1]['body'])
+        self.assertEqual(u'iVBORw==', results[2]['body'])
+        self.assertTrue(results[2]['base64'])
+        self.assertEqual('/nowhere', results[3]['path'])
+
+    def test_traversals_reused(self):
+        """The same user should only be looked up once per batch."""
+        self.post(['/user?name=arthur', '/user/greeting?name=arthur',
+                   '/user?name=lancelot'])
+        self.assertEqual(['arthur', 'lancelot'], self.root.lookups)
+        self.post(['/user?name=arthur'])
+        self.assertEqual(['arthur', 'lancelot', 'arthur'], self.root.lookups)
+
+    def test_shared_cookies(self):
+        self.client.set_cookie('localhost', 'flavour', 'spam')
+        results = self.post(['/user/cookie?name=arthur'])
+        self.assertEqual(u'spam', results[0]['body'])
+
+    def test_get(self):
+        response = self.client.get(
+            '/batch?path=/user%3Fname%3Darthur&path=/user?name=robin')
+        results = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(
+            [{'name': 'arthur'}, {'name': 'robin'}],
+            [result['body'] for result in results])
+
+    def test_parallel(self):
+        client = Root(threads=4).test_client()
+        response = client.post(
+            '/batch', content_type='application/json', data=json.dumps(
+                ['/user?name={}'.format(n) for n in range(4)]))
+        results = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(
+            [{'name': str(n)} for n in range(4)],
+            [result['body'] for result in results])
+
+    def test_nested_batch_rejected(self):
+        results = self.post(['/batch?path=/user%3Fname%3Darthur'])
+        self.assertEqual(400, results[0]['status'])
+        self.assertEqual([], self.root.lookups)
+
+    def test_metrics_recorded(self):
+        """Sub-requests are served by the root, with its metrics."""
+        metrics = Metrics()
+
+        class Config(StaplerConfig):
+            pass
+        Config.metrics = metrics
+
+        class MeasuredRoot(Root):
+            config = Config()
+        response = MeasuredRoot().test_client().get('/batch?path=/user?name=robin')
+        self.assertEqual(200, response.status_code)
+        self.assertIn(
+            'pystapler_responses_total{route="user/show",status="200"} 1',
+            metrics.render())
+
+    def test_malformed(self):
+        for data in ('{', '{"path": "/user"}', '[1]', json.dumps(['/'] * 5)):
+            response = self.client.post(
+                '/batch', data=data, content_type='application/json')
+            self.assertEqual(400, response.status_code, data)
+
+
+# vim: et ts=4
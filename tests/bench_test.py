@@ -0,0 +1,31 @@
+"""Tests for the benchmark suite."""
+# pylint: disable=missing-docstring
+
+import unittest
+
+from pystapler.bench import compare, run_benchmarks
+
+
+class BenchTests(unittest.TestCase):
+    def test_run(self):
+        report = run_benchmarks('shallow', min_time=0.01)
+        self.assertEqual(['shallow'], list(report['results']))
+        self.assertGreater(
+            report['results']['shallow']['requests_per_second'], 0)
+
+    def test_compare(self):
+        baseline = {'results': {
+            'fast': {'usec_per_request': 10.0, 'peak_alloc_bytes': 1000},
+            'lean': {'usec_per_request': 10.0, 'peak_alloc_bytes': 1000},
+        }}
+        report = {'results': {
+            'fast': {'usec_per_request': 20.0, 'peak_alloc_bytes': 1000},
+            'lean': {'usec_per_request': 11.0, 'peak_alloc_bytes': 1100},
+            'new': {'usec_per_request': 99.0, 'peak_alloc_bytes': None},
+        }}
+        regressions = compare(report, baseline, tolerance=0.2)
+        self.assertEqual(1, len(regressions))
+        self.assertTrue(regressions[0].startswith('fast:'))
+
+
+# vim: et ts=4
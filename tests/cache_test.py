@@ -0,0 +1,116 @@
+"""Tests for caching rendered responses."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import time
+import unittest
+
+from pystapler.cache import ResponseCache, cached
+from pystapler.dispatch import StaplerRoot, traversable, default
+from pystapler.response import plaintext
+
+
+SMALL_CACHE = ResponseCache(max_entries=2)
+
+
+class Root(StaplerRoot):
+    def __init__(self):
+        self.renders = 0
+
+    @traversable
+    @cached(ttl=60, vary=['page'])
+    @plaintext
+    def catalog(self, page='1', sort='name'):
+        self.renders += 1
+        return 'page {} by {} (render {})'.format(page, sort, self.renders)
+
+    @traversable
+    @cached(ttl=0.05)
+    @plaintext
+    def dashboard(self):
+        self.renders += 1
+        return 'render {}'.format(self.renders)
+
+    @traversable
+    @cached(SMALL_CACHE, vary=['n'])
+    @plaintext
+    def small(self, n):
+        self.renders += 1
+        return n
+
+    @traversable
+    def products(self):
+        return Products(self)
+
+
+class Products(object):
+    def __init__(self, root):
+        self.root = root
+
+    @default
+    @cached
+    @plaintext
+    def render(self):
+        self.root.renders += 1
+        return 'products'
+
+
+class CacheTests(unittest.TestCase):
+    def setUp(self):
+        self.root = Root()
+        self.client = self.root.test_client()
+        SMALL_CACHE.clear()
+
+    def test_hit(self):
+        first = self.client.get('/catalog')
+        second = self.client.get('/catalog')
+        self.assertEqual(1, self.root.renders)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual('no-cache', second.headers['Cache-Control'])
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+
+    def test_vary(self):
+        """Only the parameters listed in vary should be part of the key."""
+        self.client.get('/catalog?page=2&sort=name')
+        response = self.client.get('/catalog?page=2&sort=price')
+        self.assertEqual(1, self.root.renders)
+        self.assertEqual(b'page 2 by name (render 1)', response.data)
+        response = self.client.get('/catalog?page=3')
+        self.assertEqual(2, self.root.renders)
+
+    def test_not_modified(self):
+        etag = self.client.get('/catalog?page=4').headers['ETag']
+        response = self.client.get(
+            '/catalog?page=4', headers=[('If-None-Match', etag)])
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.data)
+        self.assertEqual(etag, response.headers['ETag'])
+
+    def test_ttl(self):
+        self.client.get('/dashboard')
+        time.sleep(0.1)
+        response = self.client.get('/dashboard')
+        self.assertEqual(b'render 2', response.data)
+
+    def test_lru_eviction(self):
+        for n in ('1', '2', '1', '3', '1', '2'):
+            self.client.get('/small?n=' + n)
+        stats = SMALL_CACHE.stats()
+        self.assertEqual(2, stats['entries'])
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(4, stats['misses'])
+        self.assertEqual(2, stats['evictions'])
+        self.assertEqual(4, self.root.renders)
+
+    def test_post_not_cached(self):
+        self.client.post('/catalog')
+        self.client.post('/catalog')
+        self.assertEqual(2, self.root.renders)
+
+    def test_default_method(self):
+        """Caching should work on @default methods too."""
+        self.client.get('/products')
+        self.assertEqual(b'products', self.client.get('/products').data)
+        self.assertEqual(1, self.root.renders)
+
+
+# vim: et ts=4
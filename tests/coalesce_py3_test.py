@@ -0,0 +1,53 @@
+"""Tests for coalescing identical concurrent requests to coroutine methods.
+
+This module requires Python 3.5 or later.
+"""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import asyncio
+import unittest
+
+from pystapler.asgi import TestClient
+from pystapler.coalesce import coalesce
+from pystapler.dispatch import StaplerRoot, traversable
+from pystapler.response import plaintext
+
+
+class Root(StaplerRoot):
+    def __init__(self):
+        self.calls = []
+
+    @traversable
+    @coalesce
+    @plaintext
+    async def awaited(self):
+        self.calls.append('awaited')
+        await asyncio.sleep(0.1)
+        return 'awaited'
+
+
+class AsyncCoalesceTests(unittest.TestCase):
+    def setUp(self):
+        self.root = Root()
+
+    def test_async(self):
+        client = TestClient(self.root.asgi)
+
+        async def many_requests():
+            return await asyncio.gather(
+                *[client.get_async('/awaited') for _ in range(5)])
+        loop = asyncio.new_event_loop()
+        try:
+            responses = loop.run_until_complete(many_requests())
+        finally:
+            loop.close()
+        self.assertEqual(['awaited'], self.root.calls)
+        self.assertEqual([b'awaited'] * 5,
+                         [response.data for response in responses])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: et ts=4
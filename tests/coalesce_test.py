@@ -0,0 +1,107 @@
+"""Tests for coalescing identical concurrent requests."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import threading
+import time
+import unittest
+
+from werkzeug.exceptions import NotFound
+
+from pystapler.coalesce import coalesce
+from pystapler.dispatch import StaplerRoot, traversable
+from pystapler.response import plaintext
+
+
+class Root(StaplerRoot):
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    @traversable
+    @coalesce(vary=['page'], timeout=5)
+    @plaintext
+    def expensive(self, page='1', other='x'):
+        # pylint: disable=unused-argument
+        self.calls.append(page)
+        self.release.wait(5)
+        return 'page {} ({} calls)'.format(page, len(self.calls))
+
+    @traversable
+    @coalesce(timeout=0.05)
+    @plaintext
+    def very_slow(self):
+        self.calls.append('slow')
+        self.release.wait(5)
+        return 'slow'
+
+    @traversable
+    @coalesce
+    def missing(self):
+        self.calls.append('missing')
+        self.release.wait(5)
+        raise NotFound()
+
+
+class CoalesceTests(unittest.TestCase):
+    def setUp(self):
+        self.root = Root()
+
+    def concurrently(self, count, path, method='GET'):
+        """Sends count requests at once; returns the responses."""
+        responses = []
+
+        def send():
+            client = self.root.test_client()
+            responses.append(client.open(path, method=method))
+        threads = [threading.Thread(target=send) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 5
+        while not self.root.calls and time.time() < deadline:
+            time.sleep(0.01)
+        # Give the other threads time to join the flight.
+        time.sleep(0.1)
+        self.root.release.set()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def test_coalesced(self):
+        responses = self.concurrently(8, '/expensive?page=2&other=y')
+        self.assertEqual(['2'], self.root.calls)
+        self.assertEqual(8, len(responses))
+        for response in responses:
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(b'page 2 (1 calls)', response.data)
+
+    def test_sequential_requests_are_not_coalesced(self):
+        self.root.release.set()
+        client = self.root.test_client()
+        client.get('/expensive')
+        self.assertEqual(b'page 1 (2 calls)', client.get('/expensive').data)
+
+    def test_errors_are_shared(self):
+        responses = self.concurrently(4, '/missing')
+        self.assertEqual(['missing'], self.root.calls)
+        for response in responses:
+            self.assertEqual(404, response.status_code)
+
+    def test_timeout(self):
+        responses = self.concurrently(3, '/very_slow')
+        self.assertEqual(['slow'], self.root.calls)
+        self.assertEqual(
+            [200, 503, 503],
+            sorted(response.status_code for response in responses))
+
+    def test_post_is_not_coalesced(self):
+        self.root.release.set()
+        responses = self.concurrently(3, '/expensive', method='POST')
+        self.assertEqual(['1', '1', '1'], self.root.calls)
+        self.assertEqual(3, len(responses))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: et ts=4
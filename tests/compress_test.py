@@ -0,0 +1,153 @@
+"""Tests for compression of response bodies."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import gzip
+import io
+import unittest
+import zlib
+
+from werkzeug.wrappers import Response
+
+from pystapler.cache import ResponseCache, cached
+from pystapler.compress import Compressor
+from pystapler.config import StaplerConfig
+from pystapler.dispatch import StaplerRoot, traversable
+from pystapler.response import plaintext
+
+
+LONG_TEXT = u'spam, eggs, spam, spam, bacon and spam\n' * 100
+
+MENU_CACHE = ResponseCache()
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
+class CountingCompressor(Compressor):
+    def __init__(self, **kwargs):
+        Compressor.__init__(self, **kwargs)
+        self.bodies_compressed = 0
+
+    def compress_body(self, encoding, body):
+        self.bodies_compressed += 1
+        return Compressor.compress_body(self, encoding, body)
+
+
+class Config(StaplerConfig):
+    def __init__(self, compression):
+        self.compression = compression
+
+
+class Root(StaplerRoot):
+    # Replaces the StaplerRoot.config property with a plain attribute.
+    config = None
+
+    def __init__(self, compression):
+        self.config = Config(compression)
+
+    @traversable
+    @plaintext
+    def menu(self):
+        return LONG_TEXT
+
+    @traversable
+    @plaintext
+    def short(self):
+        return u'spam'
+
+    @traversable
+    def image(self):
+        return Response(b'\0' * 4096, mimetype='image/png')
+
+    @traversable
+    def stream(self):
+        return Response(
+            (LONG_TEXT for _ in range(3)), mimetype='text/html')
+
+    @traversable
+    def untouchable(self):
+        response = Response(LONG_TEXT, mimetype='text/plain')
+        response.headers['Cache-Control'] = 'no-transform'
+        return response
+
+    @traversable
+    @cached(MENU_CACHE)
+    @plaintext
+    def cached_menu(self):
+        return LONG_TEXT
+
+
+class CompressTests(unittest.TestCase):
+    def setUp(self):
+        self.compressor = CountingCompressor(encodings=('gzip', 'deflate'))
+        self.root = Root(self.compressor)
+        self.client = self.root.test_client()
+        MENU_CACHE.clear()
+
+    def get(self, path, accept_encoding='gzip, deflate', headers=()):
+        return self.client.get(
+            path, headers=[('Accept-Encoding', accept_encoding)] + list(
+                headers))
+
+    def test_gzip(self):
+        response = self.get('/menu')
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(
+            str(len(response.data)), response.headers['Content-Length'])
+        self.assertLess(len(response.data), len(LONG_TEXT))
+        self.assertEqual(LONG_TEXT.encode('utf-8'), gunzip(response.data))
+
+    def test_deflate_preferred_by_quality(self):
+        response = self.get('/menu', 'gzip;q=0.5, deflate')
+        self.assertEqual('deflate', response.headers['Content-Encoding'])
+        self.assertEqual(
+            LONG_TEXT.encode('utf-8'), zlib.decompress(response.data))
+
+    def test_not_accepted(self):
+        response = self.get('/menu', 'identity')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(LONG_TEXT.encode('utf-8'), response.data)
+
+    def test_skipped(self):
+        """Small bodies and incompressible types are sent as they are."""
+        for path in ('/short', '/image', '/untouchable'):
+            response = self.get(path)
+            self.assertNotIn('Content-Encoding', response.headers, path)
+        self.assertEqual(0, self.compressor.bodies_compressed)
+        self.assertEqual(1, self.compressor.skipped)
+
+    def test_stream(self):
+        response = self.get('/stream')
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(
+            LONG_TEXT.encode('utf-8') * 3, gunzip(response.data))
+        self.assertEqual(1, self.compressor.streamed)
+
+    def test_cached_body_compressed_once(self):
+        first = self.get('/cached_menu')
+        second = self.get('/cached_menu')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(LONG_TEXT.encode('utf-8'), gunzip(second.data))
+        self.assertEqual(1, self.compressor.bodies_compressed)
+        self.assertGreater(
+            MENU_CACHE.stats()['bytes'], len(LONG_TEXT) + len(first.data))
+
+    def test_cached_revalidation(self):
+        """A compressed copy carries a weak ETag that still gets a 304."""
+        etag = self.get('/cached_menu').headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response = self.get(
+            '/cached_menu', headers=[('If-None-Match', etag)])
+        self.assertEqual(304, response.status_code)
+
+    def test_disabled(self):
+        client = Root(None).test_client()
+        response = client.get('/menu', headers=[('Accept-Encoding', 'gzip')])
+        self.assertNotIn('Content-Encoding', response.headers)
+
+
+# vim: et ts=4
@@ -2,11 +2,15 @@
 # pylint: disable=missing-docstring,no-self-use,too-few-public-methods
 # pylint: disable=invalid-name
 
+from datetime import datetime
 import unittest
 
 from werkzeug.exceptions import BadRequest
+from werkzeug.http import http_date
 
+from pystapler import dispatch
 from pystapler.dispatch import StaplerRoot, traversable, default
+from pystapler.dispatch import etag, last_modified, _get_route_plans
 from pystapler.response import plaintext
 
 class Root(StaplerRoot):
@@ -38,6 +42,16 @@ class Root(StaplerRoot):
     def keyword_args(self, **kwargs):
         return Renderable(repr(kwargs.keys()))
 
+    @traversable
+    def mixed_args(self, spam, eggs='eggs', **kwargs):
+        return Renderable('{} {} {}'.format(spam, eggs, sorted(kwargs)))
+
+    @traversable
+    @plaintext
+    def stream_args(self, stream, **kwargs):
+        return u'{} {}'.format(
+            stream.read().decode('ascii'), sorted(kwargs))
+
 
 class Renderable(object):
     def __init__(self, text):
@@ -49,6 +63,111 @@ class Renderable(object):
         return self.text
 
 
+class Branch(object):
+    def __init__(self, depth):
+        self.depth = depth
+
+    @traversable(returns=Renderable)
+    def leaf(self):
+        return Renderable('leaf at {}'.format(self.depth))
+
+    @traversable
+    def shape_shifter(self, shape='branch'):
+        if shape == 'branch':
+            return Branch(self.depth + 1)
+        return Renderable(shape)
+
+
+class Tree(StaplerRoot):
+    @traversable(returns=Branch)
+    def trunk(self):
+        return Branch(1)
+
+    @traversable('limb', returns=Branch)
+    def untyped_trunk(self):
+        # Deliberately violates its own type declaration.
+        return Renderable('surprise')
+
+
+def returning(return_type):
+    """Annotates a method's return type, like "-> return_type" would."""
+    def annotate(method):
+        method.__annotations__ = {'return': return_type}
+        return method
+    return annotate
+
+
+class Seed(object):
+    @default
+    @plaintext
+    def render(self):
+        return 'seed'
+
+
+class Orchard(Tree):
+    @traversable
+    @returning(Seed)
+    def seed(self):
+        return Seed()
+
+    # Overrides Tree.untyped_trunk, so /limb no longer exists.
+    def untyped_trunk(self):
+        raise AssertionError('should never happen')
+
+
+class Registered(object):
+    @traversable
+    @plaintext
+    def anything(self):
+        return 'anything'
+
+
+class Conflicted(StaplerRoot):
+    reachable_types = [Registered]
+
+    @traversable('spam')
+    def eggs(self):
+        return Renderable('eggs')
+
+    @traversable
+    def spam(self):
+        return Renderable('spam')
+
+    @traversable('ham/spam')
+    def ham(self):
+        return Renderable('ham')
+
+
+class Article(object):
+    def __init__(self, counter, revision):
+        self.counter = counter
+        self.revision = revision
+
+    @etag
+    def version(self, lang='en'):
+        return '{}-{}'.format(self.revision, lang)
+
+    @last_modified
+    def modified(self):
+        return datetime(2017, 1, 2, 3, 4, 5, 678)
+
+    @default
+    @plaintext
+    def render(self, lang='en'):
+        self.counter.append(lang)
+        return 'revision {} in {}'.format(self.revision, lang)
+
+
+class Blog(StaplerRoot):
+    def __init__(self):
+        self.renders = []
+        self.revision = 1
+
+    @traversable(returns=Article)
+    def article(self):
+        return Article(self.renders, self.revision)
+
+
 class DispatchTests(unittest.TestCase):
     def setUp(self):
         self.client = Root().test_client()
@@ -97,5 +216,192 @@ class DispatchTests(unittest.TestCase):
         self.assertEquals(200, response.status_code)
         self.assertIn(b"'request'", response.data)
 
+    def test_keyword_args_without_body(self):
+        """**kwargs should not read the body; a named parameter can."""
+        response = self.client.post(
+            '/keyword_args?spam=1', data={'eggs': '2'})
+        self.assertIn(b"'spam'", response.data)
+        self.assertNotIn(b"'form'", response.data)
+        self.assertNotIn(b"'stream'", response.data)
+        response = self.client.post(
+            '/stream_args?spam=1', data=b'eggs=2',
+            content_type='application/x-www-form-urlencoded')
+        self.assertEqual(
+            b"eggs=2 ['args', 'request', 'spam']", response.data)
+
+    def test_mixed_args(self):
+        """Named parameters should not be repeated in **kwargs."""
+        response = self.client.get('/mixed_args?spam=1&self=2&ham=3')
+        self.assertEquals(200, response.status_code)
+        self.assertIn(b"1 eggs [", response.data)
+        self.assertIn(b"'ham'", response.data)
+        self.assertNotIn(b"'self'", response.data)
+        self.assertNotIn(b"'spam'", response.data)
+
+
+    def test_plain_methods_skip_invocation(self):
+        """Methods without memo, validators or limits are just called."""
+        def no_invocation(*args):
+            raise AssertionError('invoked a plain method through _Invocation')
+        original = dispatch._Invocation
+        dispatch._Invocation = no_invocation
+        self.addCleanup(setattr, dispatch, '_Invocation', original)
+        response = self.client.get('/hovercraft')
+        self.assertEquals(b'eggs', response.data)
+
+
+class RoutePlanTests(unittest.TestCase):
+    def setUp(self):
+        self.root = Tree()
+        self.client = self.root.test_client()
+        # Route plans are kept on the class; start each test without any.
+        self.plans = _get_route_plans(Tree)
+        self.plans.clear()
+
+    def test_recorded_plan(self):
+        """Repeated requests to the same path should reuse a route plan."""
+        key = ('trunk', 'shape_shifter', 'leaf')
+        response = self.client.get('/trunk/shape_shifter/leaf')
+        self.assertEqual(b'leaf at 2', response.data)
+        plan = self.plans[key]
+        executed = []
+        execute = plan.execute
+        plan.execute = lambda *args: executed.append(args) or execute(*args)
+        for _ in range(2):
+            response = self.client.get('/trunk/shape_shifter/leaf')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(b'leaf at 2', response.data)
+        self.assertEqual(2, len(executed))
+        self.assertEqual([key], list(self.plans))
+
+    def test_not_found_not_recorded(self):
+        """Paths that end in a 404 should not take up plans."""
+        response = self.client.get('/trunk/shape_shifter/nothing')
+        self.assertEqual(404, response.status_code)
+        self.assertEqual({}, self.plans)
+
+    def test_plan_limit(self):
+        """No more than MAX_ROUTE_PLANS paths should be recorded."""
+        self.addCleanup(
+            setattr, dispatch, 'MAX_ROUTE_PLANS', dispatch.MAX_ROUTE_PLANS)
+        dispatch.MAX_ROUTE_PLANS = 1
+        self.client.get('/trunk/shape_shifter/leaf')
+        response = self.client.get('/trunk/shape_shifter/shape_shifter/leaf')
+        self.assertEqual(b'leaf at 3', response.data)
+        self.assertEqual(
+            [('trunk', 'shape_shifter', 'leaf')], list(self.plans))
+
+    def test_type_guard(self):
+        """A plan should fall back if a method returns a different type."""
+        response = self.client.get('/trunk/shape_shifter/leaf')
+        self.assertEqual(b'leaf at 2', response.data)
+        response = self.client.get('/trunk/shape_shifter/leaf?shape=hedge')
+        self.assertEqual(404, response.status_code)
+        response = self.client.get('/trunk/shape_shifter?shape=hedge')
+        self.assertEqual(b'hedge', response.data)
+
+    def test_static_plans(self):
+        """Type-stable paths should be planned ahead of time."""
+        self.assertGreater(self.root.build_route_plans(max_depth=3), 0)
+        response = self.client.get('/trunk/leaf')
+        self.assertEqual(b'leaf at 1', response.data)
+
+    def test_wrong_return_type(self):
+        """A method that breaks its type declaration should still work."""
+        self.root.build_route_plans()
+        response = self.client.get('/limb')
+        self.assertEqual(b'surprise', response.data)
+
+    def test_without_plans(self):
+        """Route plans should be optional."""
+        self.root.config.route_plans = False
+        response = self.client.get('/trunk/shape_shifter/shape_shifter/leaf')
+        self.assertEqual(b'leaf at 3', response.data)
+
+
+class ConditionalTests(unittest.TestCase):
+    def setUp(self):
+        self.root = Blog()
+        self.client = self.root.test_client()
+
+    def test_validators_are_sent(self):
+        response = self.client.get('/article')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('"1-en"', response.headers['ETag'])
+        self.assertEqual('Mon, 02 Jan 2017 03:04:05 GMT',
+                         response.headers['Last-Modified'])
+
+    def test_not_modified(self):
+        """A current client copy should not be rendered again."""
+        for _ in range(2):
+            response = self.client.get(
+                '/article', headers={'If-None-Match': '"1-en"'})
+            self.assertEqual(304, response.status_code)
+            self.assertEqual('"1-en"', response.headers['ETag'])
+        self.assertEqual([], self.root.renders)
+
+    def test_if_modified_since(self):
+        response = self.client.get('/article', headers={
+            'If-Modified-Since': http_date(datetime(2017, 1, 2, 3, 4, 5))})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual([], self.root.renders)
+
+    def test_modified(self):
+        self.root.revision = 2
+        response = self.client.get(
+            '/article', headers={'If-None-Match': '"1-en"'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'revision 2 in en', response.data)
+        response = self.client.get(
+            '/article?lang=fr', headers={'If-None-Match': '"2-en"'})
+        self.assertEqual(b'revision 2 in fr', response.data)
+        self.assertEqual(['en', 'fr'], self.root.renders)
+
+    def test_without_route_plans(self):
+        self.root.config.route_plans = False
+        response = self.client.get(
+            '/article', headers={'If-None-Match': '"1-en"'})
+        self.assertEqual(304, response.status_code)
+
+    def test_post_is_rendered(self):
+        response = self.client.post(
+            '/article', headers={'If-None-Match': '"1-en"'})
+        self.assertEqual(200, response.status_code)
+
+
+class CompileTests(unittest.TestCase):
+    def test_inherited_routes(self):
+        """Traversable methods of base classes should be traversable."""
+        client = Orchard().test_client()
+        self.assertEqual(b'leaf at 1', client.get('/trunk/leaf').data)
+        self.assertEqual(b'seed', client.get('/seed').data)
+        self.assertEqual(404, client.get('/limb').status_code)
+        # The base class's own routes are unaffected by the subclass.
+        self.assertEqual(b'surprise', Tree().test_client().get('/limb').data)
+
+    def test_reachable_types(self):
+        """Declared and annotated return types should be compiled."""
+        report = Orchard().compile()
+        self.assertEqual(Orchard, report.types[0])
+        self.assertIn(Branch, report.types)
+        self.assertIn(Renderable, report.types)
+        self.assertIn(Seed, report.types)
+        self.assertGreater(report.methods, 0)
+        self.assertGreater(report.route_plans, 0)
+        self.assertEqual([], report.conflicts)
+        self.assertEqual([], report.unreachable)
+        self.assertIn('binder', Orchard.__dict__[
+            '_pystapler_traversal_map']['seed'].__dict__)
+
+    def test_conflicts_and_unreachable_routes(self):
+        """Conflicting and unreachable routes should be reported."""
+        report = Conflicted().compile()
+        self.assertIn(Registered, report.types)
+        self.assertEqual(1, len(report.conflicts))
+        self.assertIn('traversable as "spam"', report.conflicts[0])
+        self.assertEqual(2, len(report.unreachable))
+        self.assertIn('"ham/spam"', report.unreachable[0])
+        self.assertIn('Registered', report.unreachable[1])
+
 
 # vim: et ts=4
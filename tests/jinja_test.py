@@ -0,0 +1,94 @@
+"""Tests for the Jinja2 template environment."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pystapler.config import StaplerConfig
+from pystapler.dispatch import StaplerRoot, traversable
+from pystapler.jinja import JinjaEnvironment, main
+from pystapler.response import template
+
+
+class ProductionConfig(StaplerConfig):
+    debug = False
+
+
+class JinjaTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.templates = os.path.join(self.directory, 'templates')
+        self.cache = os.path.join(self.directory, 'cache')
+        os.mkdir(self.templates)
+        self.write('hello.html', u'Hello, {{ name }}!')
+        self.write('broken.html', u'{% if %}')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, source):
+        with open(os.path.join(self.templates, name), 'w') as template_file:
+            template_file.write(source)
+
+    def make_env(self, config=ProductionConfig):
+        return JinjaEnvironment(self.templates, config, self.cache)
+
+    def test_render(self):
+        env = self.make_env()
+
+        class Root(StaplerRoot):
+            @traversable
+            @template(env, 'hello.html')
+            def hello(self, name):
+                return {'name': name}
+
+        response = Root().test_client().get('/hello?name=<Brian>')
+        self.assertEqual(b'Hello, &lt;Brian&gt;!', response.data)
+
+    def test_reload_only_in_debug(self):
+        self.assertFalse(self.make_env().auto_reload)
+        self.assertTrue(self.make_env(StaplerConfig).auto_reload)
+        self.assertFalse(
+            JinjaEnvironment(self.templates, cache_directory=self.cache)
+            .auto_reload)
+
+    def test_precompile(self):
+        compiled, failed = self.make_env().precompile()
+        self.assertEqual(['hello.html'], compiled)
+        self.assertEqual(['broken.html'], failed)
+        self.assertEqual(1, len(os.listdir(self.cache)))
+
+    def test_bytecode_shared(self):
+        """A second environment loads the compiled template from disk."""
+        self.make_env().get_template('hello.html')
+        env = self.make_env()
+        compiled = []
+        env.compile = lambda *args, **kwargs: compiled.append(args)
+        self.assertEqual(
+            u'Hello, Tim!', env.get_template('hello.html').render(name='Tim'))
+        self.assertEqual([], compiled)
+
+
+ENV = None
+
+
+class MainTests(unittest.TestCase):
+    def test_main(self):
+        global ENV  # pylint: disable=global-statement
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'page.html'), 'w') as page:
+                page.write(u'{{ 1 + 1 }}')
+            ENV = JinjaEnvironment(
+                directory, ProductionConfig, os.path.join(directory, 'cache'))
+            self.assertEqual(0, main(['tests.jinja_test:ENV']))
+            self.assertEqual(
+                1, len(os.listdir(os.path.join(directory, 'cache'))))
+        finally:
+            ENV = None
+            shutil.rmtree(directory)
+
+
+# vim: et ts=4
@@ -0,0 +1,143 @@
+"""Tests for dynamic path segments and batched loading of children."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import json
+import unittest
+
+from pystapler.batch import Batch, BatchPage
+from pystapler.dispatch import (
+    PREFIX, StaplerRoot, default, traversable, traversable_dynamic)
+from pystapler.loader import Loader
+from pystapler.response import plaintext
+
+
+USERS = {'1': 'Arthur', '2': 'Lancelot', '3': 'Robin'}
+
+
+class User(object):
+    def __init__(self, user_id, name):
+        self.user_id = user_id
+        self.name = name
+
+    @traversable
+    @plaintext
+    def orders(self, limit='10'):
+        return u'{} orders of {}'.format(limit, self.name)
+
+    @default
+    @plaintext
+    def render(self):
+        return self.name
+
+
+class Users(object):
+    def __init__(self, loader):
+        self.loader = loader
+
+    @traversable
+    @plaintext
+    def count(self):
+        return str(len(USERS))
+
+    @traversable_dynamic
+    def user(self, user_id, request):
+        return self.loader.load(request, user_id)
+
+    def names(self):
+        """A helper method, which is not traversable."""
+        return sorted(USERS.values())
+
+    @default
+    @plaintext
+    def render(self, request, ids='1,2,3'):
+        handles = [self.loader.defer(request, key) for key in ids.split(',')]
+        return u','.join(
+            handle.value.name if handle.value else u'-' for handle in handles)
+
+
+def make_root(loader):
+    batch = Batch()
+
+    class Root(StaplerRoot):
+        @traversable
+        def users(self):
+            return Users(loader)
+
+        @traversable
+        def batch(self):
+            return BatchPage(batch, self)
+    return Root()
+
+
+class DynamicTests(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.loader = Loader(self.load, max_cached=2)
+        self.root = make_root(self.loader)
+        self.client = self.root.test_client()
+
+    def load(self, keys):
+        self.batches.append(sorted(keys))
+        return dict((key, User(key, USERS[key])) for key in keys
+                    if key in USERS)
+
+    def test_segment_bound(self):
+        response = self.client.get('/users/2/orders?limit=3')
+        self.assertEqual(b'3 orders of Lancelot', response.data)
+        self.assertEqual(b'Robin', self.client.get('/users/3').data)
+
+    def test_static_name_wins(self):
+        self.assertEqual(b'3', self.client.get('/users/count').data)
+        self.assertEqual([], self.batches)
+
+    def test_not_found(self):
+        self.assertEqual(404, self.client.get('/users/42').status_code)
+
+    def test_empty_segment(self):
+        """A trailing slash is not looked up as a child."""
+        self.assertEqual(404, self.client.get('/users/').status_code)
+        self.assertEqual([], self.batches)
+
+    def test_not_traversable_name(self):
+        """Names of helper methods do not hide children."""
+        self.assertEqual(404, self.client.get('/users/names').status_code)
+        self.assertEqual([['names']], self.batches)
+
+    def test_not_planned(self):
+        """Dynamic paths do not fill the route plan cache."""
+        self.client.get('/users/1')
+        self.client.get('/users/count')
+        plans = type(self.root).__dict__[PREFIX + 'route_plans']
+        self.assertEqual([('users', 'count')], list(plans))
+
+    def test_deferred_in_one_call(self):
+        response = self.client.get('/users?ids=3,1,42')
+        self.assertEqual(b'Robin,Arthur,-', response.data)
+        self.assertEqual([['1', '3', '42']], self.batches)
+
+    def test_lru(self):
+        self.client.get('/users/1')
+        self.client.get('/users/1')
+        self.assertEqual(1, self.loader.calls)
+        self.assertEqual(1, self.loader.hits)
+        self.client.get('/users/2')
+        self.client.get('/users/3')
+        self.client.get('/users/1')
+        self.assertEqual(4, self.loader.calls)
+        self.loader.invalidate()
+        self.client.get('/users/1')
+        self.assertEqual(5, self.loader.calls)
+
+    def test_shared_by_batch(self):
+        loader = Loader(self.load)
+        client = make_root(loader).test_client()
+        response = client.post('/batch', data=json.dumps(
+            ['/users/1', '/users/1/orders', '/users?ids=1,2']))
+        bodies = [item['body'] for item in json.loads(
+            response.data.decode('utf-8'))]
+        self.assertEqual(
+            ['Arthur', '10 orders of Arthur', 'Arthur,Lancelot'], bodies)
+        self.assertEqual([['1'], ['2']], self.batches)
+
+
+# vim: et ts=4
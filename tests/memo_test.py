@@ -0,0 +1,130 @@
+"""Tests for memoizing traversable methods."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import gc
+import time
+import unittest
+
+from pystapler.dispatch import StaplerRoot, traversable, default
+from pystapler.memo import MISSING, Memo, memoized
+from pystapler.response import plaintext
+
+
+class Child(object):
+    def __init__(self, text):
+        self.text = text
+
+    @default
+    @plaintext
+    def render(self):
+        return self.text
+
+
+class Parent(object):
+    """A weakly referenceable key for memos."""
+
+
+class Root(StaplerRoot):
+    def __init__(self):
+        self.loads = 0
+
+    @traversable(memoize=True)
+    def settings(self, section='main'):
+        self.loads += 1
+        return Child('{} {}'.format(section, self.loads))
+
+    @traversable(memoize=0.05)
+    def volatile(self):
+        self.loads += 1
+        return Child('volatile {}'.format(self.loads))
+
+    @traversable(memoize=True)
+    @plaintext
+    def response(self):
+        self.loads += 1
+        return 'response {}'.format(self.loads)
+
+
+class MemoizedDispatchTests(unittest.TestCase):
+    def setUp(self):
+        self.root = Root()
+        self.client = self.root.test_client()
+
+    def test_memoized(self):
+        self.assertEqual(b'main 1', self.client.get('/settings').data)
+        self.assertEqual(b'main 1', self.client.get('/settings').data)
+        self.assertEqual(b'main 1',
+                         self.client.get('/settings?section=main').data)
+        self.assertEqual(b'other 2',
+                         self.client.get('/settings?section=other').data)
+        self.assertEqual(2, self.root.loads)
+
+    def test_per_instance(self):
+        self.client.get('/settings')
+        other = Root()
+        self.assertEqual(b'main 1', other.test_client().get('/settings').data)
+
+    def test_ttl(self):
+        self.assertEqual(b'volatile 1', self.client.get('/volatile').data)
+        self.assertEqual(b'volatile 1', self.client.get('/volatile').data)
+        time.sleep(0.1)
+        self.assertEqual(b'volatile 2', self.client.get('/volatile').data)
+
+    def test_invalidate(self):
+        self.client.get('/settings')
+        self.client.get('/settings?section=other')
+        memoized(Root.settings).invalidate(self.root, 'main')
+        self.assertEqual(b'main 3', self.client.get('/settings').data)
+        self.assertEqual(b'other 2',
+                         self.client.get('/settings?section=other').data)
+        memoized(Root.settings).invalidate(self.root)
+        self.assertEqual(b'other 4',
+                         self.client.get('/settings?section=other').data)
+        memoized(Root.settings).invalidate('other', parent=self.root)
+        self.assertEqual(b'other 5',
+                         self.client.get('/settings?section=other').data)
+        self.assertRaises(
+            TypeError, memoized(Root.settings).invalidate, section='other')
+
+    def test_responses_are_not_memoized(self):
+        self.assertEqual(b'response 1', self.client.get('/response').data)
+        self.assertEqual(b'response 2', self.client.get('/response').data)
+
+    def test_injected_parameters_are_rejected(self):
+        class Bad(StaplerRoot):
+            @traversable(memoize=True)
+            def form_page(self, form):
+                return Child(form)
+        with self.assertRaises(TypeError):
+            Bad().compile()
+
+
+class MemoTests(unittest.TestCase):
+    def test_max_entries(self):
+        memo = Memo(max_entries=2)
+        parent = Parent()
+        for key in ('a', 'b', 'c'):
+            memo.store(parent, (key,), key)
+        self.assertIs(MISSING, memo.lookup(parent, ('a',)))
+        self.assertEqual('c', memo.lookup(parent, ('c',)))
+
+    def test_weak_parents(self):
+        memo = Memo()
+        parent = Parent()
+        memo.store(parent, (), 'child')
+        self.assertEqual('child', memo.lookup(parent, ()))
+        del parent
+        gc.collect()
+        memo.invalidate()  # Must not fail on collected parents.
+
+    def test_unreferenceable_parent(self):
+        memo = Memo()
+        memo.store(42, (), 'child')
+        self.assertIs(MISSING, memo.lookup(42, ()))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: et ts=4
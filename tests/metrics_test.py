@@ -0,0 +1,135 @@
+"""Tests for per-request timing metrics."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import threading
+import unittest
+
+from pystapler.config import StaplerConfig
+from pystapler.dispatch import StaplerRoot, traversable, default
+from pystapler.metrics import Metrics, MetricsPage
+from pystapler.response import plaintext
+
+
+class Config(StaplerConfig):
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+
+class User(object):
+    def __init__(self, name):
+        self.name = name
+
+    @default
+    @plaintext
+    def show(self):
+        return self.name
+
+
+class Root(StaplerRoot):
+    # Replaces the StaplerRoot.config property with a plain attribute.
+    config = None
+
+    def __init__(self, metrics, route_plans=True):
+        self.config = Config(metrics)
+        self.config.route_plans = route_plans
+
+    @traversable
+    def user(self, name):
+        return User(name)
+
+    @traversable
+    def metrics(self):
+        return MetricsPage(self.config.metrics)
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.client = Root(self.metrics).test_client()
+
+    def render(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.headers['Content-Type'].startswith(
+            'text/plain; version=0.0.4'))
+        return response.get_data(as_text=True)
+
+    def test_routes(self):
+        self.client.get('/user?name=arthur')
+        self.client.get('/user?name=ford')
+        self.client.get('/nothing')
+        text = self.render()
+        self.assertIn(
+            'pystapler_request_duration_seconds_count'
+            '{route="user/show",phase="total"} 2', text)
+        self.assertIn(
+            'pystapler_request_duration_seconds_count'
+            '{route="user/show",phase="render"} 2', text)
+        self.assertIn(
+            'pystapler_hop_duration_seconds_count'
+            '{route="user/show",hop="user"} 2', text)
+        self.assertIn(
+            'pystapler_responses_total{route="user/show",status="200"} 2',
+            text)
+        self.assertIn(
+            'pystapler_responses_total{route="<none>",status="404"} 1', text)
+
+    def test_buckets_are_cumulative(self):
+        self.client.get('/user?name=arthur')
+        text = self.render()
+        self.assertIn(
+            'pystapler_request_duration_seconds_bucket'
+            '{route="user/show",phase="params",le="+Inf"} 1', text)
+        self.assertIn('# TYPE pystapler_request_duration_seconds histogram',
+                      text)
+
+    def test_without_route_plans(self):
+        client = Root(self.metrics, route_plans=False).test_client()
+        self.assertEqual(b'zaphod', client.get('/user?name=zaphod').data)
+        self.assertEqual(400, client.get('/user').status_code)
+        text = self.render()
+        self.assertIn(
+            'pystapler_responses_total{route="user/show",status="200"} 1',
+            text)
+        self.assertIn(
+            'pystapler_responses_total{route="<none>",status="400"} 1', text)
+
+    def test_threads_are_merged(self):
+        def send_requests():
+            for _ in range(10):
+                Root(self.metrics).test_client().get('/user?name=trillian')
+        threads = [threading.Thread(target=send_requests) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIn(
+            'pystapler_responses_total{route="user/show",status="200"} 40',
+            self.render())
+
+    def test_exited_threads_are_folded(self):
+        """The metrics of threads that exit are kept, but not per thread."""
+        def send_request():
+            Root(self.metrics).test_client().get('/user?name=zaphod')
+        for _ in range(5):
+            thread = threading.Thread(target=send_request)
+            thread.start()
+            thread.join()
+        self.assertIn(
+            'pystapler_responses_total{route="user/show",status="200"} 5',
+            self.render())
+        # Only the thread that rendered the metrics is still tracked.
+        # pylint: disable=protected-access
+        self.assertEqual(1, len(self.metrics._Metrics__threads))
+
+    def test_label_escaping(self):
+        metrics = Metrics()
+        metrics.record([], 0.0, 0.0, 0.0, 'a"b\\c\n')
+        self.assertIn(r'status="a\"b\\c\n"', metrics.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: et ts=4
@@ -0,0 +1,133 @@
+"""Tests for reloading changed modules in place."""
+# pylint: disable=missing-docstring,no-self-use
+
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from pystapler.reload import Reloader
+
+
+ORIGINAL = '''
+from pystapler.dispatch import StaplerRoot, traversable
+from pystapler.response import plaintext
+
+
+class Base(StaplerRoot):
+    @traversable
+    @plaintext
+    def greeting(self):
+        return 'hello'
+
+
+class Root(Base):
+    def __init__(self):
+        self.visits = 0
+
+    @traversable
+    @plaintext
+    def count(self):
+        self.visits += 1
+        return str(self.visits)
+'''
+
+CHANGED = '''
+from pystapler.dispatch import StaplerRoot, traversable
+from pystapler.response import plaintext
+
+
+class Base(StaplerRoot):
+    @traversable
+    @plaintext
+    def greeting(self):
+        return 'bonjour'
+
+    def shout(self):
+        return 'HEY'
+
+
+class Root(Base):
+    def __init__(self):
+        self.visits = 0
+
+    @traversable
+    @plaintext
+    def count(self):
+        self.visits += 10
+        return str(self.visits)
+
+    @traversable
+    @plaintext
+    def shout(self):
+        return super().shout() + '!'
+'''
+
+
+class ReloadTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'reloadable_app.py')
+        self.write(ORIGINAL)
+        sys.path.insert(0, self.directory)
+        import reloadable_app  # pylint: disable=import-error
+        self.module = reloadable_app
+        self.root = reloadable_app.Root()
+        self.reloader = Reloader(self.root, interval=0)
+        self.client = Client(self.reloader, BaseResponse)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        del sys.modules['reloadable_app']
+        shutil.rmtree(self.directory)
+
+    def write(self, source, age=0):
+        with open(self.path, 'w') as source_file:
+            source_file.write(textwrap.dedent(source))
+        # Make sure the modification time differs from the previous one.
+        mtime = time.time() + age
+        os.utime(self.path, (mtime, mtime))
+        if os.path.exists(self.path + 'c'):
+            os.remove(self.path + 'c')
+
+    def test_reload_keeps_state(self):
+        self.assertEqual(b'hello', self.client.get('/greeting').data)
+        self.assertEqual(b'1', self.client.get('/count').data)
+        root_class = type(self.root)
+        self.write(CHANGED, age=10)
+        self.assertEqual(b'bonjour', self.client.get('/greeting').data)
+        self.assertEqual(b'11', self.client.get('/count').data)
+        self.assertIs(root_class, self.module.Root)
+        report = self.reloader.reloads[-1]
+        self.assertEqual(['reloadable_app'], report.modules)
+        self.assertEqual(
+            set(['Base', 'Root']),
+            set(cls.__name__ for cls in report.classes))
+        self.assertGreater(report.seconds, 0)
+
+    def test_new_route_and_super(self):
+        self.assertEqual(404, self.client.get('/shout').status_code)
+        self.write(CHANGED, age=10)
+        if sys.version_info < (3, 7):
+            self.skipTest('super() is only rebound on Python 3.7+')
+        self.assertEqual(b'HEY!', self.client.get('/shout').data)
+
+    def test_unchanged(self):
+        self.client.get('/greeting')
+        self.assertIsNone(self.reloader.check())
+        self.assertEqual([], self.reloader.reloads)
+
+    def test_failed_reload_keeps_old_code(self):
+        self.write('class Root(:\n', age=10)
+        self.assertEqual(b'hello', self.client.get('/greeting').data)
+        self.assertEqual(['reloadable_app'], self.reloader.reloads[-1].failed)
+        self.assertIs(type(self.root), self.module.Root)
+
+
+# vim: et ts=4
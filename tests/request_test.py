@@ -0,0 +1,192 @@
+"""Tests for extracting injectable parameters from requests."""
+# pylint: disable=missing-docstring,too-few-public-methods
+
+from io import BytesIO
+import json
+import unittest
+
+from werkzeug.datastructures import MultiDict
+
+from pystapler.config import StaplerConfig
+from pystapler.dispatch import StaplerRoot, traversable
+from pystapler.request import RequestParams
+from pystapler.response import json_response, plaintext
+
+
+class FakeRequest(object):
+    """A stand-in for a Werkzeug request that records body access."""
+    mimetype = 'application/json'
+    content_length = None
+
+    def __init__(self, query):
+        self.args = MultiDict(query)
+        self.accessed = []
+
+    @property
+    def form(self):
+        self.accessed.append('form')
+        return MultiDict()
+
+    @property
+    def stream(self):
+        self.accessed.append('stream')
+        return BytesIO()
+
+    @property
+    def files(self):
+        self.accessed.append('files')
+        return MultiDict()
+
+    def get_data(self, as_text=False):
+        # pylint: disable=unused-argument
+        self.accessed.append('data')
+        return '{"spam": "eggs"}'
+
+
+class RequestParamsTests(unittest.TestCase):
+    def setUp(self):
+        self.request = FakeRequest([('spam', '1'), ('spam', '2'), ('ham', '')])
+        self.params = RequestParams(self.request)
+
+    def test_query_args(self):
+        """Query string parameters should map to their first value."""
+        self.assertEqual('1', self.params['spam'])
+        self.assertEqual('', self.params.get('ham'))
+        self.assertIsNone(self.params.get('eggs'))
+        self.assertRaises(KeyError, lambda: self.params['eggs'])
+
+    def test_multiple_values(self):
+        """All the values of a parameter should be available."""
+        self.assertEqual(['1', '2'], self.params.getlist('spam'))
+        self.assertEqual(['1', '2'], self.params['args'].getlist('spam'))
+
+    def test_lazy_body(self):
+        """The request body should only be read when asked for."""
+        self.assertIn('form', self.params)
+        self.assertEqual('1', self.params['spam'])
+        self.assertEqual([], self.request.accessed)
+        self.assertEqual({'spam': 'eggs'}, self.params['json'])
+        self.assertEqual({'spam': 'eggs'}, self.params['json'])
+        self.assertEqual(['data'], self.request.accessed)
+
+    def test_reserved_names(self):
+        """Injectables win over query parameters with the same name."""
+        request = FakeRequest([('json', 'query'), ('files', 'query')])
+        params = RequestParams(request)
+        self.assertEqual({'spam': 'eggs'}, params['json'])
+        self.assertEqual({'spam': 'eggs'}, params.get('json'))
+        self.assertEqual(MultiDict(), params.get('files'))
+        self.assertEqual('query', params['args']['json'])
+        self.assertEqual(['query'], params['args'].getlist('files'))
+
+    def test_mapping(self):
+        """The parameters should behave like a read-only dictionary."""
+        self.assertIs(self.request, self.params['request'])
+        self.assertEqual(
+            {'spam', 'ham', 'request', 'args', 'form', 'json', 'stream',
+             'files'},
+            set(self.params))
+        self.assertEqual(8, len(self.params))
+        self.assertEqual('1', dict(self.params)['spam'])
+
+
+class UploadConfig(StaplerConfig):
+    max_body_size = 1024
+    spool_memory_size = 16
+
+
+class UploadRoot(StaplerRoot):
+    config = UploadConfig()
+
+    def __init__(self):
+        self.streams = []
+
+    @traversable
+    @plaintext
+    def upload(self, stream):
+        self.streams.append(stream)
+        return u'{}:{}'.format(
+            stream.__class__.__name__, len(stream.read()))
+
+    @traversable
+    @json_response
+    def parsed(self, json):  # pylint: disable=redefined-outer-name
+        return {'body': json}
+
+    @traversable
+    @plaintext
+    def attach(self, files):
+        upload = files['attachment']
+        return u'{}:{}'.format(upload.filename, len(upload.read()))
+
+
+class BodyTests(unittest.TestCase):
+    def setUp(self):
+        self.root = UploadRoot()
+        self.client = self.root.test_client()
+
+    def test_stream(self):
+        """A body asked for as a stream is spooled, even past memory."""
+        response = self.client.post('/upload', data=b'x' * 100)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'SpooledTemporaryFile:100', response.data)
+
+    def test_stream_closed(self):
+        """The spooled body is closed once the response has been sent."""
+        self.client.post('/upload', data=b'x' * 100, buffered=True)
+        self.assertTrue(self.root.streams[0].closed)
+
+    def test_declared_too_large(self):
+        """A body whose Content-Length is over the limit is never read."""
+        response = self.client.post('/upload', data=b'x' * 2048)
+        self.assertEqual(413, response.status_code)
+
+    def test_undeclared_too_large(self):
+        """A body without a Content-Length is cut off at the limit."""
+        response = self.client.post(
+            '/upload', input_stream=BytesIO(b'x' * 2048),
+            environ_overrides={'wsgi.input_terminated': True})
+        self.assertEqual(413, response.status_code)
+
+    def test_json(self):
+        for content_type, body, expected in (
+                ('application/json', b'{"n": 1}', {'n': 1}),
+                ('application/vnd.api+json', b'[1]', [1]),
+                ('application/json', b'{not json', None),
+                ('text/plain', b'{"n": 1}', None)):
+            response = self.client.post(
+                '/parsed', data=body, content_type=content_type)
+            self.assertEqual(
+                {'body': expected},
+                json.loads(response.data.decode('utf-8')), content_type)
+
+    def test_files(self):
+        response = self.client.post('/attach', data={
+            'attachment': (BytesIO(b'spam' * 64), 'spam.txt')})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'spam.txt:256', response.data)
+
+
+class FormRoot(StaplerRoot):
+    @traversable
+    @plaintext
+    def submit(self, form):
+        return u'{}'.format(len(form['data']))
+
+
+class FormLimitTests(unittest.TestCase):
+    data = {'data': 'x' * (1024 * 1024)}
+
+    def test_no_limit_by_default(self):
+        response = FormRoot().test_client().post('/submit', data=self.data)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'1048576', response.data)
+
+    def test_limit(self):
+        root = FormRoot()
+        root.config.max_form_memory_size = 1024
+        response = root.test_client().post('/submit', data=self.data)
+        self.assertEqual(413, response.status_code)
+
+
+# vim: et ts=4
@@ -0,0 +1,339 @@
+"""Tests for the response helper decorators."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+from datetime import date
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+
+from werkzeug.test import create_environ, run_wsgi_app
+
+from pystapler import response as response_module
+from pystapler.dispatch import StaplerRoot, traversable
+from pystapler.response import (
+    _json_encoder, binary, json_response, template)
+
+
+class FakeTemplate(object):
+    """A template that renders a list of items, one line per item."""
+    def __init__(self):
+        self.generated = []
+
+    def render(self, **template_vars):
+        return u''.join(self.generate(**template_vars))
+
+    def generate(self, items):
+        yield u'<ul>\n'
+        for item in items:
+            self.generated.append(item)
+            yield u'<li>{}</li>\n'.format(item)
+        yield u'</ul>\n'
+
+
+class FakeEnvironment(object):
+    def __init__(self):
+        self.template = FakeTemplate()
+        self.lookups = 0
+
+    def get_template(self, name):
+        assert name == 'list.html'
+        self.lookups += 1
+        return self.template
+
+
+ENV = FakeEnvironment()
+
+
+class Root(StaplerRoot):
+    @traversable
+    @template(ENV, 'list.html')
+    def rendered(self):
+        return {'items': [u'spam', u'eggs']}
+
+    @traversable
+    @template(ENV, 'list.html', stream=True, buffer_size=16)
+    def streamed(self):
+        return {'items': [u'spam', u'eggs', u'ham']}
+
+    @traversable
+    @template(ENV, 'list.html', stream=True, buffer_size=0)
+    def unbuffered(self):
+        return {'items': [u'spam']}
+
+
+class TemplateTests(unittest.TestCase):
+    def setUp(self):
+        self.root = Root()
+        self.client = self.root.test_client()
+
+    def test_rendered(self):
+        response = self.client.get('/rendered')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            'text/html; charset=utf-8', response.headers['Content-Type'])
+        self.assertEqual(
+            b'<ul>\n<li>spam</li>\n<li>eggs</li>\n</ul>\n', response.data)
+
+    def test_streamed(self):
+        """A streamed template should be rendered while being sent."""
+        ENV.template.generated = []
+        app_iter, status, _ = run_wsgi_app(
+            self.root, create_environ('/streamed'), buffered=False)
+        self.assertEqual('200 OK', status)
+        chunks = []
+        for chunk in app_iter:
+            chunks.append(chunk)
+            if len(chunks) == 1:
+                # Only enough of the template to fill the buffer has been
+                # rendered so far.
+                self.assertEqual([u'spam'], ENV.template.generated)
+        self.assertEqual(
+            b'<ul>\n<li>spam</li>\n<li>eggs</li>\n<li>ham</li>\n</ul>\n',
+            b''.join(chunks))
+        self.assertEqual(
+            [b'<ul>\n<li>spam</li>\n', b'<li>eggs</li>\n<li>ham</li>\n',
+             b'</ul>\n'], chunks)
+
+    def test_unbuffered(self):
+        response = self.client.get('/unbuffered')
+        self.assertEqual(b'<ul>\n<li>spam</li>\n</ul>\n', response.data)
+        self.assertNotIn('Content-Length', response.headers)
+
+    def test_lazy_lookup(self):
+        """Templates are looked up on first render, then reused."""
+        env = FakeEnvironment()
+        decorate = template(env, 'list.html')
+        method = decorate(lambda self: {'items': []})
+        self.assertEqual(0, env.lookups)
+        method(None)
+        method(None)
+        self.assertEqual(1, env.lookups)
+        env.auto_reload = True
+        method(None)
+        self.assertEqual(2, env.lookups)
+
+
+class RecordingFileWrapper(object):
+    """A wsgi.file_wrapper that records the files it was given."""
+    wrapped = []
+
+    def __init__(self, file_obj, block_size=8192):
+        self.wrapped.append(file_obj)
+        self.file_obj = file_obj
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.file_obj.read(self.block_size), b'')
+
+    def close(self):
+        self.file_obj.close()
+
+
+class BinaryRoot(StaplerRoot):
+    def __init__(self, path):
+        self.path = path
+        self.opened = []
+
+    @traversable
+    def raw(self):
+        return b'\x00\x01\x02'
+
+    @traversable
+    @binary(content_type='image/png')
+    def image(self):
+        return bytearray(b'\x89PNG')
+
+    @traversable
+    @binary
+    def view(self):
+        return memoryview(b'0123456789')[2:5]
+
+    @traversable
+    @binary(content_type='text/plain')
+    def file(self):
+        file_obj = open(self.path, 'rb')
+        file_obj.seek(6)
+        self.opened.append(file_obj)
+        return file_obj
+
+    @traversable
+    def mapped(self):
+        with open(self.path, 'rb') as file_obj:
+            return mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @traversable
+    @binary(content_type='text/csv')
+    def generated(self):
+        yield u'a,b\n'
+        yield b'1,2\n'
+
+
+class BinaryTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'file.txt')
+        with open(path, 'wb') as file_obj:
+            file_obj.write(b'hello world')
+        self.root = BinaryRoot(path)
+        self.client = self.root.test_client()
+        RecordingFileWrapper.wrapped = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def send(self, path, method='GET'):
+        environ = create_environ(path, method=method)
+        environ['wsgi.file_wrapper'] = RecordingFileWrapper
+        app_iter, status, headers = run_wsgi_app(
+            self.root, environ, buffered=True)
+        return status, headers, b''.join(app_iter)
+
+    def test_bytes(self):
+        response = self.client.get('/raw')
+        self.assertEqual(b'\x00\x01\x02', response.data)
+        self.assertEqual('application/octet-stream',
+                         response.headers['Content-Type'])
+        self.assertEqual('3', response.headers['Content-Length'])
+
+    def test_buffers(self):
+        response = self.client.get('/image')
+        self.assertEqual(b'\x89PNG', response.data)
+        self.assertEqual('image/png', response.headers['Content-Type'])
+        response = self.client.get('/view')
+        self.assertEqual(b'234', response.data)
+        self.assertEqual('3', response.headers['Content-Length'])
+
+    def test_file_wrapper(self):
+        status, headers, body = self.send('/file')
+        self.assertEqual('200 OK', status)
+        self.assertEqual(b'world', body)
+        self.assertEqual('5', headers['Content-Length'])
+        self.assertEqual(self.root.opened, RecordingFileWrapper.wrapped)
+        self.assertTrue(self.root.opened[0].closed)
+
+    def test_head_closes_file(self):
+        status, _, body = self.send('/file', method='HEAD')
+        self.assertEqual('200 OK', status)
+        self.assertEqual(b'', body)
+        self.assertEqual([], RecordingFileWrapper.wrapped)
+        self.assertTrue(self.root.opened[0].closed)
+
+    def test_mmap(self):
+        _, headers, body = self.send('/mapped')
+        self.assertEqual(b'hello world', body)
+        self.assertEqual('11', headers['Content-Length'])
+        self.assertEqual(1, len(RecordingFileWrapper.wrapped))
+
+    def test_generator(self):
+        response = self.client.get('/generated')
+        self.assertEqual(b'a,b\n1,2\n', response.data)
+        self.assertTrue(
+            response.headers['Content-Type'].startswith('text/csv'))
+        self.assertNotIn('Content-Length', response.headers)
+
+
+class JsonRoot(StaplerRoot):
+    def __init__(self):
+        self.generated = []
+
+    @traversable
+    @json_response
+    def document(self):
+        return {'spam': [1, 2], 'eggs': u'caf\u00e9'}
+
+    @traversable
+    @json_response(buffer_size=0)
+    def records(self, count='3'):
+        for number in range(int(count)):
+            self.generated.append(number)
+            yield {'n': number}
+
+    @traversable
+    @json_response(ndjson=True)
+    def lines(self):
+        yield {'n': 1}
+        yield {'n': 2}
+
+    @traversable
+    @json_response(default=str)
+    def dated(self):
+        return {'day': date(2017, 6, 1)}
+
+
+class JsonTests(unittest.TestCase):
+    def setUp(self):
+        self.root = JsonRoot()
+        self.client = self.root.test_client()
+
+    def test_document(self):
+        response = self.client.get('/document')
+        self.assertEqual(
+            'application/json', response.headers['Content-Type'])
+        self.assertEqual(
+            str(len(response.data)), response.headers['Content-Length'])
+        self.assertEqual(
+            {'spam': [1, 2], 'eggs': u'caf\u00e9'},
+            json.loads(response.data.decode('utf-8')))
+
+    def test_streamed_array(self):
+        """Records should be encoded while the response is being sent."""
+        app_iter, _, headers = run_wsgi_app(
+            self.root, create_environ('/records'), buffered=False)
+        self.assertNotIn('Content-Length', headers)
+        chunks = []
+        for chunk in app_iter:
+            chunks.append(chunk)
+            if len(chunks) == 2:
+                self.assertEqual([0], self.root.generated)
+        self.assertEqual(
+            [{'n': 0}, {'n': 1}, {'n': 2}],
+            json.loads(b''.join(chunks).decode('utf-8')))
+
+    def test_empty_array(self):
+        response = self.client.get('/records?count=0')
+        self.assertEqual(b'[]', response.data)
+
+    def test_ndjson(self):
+        response = self.client.get('/lines')
+        self.assertEqual(
+            'application/x-ndjson', response.headers['Content-Type'])
+        self.assertEqual(
+            [{'n': 1}, {'n': 2}],
+            [json.loads(line.decode('utf-8'))
+             for line in response.data.splitlines()])
+
+    def test_default(self):
+        response = self.client.get('/dated')
+        self.assertEqual(
+            {'day': '2017-06-01'}, json.loads(response.data.decode('utf-8')))
+
+
+class JsonEncoderTests(unittest.TestCase):
+    """The orjson and json module encoders should produce the same JSON."""
+
+    def encoders(self):
+        encoders = []
+        if response_module.orjson is not None:
+            encoders.append(('orjson', _json_encoder(str)))
+        saved = response_module.orjson
+        response_module.orjson = None
+        try:
+            encoders.append(('json', _json_encoder(str)))
+        finally:
+            response_module.orjson = saved
+        return encoders
+
+    def test_encoders(self):
+        value = {1: u'caf\u00e9', 'day': date(2017, 6, 1), 'n': [1.5, None]}
+        for name, encode in self.encoders():
+            encoded = encode(value)
+            self.assertIsInstance(encoded, bytes, name)
+            self.assertEqual(
+                {'1': u'caf\u00e9', 'day': '2017-06-01', 'n': [1.5, None]},
+                json.loads(encoded.decode('utf-8')), name)
+
+
+# vim: et ts=4
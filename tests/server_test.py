@@ -28,6 +28,9 @@ class Root(StaplerRoot):
 
 
 class ServerTestCase(unittest.TestCase):
+    # Configuration attributes to set on the server's StaplerConfig.
+    config = {}
+
     @classmethod
     def setUpClass(cls):
         cls.port = _find_unused_port()
@@ -36,6 +39,8 @@ class ServerTestCase(unittest.TestCase):
             root = Root()
             root.config.port = cls.port
             root.config.debug = False
+            for name, value in cls.config.items():
+                setattr(root.config, name, value)
             main(root)
 
         cls.server = multiprocessing.Process(target=test_server)
@@ -69,4 +74,15 @@ class ServerTestCase(unittest.TestCase):
                           self.execute_get('/hello?name=Daniel'))
 
 
+class PreforkServerTestCase(ServerTestCase):
+    config = {'workers': 2, 'threads': 2, 'max_requests': 3}
+
+    def test_recycling(self):
+        """Requests should keep working while workers are recycled."""
+        for index in range(20):
+            self.assertEquals(
+                'Hello, {}!'.format(index).encode('ascii'),
+                self.execute_get('/hello?name={}'.format(index)))
+
+
 # vim: et ts=4
@@ -0,0 +1,99 @@
+"""Tests for serving static files."""
+# pylint: disable=missing-docstring,no-self-use
+
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from pystapler.dispatch import StaplerRoot
+from pystapler.static import static_root
+
+
+class StaticTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'css'))
+        with open(os.path.join(self.directory, 'css', 'site.css'), 'wb') as f:
+            f.write(b'body { color: red; }')
+        with gzip.open(
+                os.path.join(self.directory, 'css', 'site.css.gz'), 'wb') as f:
+            f.write(b'body { color: red; }')
+        with open(os.path.join(self.directory, 'logo.png'), 'wb') as f:
+            f.write(b'0123456789')
+
+        class Root(StaplerRoot):
+            assets = static_root(self.directory, refresh_interval=60)
+
+        self.client = Root().test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_file(self):
+        response = self.client.get('/assets/logo.png')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'0123456789', response.data)
+        self.assertEqual('image/png', response.headers['Content-Type'])
+        self.assertEqual('10', response.headers['Content-Length'])
+        self.assertIn('ETag', response.headers)
+        self.assertIn('Last-Modified', response.headers)
+
+    def test_not_found(self):
+        self.assertEqual(404, self.client.get('/assets/nothing').status_code)
+        self.assertEqual(404, self.client.get('/assets/css').status_code)
+        self.assertEqual(404, self.client.get('/assets').status_code)
+
+    def test_escape(self):
+        """Paths outside the directory should never be served."""
+        self.assertEqual(
+            404, self.client.get('/assets/../etc/passwd').status_code)
+        self.assertEqual(
+            404, self.client.get('/assets/css/%2e%2e/logo.png').status_code)
+
+    def test_method(self):
+        self.assertEqual(405, self.client.post('/assets/logo.png').status_code)
+
+    def test_not_modified(self):
+        response = self.client.get('/assets/logo.png')
+        etag = response.headers['ETag']
+        response = self.client.get(
+            '/assets/logo.png', headers=[('If-None-Match', etag)])
+        self.assertEqual(304, response.status_code)
+        last_modified = self.client.get(
+            '/assets/logo.png').headers['Last-Modified']
+        response = self.client.get(
+            '/assets/logo.png', headers=[('If-Modified-Since', last_modified)])
+        self.assertEqual(304, response.status_code)
+
+    def test_range(self):
+        response = self.client.get(
+            '/assets/logo.png', headers=[('Range', 'bytes=2-5')])
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'2345', response.data)
+        self.assertEqual('bytes 2-5/10', response.headers['Content-Range'])
+
+    def test_precompressed(self):
+        response = self.client.get(
+            '/assets/css/site.css', headers=[('Accept-Encoding', 'gzip')])
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertTrue(
+            response.headers['Content-Type'].startswith('text/css'))
+        self.assertEqual(
+            b'body { color: red; }',
+            gzip.GzipFile(fileobj=io.BytesIO(response.data)).read())
+        response = self.client.get('/assets/css/site.css')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(b'body { color: red; }', response.data)
+
+    def test_stat_cache(self):
+        """A deleted file should still be known until the cache expires."""
+        self.client.get('/assets/logo.png')
+        os.unlink(os.path.join(self.directory, 'logo.png'))
+        # The stat() result is cached, but opening the file fails.
+        self.assertEqual(404, self.client.get('/assets/logo.png').status_code)
+
+
+# vim: et ts=4
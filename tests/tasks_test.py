@@ -0,0 +1,123 @@
+"""Tests for running requests' work in the background."""
+# pylint: disable=missing-docstring,no-self-use,too-few-public-methods
+
+import json
+import threading
+import unittest
+
+from six.moves.urllib.parse import urlparse
+
+from pystapler.dispatch import StaplerRoot, traversable
+from pystapler.metrics import Metrics, MetricsPage
+from pystapler.tasks import TaskQueue, background
+
+
+RELEASE = threading.Event()
+
+
+def make_root(task_queue):
+    class Root(StaplerRoot):
+        tasks = task_queue
+
+        @traversable
+        @background(task_queue)
+        def add(self, a, b):
+            RELEASE.wait(5)
+            return int(a) + int(b)
+
+        @traversable
+        @background(task_queue)
+        def fail(self):
+            raise ValueError('no shrubbery')
+
+        @traversable
+        def metrics(self):
+            return MetricsPage(Metrics(), task_queue)
+    return Root()
+
+
+class TaskTests(unittest.TestCase):
+    def setUp(self):
+        RELEASE.clear()
+        self.tasks = TaskQueue(workers=1, max_pending=2, retry_after=7)
+        self.client = make_root(self.tasks).test_client()
+
+    def tearDown(self):
+        RELEASE.set()
+
+    def status(self, url):
+        # Werkzeug makes the Location header absolute.
+        response = self.client.get(urlparse(url).path)
+        self.assertEqual(200, response.status_code)
+        return json.loads(response.data.decode('utf-8'))
+
+    def test_accepted(self):
+        response = self.client.post('/add?a=2&b=3')
+        self.assertEqual(202, response.status_code)
+        url = response.headers['Location']
+        self.assertTrue(url.endswith(
+            json.loads(response.data.decode('utf-8'))['status_url']))
+        self.assertTrue(urlparse(url).path.startswith('/tasks/'))
+        self.assertIn(self.status(url)['state'], ('pending', 'running'))
+        RELEASE.set()
+        self.tasks.drain(5)
+        status = self.status(url)
+        self.assertEqual('done', status['state'])
+        self.assertEqual(5, status['result'])
+
+    def test_failed(self):
+        url = self.client.post('/fail').headers['Location']
+        self.tasks.drain(5)
+        status = self.status(url)
+        self.assertEqual('failed', status['state'])
+        self.assertIn('no shrubbery', status['error'])
+
+    def test_backpressure(self):
+        rejected = self.tasks.stats()['rejected']
+        self.assertEqual(202, self.client.post('/add?a=1&b=1').status_code)
+        self.assertEqual(202, self.client.post('/add?a=1&b=1').status_code)
+        response = self.client.post('/add?a=1&b=1')
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('7', response.headers['Retry-After'])
+        self.assertEqual(rejected + 1, self.tasks.stats()['rejected'])
+        stats = self.tasks.stats()
+        self.assertEqual(2, stats['queued'] + stats['running'])
+        text = self.client.get('/metrics').data.decode('utf-8')
+        self.assertIn('pystapler_tasks_rejected_total{queue="default"} 1', text)
+        self.assertIn('pystapler_tasks_submitted_total{queue="default"} 2', text)
+
+    def test_drain_rejects(self):
+        RELEASE.set()
+        self.tasks.drain(5)
+        self.assertEqual(503, self.client.post('/add?a=1&b=1').status_code)
+
+    def test_unknown_task(self):
+        self.assertEqual(404, self.client.get('/tasks/nonsense').status_code)
+
+    def test_closed_parameters(self):
+        """Files closed when the response is sent cannot be taken."""
+        # pylint: disable=unused-argument
+        def upload(self, stream):
+            return stream.read()
+
+        def attach(self, files):
+            return list(files)
+        for method in (upload, attach):
+            self.assertRaises(TypeError, background(self.tasks), method)
+
+    def test_metrics_of_several_queues(self):
+        """Each metric is described once, followed by all its samples."""
+        other = TaskQueue(name='other')
+        text = MetricsPage(Metrics(), self.tasks, other).render().get_data(
+            as_text=True)
+        lines = text.splitlines()
+        self.assertEqual(
+            1, lines.count('# TYPE pystapler_tasks_queued gauge'))
+        index = lines.index('# TYPE pystapler_tasks_queued gauge')
+        self.assertEqual(
+            ['pystapler_tasks_queued{queue="default"} 0',
+             'pystapler_tasks_queued{queue="other"} 0'],
+            lines[index + 1:index + 3])
+
+
+# vim: et ts=4